@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0032_alter_exercise_teacher_files"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="exercise",
+            name="bundle_version",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0033_exercise_bundle_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="exercise",
+            name="result_cache_enabled",
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -108,22 +108,30 @@ class Course(models.Model):
             self.make_auto_groups()
 
     def save(self, *args, **kwargs):
+        former_language, former_late_penalty = None, None
+
         if self.pk is not None:
-            self.handle_student_groups_change(*args, **kwargs)
+            former_language, former_late_penalty = (
+                Course.objects.filter(pk=self.pk)
+                .values_list("language", "late_penalty")
+                .first()
+            ) or (None, None)
 
-            # Get submissions related to this course
-            # And update their grades
-            # TODO only if penalty changed!
-            from runner.models import Submission
+            self.handle_student_groups_change(*args, **kwargs)
 
-            course_submissions = Submission.objects.filter(
-                exercise__session__course=self
-            )
-            for submission in course_submissions:
-                submission.refresh_grade()
+            # The language is part of the exercise bundles
+            if former_language != self.language:
+                for exercise in Exercise.objects.filter(session__course=self):
+                    exercise.refresh_bundle_version()
 
         super(Course, self).save(*args, **kwargs)
 
+        # Update the grades of the course's submissions, once the new penalty is saved
+        if former_late_penalty is not None and former_late_penalty != self.late_penalty:
+            from runner.models import Submission
+
+            Submission.refresh_grades(exercise__session__course=self)
+
     def make_auto_groups(self):
         """
         Create groups of students, ordered alphabetically by username.
@@ -213,17 +221,21 @@ class Session(models.Model):
         return self.course.title + " : " + self.title
 
     def save(self, *args, **kwargs):
+        former_deadline = (
+            Session.objects.filter(pk=self.pk)
+            .values_list("deadline", flat=True)
+            .first()
+            if self.pk is not None
+            else None
+        )
+
         super(Session, self).save(*args, **kwargs)
 
-        if self.pk is not None:
-            # Get submissions related to this session
-            # And update their grades
-            # TODO only if session grade or deadline changed!
+        # Update the grades of the session's submissions, which are late or not anymore
+        if former_deadline != self.deadline:
             from runner.models import Submission
 
-            session_submissions = Submission.objects.filter(exercise__session=self)
-            for submission in session_submissions:
-                submission.refresh_grade()
+            Submission.refresh_grades(exercise__session=self)
 
 
 class Exercise(models.Model):
@@ -253,6 +265,102 @@ class Exercise(models.Model):
     # Multiple-file exercises specifics
     teacher_files = models.FileField(upload_to="teacher_files/", blank=True, null=True)
 
+    # Reuse the results of identical executions. Disable for non-deterministic exercises
+    result_cache_enabled = models.BooleanField(default=True)
+
+    # Hash of everything the runners need to run the exercise's tests (see get_bundle)
+    bundle_version = models.CharField(max_length=64, blank=True, editable=False)
+
+    def read_teacher_files(self):
+        """
+        Returns the teacher_files ZIP file in base64 format, or None if it cannot be found
+        """
+
+        import base64
+        import os
+
+        if not self.teacher_files or not os.path.exists(self.teacher_files.path):
+            return None
+
+        with self.teacher_files.open(mode="rb") as f:
+            return base64.b64encode(f.read()).decode()
+
+    def build_bundle(self):
+        """
+        Everything the runners need to run the tests of this exercise, whatever the submission
+        """
+
+        from runner.models import Test
+        import hashlib
+
+        teacher_files = (
+            self.read_teacher_files()
+            if self.type == self.ExerciseTypes.MULTIPLE
+            else None
+        )
+
+        return {
+            "exercise": self.id,
+            "type": self.type,
+            "language": self.session.course.language,
+            "prefix": self.prefix,
+            "suffix": self.suffix,
+            "teacher_files": teacher_files,
+            # Identifies the teacher files in the results cache keys
+            "teacher_files_version": (
+                hashlib.sha256(teacher_files.encode()).hexdigest()
+                if teacher_files
+                else None
+            ),
+            "result_cache": self.result_cache_enabled,
+            "tests": list(
+                Test.objects.filter(exercise=self).order_by("id").values("id", "stdin")
+            ),
+        }
+
+    def get_bundle(self):
+        """
+        The exercise bundle, with its version : a hash of its content.
+        Runners cache bundles by version, so any change to the exercise,
+        its tests or its teacher files gives a new bundle.
+        """
+
+        import hashlib
+        import json
+
+        bundle = self.build_bundle()
+        version = hashlib.sha256(
+            json.dumps(bundle, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        if version != self.bundle_version:
+            # NOTE : Not using `save()` because it would compute the bundle again
+            Exercise.objects.filter(pk=self.pk).update(bundle_version=version)
+            self.bundle_version = version
+
+        bundle["version"] = version
+        return bundle
+
+    def refresh_bundle_version(self):
+        return self.get_bundle()["version"]
+
+    def save(self, *args, **kwargs):
+        # (grade,) of the saved exercise, the grade itself may be None
+        former = (
+            Exercise.objects.filter(pk=self.pk).values_list("grade").first()
+            if self.pk is not None
+            else None
+        )
+
+        super(Exercise, self).save(*args, **kwargs)
+        self.refresh_bundle_version()
+
+        # Update the grades of the exercise's submissions, scaled to the new grade
+        if former is not None and former[0] != self.grade:
+            from runner.models import Submission
+
+            Submission.refresh_grades(exercise=self)
+
     def __str__(self):
         if self.type == self.ExerciseTypes.MULTIPLE:
             return self.title + " (multiple-file)"
@@ -138,6 +138,7 @@ class ExerciseSerializer(RoleBasedSerializer):
             "prefix",
             "suffix",
             "teacher_files",
+            "result_cache_enabled",
             "submission_status",
             "session",
             "session_id",
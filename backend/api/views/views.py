@@ -17,7 +17,6 @@ from rest_framework.response import Response
 from runner.models import Submission
 from runner.serializers import SubmissionSerializer
 from runner.serializers import TestResultSerializer
-import os
 
 
 class IsCourseOwner(permissions.BasePermission):
@@ -128,24 +127,19 @@ class ExerciseTeacherFilesViewSet(viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated | HasAPIKey]
 
     def list(self, request):
-        import base64
-
         exercise_id = self.request.query_params.get("exercise_id")
 
         exercise = Exercise.objects.get(id=exercise_id)
 
-        teacher_files_zip = exercise.teacher_files
+        teacher_files_zip_to_base64 = exercise.read_teacher_files()
 
         # Check if the file exists
-        if not os.path.exists(teacher_files_zip.path):
+        if teacher_files_zip_to_base64 is None:
             return Response(
                 {"message": "The teacher files cannot be found"},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        teacher_files_zip_to_base64 = base64.b64encode(teacher_files_zip.read())
-        teacher_files_zip.close()
-
         return Response(teacher_files_zip_to_base64)
 
 
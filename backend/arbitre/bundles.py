@@ -0,0 +1,67 @@
+"""
+In-memory cache of exercise bundles on the runners.
+
+A bundle holds everything needed to run the tests of an exercise (type, language,
+prefix, suffix, teacher files and tests' stdin), see `Exercise.get_bundle`.
+Bundles are immutable : editing an exercise gives it a new version,
+so cached bundles never need to be invalidated, only evicted.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import environ
+import os
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+
+class BundleCache:
+    """
+    LRU of the most recently used exercise bundles, by version
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.bundles: OrderedDict[str, dict] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, version: str):
+        with self.lock:
+            bundle = self.bundles.get(version)
+            if bundle is not None:
+                self.bundles.move_to_end(version)
+            return bundle
+
+    def put(self, bundle: dict):
+        with self.lock:
+            self.bundles[bundle["version"]] = bundle
+            self.bundles.move_to_end(bundle["version"])
+
+            while len(self.bundles) > self.max_entries:
+                self.bundles.popitem(last=False)
+
+
+_bundle_cache = BundleCache(env.int("BUNDLE_CACHE_SIZE", default=128))
+
+
+def get_cached_exercise_bundle(runner_data, exercise_id, version=None):
+    """
+    Return the bundle of an exercise, from the cache if this version was already fetched.
+
+    If the exercise was edited since the task was queued, the newest bundle is returned.
+    """
+
+    if version:
+        bundle = _bundle_cache.get(version)
+        if bundle is not None:
+            return bundle
+
+    bundle = runner_data.get_exercise_bundle(exercise_id)
+    if bundle is not None:
+        _bundle_cache.put(bundle)
+
+    return bundle
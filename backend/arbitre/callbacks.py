@@ -0,0 +1,95 @@
+"""
+Buffer of Judge0 callbacks.
+
+The callback endpoint only validates Judge0's output and pushes it to a Redis list,
+so that it answers at once however many callbacks arrive. The outputs are applied
+in micro-batches by `python manage.py ingest_callbacks` (see `TestResult.store_judge0_outputs`) :
+one bulk update, one status and grade refresh, and one WebSocket update per submission.
+
+Callbacks lost in between (consumer crash) are recovered like any lost callback :
+their results are fetched from Judge0 once their RUNNING_LEASE expires.
+"""
+
+from arbitre.redis_client import get_redis
+import base64
+import binascii
+import environ
+import json
+import os
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+CALLBACKS_KEY = "arbitre:judge0:callbacks"
+
+OUTPUT_STREAMS = ["message", "stdout", "stderr", "compile_output"]
+
+
+def is_callback_buffer_enabled():
+    return env.bool("CALLBACK_BUFFER", default=True)
+
+
+def is_valid_output(output_data):
+    """
+    Whether the output streams of a Judge0 output are valid base64.
+    Judge0 wraps them in lines of 60 characters, the line breaks are ignored.
+    """
+
+    for key in OUTPUT_STREAMS:
+        value = output_data.get(key)
+        if not value:
+            continue
+
+        try:
+            base64.b64decode("".join(value.split()), validate=True)
+        except (binascii.Error, AttributeError, ValueError):
+            return False
+
+    return True
+
+
+def buffer_callback(output_data):
+    """
+    Pushes a Judge0 output to the buffer. Returns False if it couldn't be,
+    the caller then stores it at once.
+    """
+
+    if not is_callback_buffer_enabled():
+        return False
+
+    try:
+        get_redis().rpush(CALLBACKS_KEY, json.dumps(output_data))
+    except Exception as e:
+        print(f"Couldn't buffer callback: {e}")
+        return False
+
+    return True
+
+
+def drain_callbacks(batch_size, timeout=1):
+    """
+    Pops up to `batch_size` buffered Judge0 outputs, in arrival order.
+    Waits up to `timeout` seconds (below the Redis socket timeout) for the first one.
+    """
+
+    first = get_redis().blpop(CALLBACKS_KEY, timeout=timeout)
+    if first is None:
+        return []
+
+    pipeline = get_redis().pipeline()
+    pipeline.lrange(CALLBACKS_KEY, 0, batch_size - 2)
+    pipeline.ltrim(CALLBACKS_KEY, batch_size - 1, -1)
+    rest, _ = pipeline.execute()
+
+    return [json.loads(item) for item in [first[1], *rest]]
+
+
+def get_backlog():
+    """
+    Number of callbacks waiting to be applied
+    """
+
+    return get_redis().llen(CALLBACKS_KEY)
@@ -1,7 +1,21 @@
 from celery import Celery
 from celery.schedules import crontab
+from kombu import Queue
 import os
-from arbitre.tasks import run_all_pending_testresults
+from arbitre.judge0_hosts import (
+    DEFAULT_POOL,
+    LEGACY_QUEUE,
+    get_judge0_pools,
+    get_pool_queue,
+    is_legacy_queue_consumed,
+)
+from arbitre.tasks import (
+    probe_judge0_hosts,
+    refresh_dirty_submissions,
+    relay_dispatch_outbox,
+    run_all_pending_testresults,
+)
+import environ
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "arbitre.settings")
@@ -12,6 +26,30 @@ app.conf.broker_transport_options = {"visibility_timeout": 3600}
 app.conf.result_backend_transport_options = {"visibility_timeout": 3600}
 app.conf.visibility_timeout = 3600
 
+# Live submissions, recovery of lost dispatches, and requeues have their own queues,
+# so that workers can be allocated to each of them (see run.sh).
+# Each pool of Judge0 hosts has its own set of queues, e.g. "interactive.large"
+app.conf.task_queues = [
+    Queue(name, routing_key=name, queue_arguments={"x-max-priority": 10})
+    for name in [
+        get_pool_queue(queue, pool)
+        for pool in [DEFAULT_POOL, *get_judge0_pools().keys()]
+        for queue in ["interactive", "recovery", "bulk"]
+    ]
+]
+
+# Declared as it was created, RabbitMQ refuses to declare a queue again with other arguments
+if is_legacy_queue_consumed():
+    app.conf.task_queues.append(Queue(LEGACY_QUEUE, routing_key=LEGACY_QUEUE))
+
+app.conf.task_default_queue = "interactive"
+app.conf.task_routes = {
+    "arbitre.tasks.delete_judge0_submissions": {"queue": "recovery"},
+    "arbitre.tasks.probe_judge0_hosts": {"queue": "recovery"},
+    "arbitre.tasks.relay_dispatch_outbox": {"queue": "recovery"},
+    "arbitre.tasks.run_all_pending_testresults": {"queue": "recovery"},
+}
+
 # Using a string here means the worker doesn't have to serialize
 # the configuration object to child processes.
 # - namespace='CELERY' means all celery-related configuration keys
@@ -24,7 +62,25 @@ app.autodiscover_tasks()
 
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
+    env = environ.Env()
+
+    # Submissions are dispatched by the outbox relay as soon as they're committed,
+    # these only catch up on what it missed
+    sender.add_periodic_task(
+        env.float("OUTBOX_RELAY_INTERVAL", default=5.0),
+        relay_dispatch_outbox.s(),
+    )
     sender.add_periodic_task(
-        15.0,  # every 15 seconds
+        env.float("PENDING_SWEEP_INTERVAL", default=60.0),
         run_all_pending_testresults.s(),
     )
+
+    # Submissions updated by their test results are refreshed once per window
+    recompute_window = env.float("RECOMPUTE_WINDOW", default=1.0)
+    if recompute_window > 0:
+        sender.add_periodic_task(recompute_window, refresh_dirty_submissions.s())
+
+    sender.add_periodic_task(
+        env.float("JUDGE0_PROBE_INTERVAL", default=10.0),
+        probe_judge0_hosts.s(),
+    )
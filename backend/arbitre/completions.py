@@ -0,0 +1,55 @@
+"""
+Latency of the submissions, from their upload to their final result.
+
+A submission is complete when none of its test results is pending or running anymore.
+`Submission.complete` fires once per upload (generation) at that moment : it records
+the latency here, in a histogram exposed by the `judge0-metrics` endpoint,
+and sends one `submission_completed` WebSocket message.
+"""
+
+from arbitre.redis_client import get_redis
+
+COMPLETION_KEY = "arbitre:submissions:completion"  # Hash of the latency histogram
+
+COMPLETION_BUCKETS = [1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+
+def record_completion_latency(latency):
+    """
+    Adds a completed submission to the latency histogram
+    """
+
+    bucket = next((str(le) for le in COMPLETION_BUCKETS if latency <= le), "+Inf")
+
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        pipeline.hincrby(COMPLETION_KEY, bucket, 1)
+        pipeline.hincrby(COMPLETION_KEY, "count", 1)
+        pipeline.hincrbyfloat(COMPLETION_KEY, "sum", latency)
+        pipeline.execute()
+    except Exception as e:
+        print(f"Couldn't record the latency of a submission: {e}")
+
+
+def get_completion_histogram():
+    """
+    Returns the latency histogram of the submissions : {"buckets", "count", "sum"}
+    with Prometheus' cumulative buckets, [(upper bound, submissions)]
+    """
+
+    counts = {
+        field.decode(): value
+        for field, value in get_redis().hgetall(COMPLETION_KEY).items()
+    }
+
+    buckets = []
+    cumulative = 0
+    for le in [str(le) for le in COMPLETION_BUCKETS] + ["+Inf"]:
+        cumulative += int(counts.get(le, 0))
+        buckets.append((le, cumulative))
+
+    return {
+        "buckets": buckets,
+        "count": int(counts.get("count", 0)),
+        "sum": float(counts.get("sum", 0)),
+    }
@@ -0,0 +1,244 @@
+"""
+Adaptive limit of the executions in flight on each Judge0 host, shared by all runners.
+
+Each host has a window : the number of executions it may run at once. Runners reserve
+slots in the window before sending tests, and callbacks free them. The window follows
+AIMD (additive increase, multiplicative decrease), like TCP congestion control :
+    - every execution called back within JUDGE0_TARGET_LATENCY seconds grows it by 1/window
+      (so about one slot per window of executions),
+    - an execution slower than that, or a Judge0 error, shrinks it by JUDGE0_WINDOW_DECREASE,
+      at most once per JUDGE0_TARGET_LATENCY seconds.
+
+Runners that find every window full retry later instead of piling work on Judge0.
+Executions never called back are forgotten after RUNNING_LEASE seconds.
+The windows and the measured latencies are exposed by the `judge0-metrics` endpoint.
+"""
+
+from arbitre import http_client
+from arbitre.judge0_hosts import choose_judge0_host, get_hosts_state, get_judge0_hosts
+from arbitre.redis_client import get_redis
+import environ
+import os
+import random
+import time
+import uuid
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+IN_FLIGHT_PREFIX = "arbitre:judge0:in-flight:"  # Sorted set of tokens, by sending time
+WINDOW_PREFIX = "arbitre:judge0:window:"  # Hash of the window and measures of a host
+
+# Reserves ARGV[5..] in the window if there is room for all of them.
+# A host with nothing in flight always accepts a reservation.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - tonumber(ARGV[2]))
+
+local window = tonumber(redis.call("HGET", KEYS[2], "window") or ARGV[3])
+local in_flight = redis.call("ZCARD", KEYS[1])
+if in_flight > 0 and in_flight + tonumber(ARGV[4]) > window then
+    return 0
+end
+
+for i = 5, #ARGV do
+    redis.call("ZADD", KEYS[1], now, ARGV[i])
+end
+return 1
+"""
+
+# Frees the slot of token ARGV[2], and adapts the window to its latency
+COMPLETE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local sent = redis.call("ZSCORE", KEYS[1], ARGV[2])
+if not sent then
+    return nil
+end
+redis.call("ZREM", KEYS[1], ARGV[2])
+
+local latency = now - tonumber(sent)
+local error = tonumber(ARGV[3])
+local target = tonumber(ARGV[4])
+local alpha = tonumber(ARGV[8])
+
+local state = redis.call("HMGET", KEYS[2], "window", "latency", "error_rate", "decreased_at")
+local window = tonumber(state[1] or ARGV[5])
+local average_latency = tonumber(state[2] or latency)
+local error_rate = tonumber(state[3] or 0)
+local decreased_at = tonumber(state[4] or 0)
+
+average_latency = average_latency + alpha * (latency - average_latency)
+error_rate = error_rate + alpha * (error - error_rate)
+
+if error == 1 or latency > target then
+    if now - decreased_at > target then
+        window = math.max(tonumber(ARGV[6]), window * tonumber(ARGV[9]))
+        decreased_at = now
+    end
+else
+    window = math.min(tonumber(ARGV[7]), window + 1 / window)
+end
+
+redis.call(
+    "HSET", KEYS[2], "window", tostring(window), "latency", tostring(average_latency),
+    "error_rate", tostring(error_rate), "decreased_at", tostring(decreased_at)
+)
+return tostring(latency)
+"""
+
+
+def get_initial_window():
+    return env.float("JUDGE0_INITIAL_WINDOW", default=20.0)
+
+
+def is_concurrency_limit_enabled():
+    return env.bool("JUDGE0_CONCURRENCY_LIMIT", default=True)
+
+
+def acquire_slots(hostname, count):
+    """
+    Reserves `count` slots in the window of a host.
+    Returns the reservations, or None if the window is full.
+    """
+
+    reservations = [f"reservation:{uuid.uuid4()}" for _ in range(count)]
+    if not is_concurrency_limit_enabled():
+        return reservations
+
+    try:
+        acquired = get_redis().eval(
+            ACQUIRE_SCRIPT,
+            2,
+            IN_FLIGHT_PREFIX + hostname,
+            WINDOW_PREFIX + hostname,
+            time.time(),
+            env.int("RUNNING_LEASE", default=120),
+            get_initial_window(),
+            count,
+            *reservations,
+        )
+    except Exception as e:
+        # Without Redis, executions are not limited
+        print(f"Couldn't reserve Judge0 slots: {e}")
+        return reservations
+
+    return reservations if acquired else None
+
+
+def acquire_judge0_host(count, pool=None):
+    """
+    Chooses a Judge0 host (of a pool) with room for `count` executions in its window.
+    Returns (hostname, reservations), or (None, None) if every healthy host is saturated
+    or has its circuit open.
+    """
+
+    states = get_hosts_state()
+    hostname = choose_judge0_host(pool)
+
+    # Other healthy hosts are tried if the chosen one is saturated
+    others = [
+        other
+        for other in get_judge0_hosts(pool)
+        if other != hostname and states.get(other, {"healthy": True})["healthy"]
+    ]
+    random.shuffle(others)
+
+    # Requests to hosts with an open circuit would fail at once
+    candidates = [hostname] + others
+    open_circuits = http_client.get_open_circuits(candidates)
+
+    for candidate in candidates:
+        if candidate in open_circuits:
+            continue
+
+        reservations = acquire_slots(candidate, count)
+        if reservations is not None:
+            return candidate, reservations
+
+    return None, None
+
+
+def commit_slots(hostname, reservations, tokens):
+    """
+    Replaces reservations by the tokens Judge0 returned, whose callbacks will free the slots.
+    Reservations without a token are freed.
+    """
+
+    if not is_concurrency_limit_enabled():
+        return
+
+    try:
+        pipeline = get_redis().pipeline()
+        if reservations:
+            pipeline.zrem(IN_FLIGHT_PREFIX + hostname, *reservations)
+        if tokens:
+            now = time.time()
+            pipeline.zadd(IN_FLIGHT_PREFIX + hostname, {token: now for token in tokens})
+        pipeline.execute()
+    except Exception as e:
+        print(f"Couldn't register Judge0 slots: {e}")
+
+
+def release_slots(hostname, reservations):
+    commit_slots(hostname, reservations, [])
+
+
+def record_completion(hostname, token, error=False):
+    """
+    Frees the slot of an execution that was called back, and adapts the host's window
+    to its latency. Returns the latency, or None if the execution wasn't tracked.
+    """
+
+    if not hostname or not is_concurrency_limit_enabled():
+        return None
+
+    try:
+        latency = get_redis().eval(
+            COMPLETE_SCRIPT,
+            2,
+            IN_FLIGHT_PREFIX + hostname,
+            WINDOW_PREFIX + hostname,
+            time.time(),
+            token,
+            1 if error else 0,
+            env.float("JUDGE0_TARGET_LATENCY", default=10.0),
+            get_initial_window(),
+            env.float("JUDGE0_MIN_WINDOW", default=2.0),
+            env.float("JUDGE0_MAX_WINDOW", default=200.0),
+            0.2,  # Smoothing of the measures
+            env.float("JUDGE0_WINDOW_DECREASE", default=0.5),
+        )
+    except Exception as e:
+        print(f"Couldn't record Judge0 completion: {e}")
+        return None
+
+    return float(latency) if latency is not None else None
+
+
+def get_windows_state():
+    """
+    Returns the window, executions in flight and measures of every host : {hostname: state}
+    """
+
+    states = {}
+
+    try:
+        redis = get_redis()
+        for hostname in get_judge0_hosts():
+            state = {
+                key.decode(): float(value)
+                for key, value in redis.hgetall(WINDOW_PREFIX + hostname).items()
+            }
+            states[hostname] = {
+                "window": state.get("window", get_initial_window()),
+                "in_flight": redis.zcard(IN_FLIGHT_PREFIX + hostname),
+                "latency_seconds": state.get("latency", 0.0),
+                "error_rate": state.get("error_rate", 0.0),
+            }
+    except Exception as e:
+        print(f"Couldn't read Judge0 windows: {e}")
+
+    return states
@@ -84,6 +84,13 @@ class SubmissionConsumer(AsyncWebsocketConsumer):
         # Send message to WebSocket
         await self.send(text_data=json.dumps({"message": message}))
 
+    # Receive the completion of the submission, sent once when its last test is done
+    async def submission_completed(self, event):
+        message = event["message"]
+
+        # Send message to WebSocket
+        await self.send(text_data=json.dumps({"message": message}))
+
     @database_sync_to_async
     def get_submission_id(self):
         submission = Submission.objects.filter(
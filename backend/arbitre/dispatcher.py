@@ -0,0 +1,420 @@
+"""
+Asynchronous Judge0 dispatcher.
+
+Celery runners hold one process per HTTP exchange with Judge0. This dispatcher instead
+consumes the dispatch outbox directly (DISPATCHER=async) and keeps up to DISPATCHER_CONCURRENCY
+dispatches in flight in a single process, over pooled keep-alive connections.
+
+Submissions are prepared and their results stored with the same functions as the
+`run_submission` task, the database being accessed directly (see DatabaseRunnerData).
+Judge0 requests that didn't reach the host are retried with exponential backoff and jitter,
+and go through the hosts' circuit breakers and latency histograms of `http_client`.
+
+> python manage.py judge0_dispatcher
+"""
+
+from arbitre import http_client
+from arbitre.concurrency import acquire_judge0_host
+from arbitre.tasks import (
+    BatchSubmissionsRejected,
+    DatabaseRunnerData,
+    get_batch_size,
+    get_unsent_test_ids,
+    is_batch_dispatch_enabled,
+    is_dispatch_done,
+    mark_dispatch_done,
+    prepare_submission,
+    register_judge0_responses,
+    report_dispatch_error,
+)
+from asgiref.sync import sync_to_async
+import asyncio
+import environ
+import httpx
+import os
+import random
+import requests
+import time
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+# Judge0 didn't handle the request, it can be sent again
+RETRYABLE_STATUSES = [502, 503, 504]
+
+
+class Judge0Unavailable(Exception):
+    pass
+
+
+def record_request(host, latency, failed):
+    """
+    Records a request to a Judge0 host in its latency histogram and circuit breaker,
+    as `http_client.request` does
+    """
+
+    http_client.record_latency(host, latency, error=failed)
+    if failed:
+        http_client.record_failure(host)
+    else:
+        http_client.record_success(host)
+
+
+async def post_with_backoff(client, url, data):
+    """
+    POSTs to Judge0, retrying with exponential backoff (and full jitter)
+    the requests that didn't reach it. Requests that may have been handled are not retried,
+    so that tests don't run twice.
+
+    Raises CircuitOpen (a ConnectionError) if the host's circuit is open.
+    """
+
+    host = http_client.get_host(url)
+    attempts = env.int("DISPATCHER_MAX_ATTEMPTS", default=5)
+    base_delay = env.float("DISPATCHER_BACKOFF_BASE", default=0.5)
+
+    # Redis is called from other threads, not to block the event loop
+    is_circuit_open = sync_to_async(http_client.is_circuit_open, thread_sensitive=False)
+    record = sync_to_async(record_request, thread_sensitive=False)
+
+    for attempt in range(attempts):
+        if await is_circuit_open(host):
+            raise http_client.CircuitOpen(f"Circuit of {host} is open")
+
+        start = time.monotonic()
+        try:
+            response = await client.post(url, json=data)
+        except httpx.PoolTimeout as e:
+            # No connection left in the pool, the host is not to blame
+            error = e
+        except httpx.TransportError as e:
+            await record(host, time.monotonic() - start, True)
+            if not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+                raise
+            error = e
+        else:
+            await record(host, time.monotonic() - start, response.status_code >= 500)
+            if response.status_code not in RETRYABLE_STATUSES:
+                return response
+            error = Judge0Unavailable(f"{url} responded {response.status_code}")
+
+        if attempt < attempts - 1:
+            await asyncio.sleep(random.uniform(0, base_delay * 2**attempt))
+
+    # Handled like the Celery runners' connection errors
+    raise requests.exceptions.ConnectionError(str(error))
+
+
+async def send_tests_batch(client, judge0_url, submissions):
+    """
+    Asynchronous `send_tests_to_judge0_batch`
+    """
+
+    response = await post_with_backoff(
+        client, f"{judge0_url}/batch", {"submissions": submissions}
+    )
+
+    if response.status_code >= 500:
+        raise requests.exceptions.ConnectionError
+
+    if response.status_code >= 400:
+        raise BatchSubmissionsRejected(response.text)
+
+    items = response.json()
+    if not isinstance(items, list) or len(items) != len(submissions):
+        raise BatchSubmissionsRejected(response.text)
+
+    return items
+
+
+async def send_test(client, judge0_url, submission):
+    response = await post_with_backoff(client, judge0_url, submission)
+    return response.json()
+
+
+async def send_tests(client, judge0_url, submissions, responses, start=0):
+    """
+    Sends tests one by one, concurrently, filling `responses` from index `start`.
+    All of them are waited for before an error is raised, so that no token is lost.
+    """
+
+    async def send(i, submission):
+        responses[i] = await send_test(client, judge0_url, submission)
+
+    results = await asyncio.gather(
+        *[send(start + i, s) for i, s in enumerate(submissions)],
+        return_exceptions=True,
+    )
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def dispatch_tests(client, judge0_url, submissions, responses):
+    """
+    Asynchronous `dispatch_tests_to_judge0` : batches when the host allows it,
+    the tests of a rejected batch being sent concurrently
+    """
+
+    if not is_batch_dispatch_enabled():
+        await send_tests(client, judge0_url, submissions, responses)
+        return
+
+    batch_size = get_batch_size()
+
+    for i in range(0, len(submissions), batch_size):
+        chunk = submissions[i : i + batch_size]
+        try:
+            chunk_responses = await send_tests_batch(client, judge0_url, chunk)
+        except BatchSubmissionsRejected as e:
+            print(f"Batch rejected by {judge0_url}, sending tests one by one: {e}")
+            await send_tests(client, judge0_url, chunk, responses, start=i)
+            continue
+
+        responses.update(enumerate(chunk_responses, start=i))
+
+
+class Dispatcher:
+    def __init__(self, concurrency, batch_size, poll_interval):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+        self.runner_data = DatabaseRunnerData()
+        self.tasks = set()
+        self.wakeup = asyncio.Event()
+        self.listen_connection = None
+
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=concurrency,
+                max_keepalive_connections=env.int(
+                    "DISPATCHER_KEEPALIVE_CONNECTIONS", default=100
+                ),
+            ),
+            timeout=httpx.Timeout(
+                env.float("DISPATCHER_REQUEST_TIMEOUT", default=30.0), connect=5.0
+            ),
+        )
+
+    def connect_listener(self):
+        """
+        Opens the connection listening to the outbox notifications (Postgres only).
+        Django refuses to open connections from the event loop, it's called through sync_to_async.
+        """
+
+        from django.db import connection
+        from runner.models import DispatchOutbox
+
+        if connection.vendor != "postgresql":
+            return None
+
+        # A dedicated connection, the others being used from sync_to_async's thread
+        listen_connection = connection.get_new_connection(
+            connection.get_connection_params()
+        )
+        listen_connection.autocommit = True
+        listen_connection.cursor().execute(f"LISTEN {DispatchOutbox.NOTIFY_CHANNEL}")
+
+        return listen_connection
+
+    async def listen(self):
+        """
+        Wakes the dispatcher up when outbox entries are committed (Postgres only)
+        """
+
+        self.listen_connection = await sync_to_async(self.connect_listener)()
+        if self.listen_connection is None:
+            return
+
+        def on_notify():
+            self.listen_connection.poll()
+            self.listen_connection.notifies.clear()
+            self.wakeup.set()
+
+        asyncio.get_running_loop().add_reader(
+            self.listen_connection.fileno(), on_notify
+        )
+
+    def claim(self, limit):
+        """
+        Claims up to `limit` outbox entries, with the relay's ordering and fairness
+        """
+
+        from runner.models import DispatchOutbox
+
+        claimed = []
+        DispatchOutbox.relay(
+            self.batch_size,
+            publish=lambda entry: claimed.append(entry.get_task_arguments()),
+            limit=limit,
+        )
+        return claimed
+
+    async def run_submission(
+        self,
+        submission_id,
+        test_ids,
+        payload_key=None,
+        exercise_id=None,
+        bundle_version=None,
+        dispatch_id=None,
+        generation=None,
+        attempt=0,
+    ):
+        """
+        Asynchronous `run_submission` task
+        """
+
+        if dispatch_id and await sync_to_async(is_dispatch_done)(dispatch_id):
+            return
+
+        tokens = {}
+        dispatched = False
+
+        try:
+            prepared = await sync_to_async(prepare_submission)(
+                self.runner_data,
+                submission_id,
+                test_ids,
+                payload_key,
+                exercise_id,
+                bundle_version,
+                generation,
+            )
+            if prepared is None:
+                return
+
+            test_ids = prepared["test_ids"]
+
+            # Wait for room in the concurrency window of a host
+            while True:
+                hostname, reservations = await sync_to_async(acquire_judge0_host)(
+                    len(test_ids), prepared["pool"]
+                )
+                if hostname is not None:
+                    break
+
+                # The sweep must not dispatch the tests again while they wait
+                delay = env.float("JUDGE0_SATURATED_RETRY_DELAY", default=2.0)
+                await sync_to_async(self.runner_data.extend_pending_leases)(
+                    submission_id, test_ids, delay, generation
+                )
+                await asyncio.sleep(delay)
+
+            responses = {}
+            try:
+                await dispatch_tests(
+                    self.client,
+                    f"http://{hostname}/submissions",
+                    prepared["submissions"],
+                    responses,
+                )
+            except Exception:
+                # The tests Judge0 accepted before the error run anyway, only the others are retried
+                sent_test_ids = test_ids
+                test_ids = get_unsent_test_ids(test_ids, responses)
+                await sync_to_async(register_judge0_responses)(
+                    self.runner_data,
+                    submission_id,
+                    hostname,
+                    reservations,
+                    sent_test_ids,
+                    responses,
+                    prepared["execution_keys"],
+                    tokens,
+                    generation,
+                )
+                raise
+            dispatched = True
+
+            await sync_to_async(register_judge0_responses)(
+                self.runner_data,
+                submission_id,
+                hostname,
+                reservations,
+                test_ids,
+                responses,
+                prepared["execution_keys"],
+                tokens,
+                generation,
+            )
+
+            if dispatch_id:
+                await sync_to_async(mark_dispatch_done)(dispatch_id)
+        except Exception as e:
+            delay = await sync_to_async(report_dispatch_error)(
+                self.runner_data,
+                submission_id,
+                test_ids,
+                tokens,
+                dispatched,
+                e,
+                attempt,
+                generation,
+            )
+            if delay is not None:
+                await asyncio.sleep(delay)
+                await self.run_submission(
+                    submission_id,
+                    test_ids,
+                    payload_key,
+                    exercise_id,
+                    bundle_version,
+                    dispatch_id,
+                    generation,
+                    attempt + 1,
+                )
+
+    def on_task_done(self, task):
+        self.tasks.discard(task)
+        self.wakeup.set()
+
+    async def close(self):
+        if self.listen_connection is not None:
+            asyncio.get_running_loop().remove_reader(self.listen_connection.fileno())
+            self.listen_connection.close()
+            self.listen_connection = None
+
+        await self.client.aclose()
+
+    async def run(self):
+        await self.listen()
+
+        print(f"Judge0 dispatcher started, up to {self.concurrency} dispatches at once")
+
+        try:
+            await self.dispatch_forever()
+        finally:
+            await self.close()
+
+    async def dispatch_forever(self):
+        while True:
+            available = self.concurrency - len(self.tasks)
+            claimed = []
+
+            if available > 0:
+                try:
+                    claimed = await sync_to_async(self.claim)(available)
+                except Exception as e:
+                    print(f"Couldn't claim outbox entries: {e}")
+
+            for args, kwargs in claimed:
+                task = asyncio.create_task(self.run_submission(*args, **kwargs))
+                self.tasks.add(task)
+                task.add_done_callback(self.on_task_done)
+
+            # More entries may be waiting
+            if claimed and len(claimed) == available:
+                continue
+
+            # Wait for new entries, finished dispatches, or the poll interval as a safety net
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,44 @@
+"""
+Current upload generation of the submissions, shared with the runners.
+
+A resubmission replaces the file of its Submission and gives it a new generation,
+so that runners drop the work queued for former uploads before it reaches Judge0.
+"""
+
+from arbitre.redis_client import get_redis
+import environ
+import os
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+GENERATION_PREFIX = "arbitre:submission-generation:"
+
+
+def publish_generation(submission_id, generation):
+    try:
+        get_redis().set(
+            GENERATION_PREFIX + str(submission_id),
+            generation,
+            ex=env.int("OUTBOX_RETENTION", default=24 * 3600),
+        )
+    except Exception as e:
+        print(f"Couldn't publish generation of submission {submission_id}: {e}")
+
+
+def is_stale_generation(submission_id, generation):
+    """
+    Whether the submission was uploaded again since this generation.
+    Without the current generation (Redis unavailable, expired), work is never dropped.
+    """
+
+    try:
+        current = get_redis().get(GENERATION_PREFIX + str(submission_id))
+    except Exception as e:
+        print(f"Couldn't check generation of submission {submission_id}: {e}")
+        return False
+
+    return current is not None and int(current) > generation
@@ -0,0 +1,242 @@
+"""
+HTTP client shared by the runners' calls to Judge0 and to Arbitre's REST API.
+
+    - Connections are pooled and kept alive : one pool per host, in a session per process.
+    - Every request has a connect timeout (HTTP_CONNECT_TIMEOUT) and a read timeout (HTTP_READ_TIMEOUT).
+    - Idempotent requests that didn't get an answer (connection errors, timeouts, 502/503/504)
+      are retried up to HTTP_MAX_RETRIES times, with an exponential backoff and full jitter.
+    - Judge0 hosts have a circuit breaker, shared by all runners : after HTTP_CIRCUIT_FAILURES
+      failures in a row, requests to the host fail at once for HTTP_CIRCUIT_COOLDOWN seconds.
+      The next request is then a trial : a failure opens the circuit again, a success closes it.
+    - The latency of the requests is recorded in a histogram per host,
+      exposed by the `judge0-metrics` endpoint.
+"""
+
+from arbitre.redis_client import get_redis
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import environ
+import os
+import random
+import requests
+import time
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+CIRCUIT_PREFIX = "arbitre:http:circuit:"  # Hash of the failures of a host
+LATENCY_PREFIX = "arbitre:http:latency:"  # Hash of the latency histogram of a host
+LATENCY_HOSTS_KEY = "arbitre:http:hosts"  # Set of the hosts with a histogram
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+# The host didn't handle the request, it can be sent again
+RETRYABLE_STATUSES = [502, 503, 504]
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+_session = None
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """
+    The host failed too often recently, the request has not been sent
+    """
+
+
+def get_session():
+    global _session
+
+    if _session is None:
+        adapter = HTTPAdapter(
+            pool_connections=env.int("HTTP_POOL_CONNECTIONS", default=10),
+            pool_maxsize=env.int("HTTP_POOL_MAXSIZE", default=10),
+        )
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+
+    return _session
+
+
+def get_host(url):
+    return urlsplit(url).netloc
+
+
+def is_circuit_open(host):
+    try:
+        opened_until = get_redis().hget(CIRCUIT_PREFIX + host, "opened_until")
+    except Exception as e:
+        print(f"Couldn't read the circuit of {host}: {e}")
+        return False
+
+    return opened_until is not None and float(opened_until) > time.time()
+
+
+def get_open_circuits(hosts):
+    """
+    Returns the hosts, among `hosts`, that requests are not sent to currently
+    """
+
+    try:
+        pipeline = get_redis().pipeline()
+        for host in hosts:
+            pipeline.hget(CIRCUIT_PREFIX + host, "opened_until")
+        opened_until = pipeline.execute()
+    except Exception as e:
+        print(f"Couldn't read the circuits: {e}")
+        return []
+
+    now = time.time()
+    return [
+        host
+        for host, until in zip(hosts, opened_until)
+        if until is not None and float(until) > now
+    ]
+
+
+def record_success(host):
+    try:
+        get_redis().delete(CIRCUIT_PREFIX + host)
+    except Exception as e:
+        print(f"Couldn't close the circuit of {host}: {e}")
+
+
+def record_failure(host):
+    try:
+        key = CIRCUIT_PREFIX + host
+        failures = get_redis().hincrby(key, "failures", 1)
+
+        if failures >= env.int("HTTP_CIRCUIT_FAILURES", default=5):
+            cooldown = env.float("HTTP_CIRCUIT_COOLDOWN", default=30.0)
+            print(
+                f"Too many failures on {host}, not sending it requests for {cooldown}s"
+            )
+            get_redis().hset(key, "opened_until", time.time() + cooldown)
+    except Exception as e:
+        print(f"Couldn't record a failure of {host}: {e}")
+
+
+def record_latency(host, latency, error=False):
+    """
+    Adds a request to the latency histogram of a host
+    """
+
+    bucket = next((str(le) for le in LATENCY_BUCKETS if latency <= le), "+Inf")
+
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        pipeline.sadd(LATENCY_HOSTS_KEY, host)
+        pipeline.hincrby(LATENCY_PREFIX + host, bucket, 1)
+        pipeline.hincrby(LATENCY_PREFIX + host, "count", 1)
+        pipeline.hincrbyfloat(LATENCY_PREFIX + host, "sum", latency)
+        if error:
+            pipeline.hincrby(LATENCY_PREFIX + host, "errors", 1)
+        pipeline.execute()
+    except Exception as e:
+        print(f"Couldn't record the latency of {host}: {e}")
+
+
+def get_latency_histograms():
+    """
+    Returns the latency histogram of every host : {host: {"buckets", "count", "sum", "errors"}}
+    with Prometheus' cumulative buckets, [(upper bound, requests)]
+    """
+
+    hosts = sorted(host.decode() for host in get_redis().smembers(LATENCY_HOSTS_KEY))
+
+    pipeline = get_redis().pipeline()
+    for host in hosts:
+        pipeline.hgetall(LATENCY_PREFIX + host)
+
+    histograms = {}
+    for host, counts in zip(hosts, pipeline.execute()):
+        counts = {field.decode(): value for field, value in counts.items()}
+
+        buckets = []
+        cumulative = 0
+        for le in [str(le) for le in LATENCY_BUCKETS] + ["+Inf"]:
+            cumulative += int(counts.get(le, 0))
+            buckets.append((le, cumulative))
+
+        histograms[host] = {
+            "buckets": buckets,
+            "count": int(counts.get("count", 0)),
+            "sum": float(counts.get("sum", 0)),
+            "errors": int(counts.get("errors", 0)),
+        }
+
+    return histograms
+
+
+def request(method, url, timeout=None, circuit_breaker=False, retry=None, **kwargs):
+    """
+    Sends a request with the shared session.
+
+    `timeout` overrides the read timeout. `circuit_breaker` enables the circuit breaker
+    of the host (Judge0 hosts). `retry` overrides whether the request is retried,
+    by default only idempotent ones (GET, PUT, DELETE) are.
+
+    Raises requests' exceptions, and CircuitOpen (a ConnectionError) if the host's circuit is open.
+    """
+
+    host = get_host(url)
+    timeout = (
+        env.float("HTTP_CONNECT_TIMEOUT", default=3.05),
+        timeout or env.float("HTTP_READ_TIMEOUT", default=30.0),
+    )
+
+    if retry is None:
+        retry = method.upper() in IDEMPOTENT_METHODS
+    attempts = 1 + (env.int("HTTP_MAX_RETRIES", default=3) if retry else 0)
+    base_delay = env.float("HTTP_BACKOFF_BASE", default=0.2)
+
+    for attempt in range(attempts):
+        if circuit_breaker and is_circuit_open(host):
+            raise CircuitOpen(f"Circuit of {host} is open")
+
+        start = time.monotonic()
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+            error = None
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            response = None
+            error = e
+
+        failed = response is None or response.status_code >= 500
+        record_latency(host, time.monotonic() - start, error=failed)
+
+        if circuit_breaker:
+            if failed:
+                record_failure(host)
+            else:
+                record_success(host)
+
+        retryable = response is None or response.status_code in RETRYABLE_STATUSES
+        if not retryable or attempt == attempts - 1:
+            break
+
+        time.sleep(random.uniform(0, base_delay * 2**attempt))
+
+    if error is not None:
+        raise error
+
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
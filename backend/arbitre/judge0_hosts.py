@@ -0,0 +1,227 @@
+"""
+Judge0 host scheduler.
+
+Each host's health and load are probed regularly through Judge0's `GET /workers`
+(see the `probe_judge0_hosts` task), and stored in Redis so that every runner shares them.
+Submissions are then sent to a healthy host, chosen at random with a weight
+proportional to its free capacity : hosts with deep queues get less work.
+
+A host that fails JUDGE0_MAX_PROBE_FAILURES probes in a row is taken out of rotation,
+and the results it was running are put back in pending state to be sent elsewhere.
+It's put back in rotation as soon as a probe succeeds.
+
+Hosts can be split into pools (JUDGE0_POOLS), so that languages needing more memory
+or compile time (Java, Kotlin...) run on larger hosts. Each pool has its own Celery queues.
+"""
+
+from arbitre import http_client
+from arbitre.redis_client import get_redis
+import environ
+import json
+import os
+import random
+import requests
+import time
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+HOSTS_STATE_KEY = "arbitre:judge0:hosts"
+
+# Submissions matching no pool run on JUDGE0_HOSTNAMES
+DEFAULT_POOL = "default"
+
+# Celery's default queue, used before the dispatch queues. The recovery workers consume it
+# until the messages published before they existed are drained : set LEGACY_QUEUE=False
+# once `rabbitmqctl list_queues` shows it empty, then remove it
+LEGACY_QUEUE = "celery"
+
+
+def get_judge0_pools():
+    """
+    Pools of Judge0 hosts, declared in JSON with JUDGE0_POOLS :
+        {"large": {"hosts": ["judge0-large:2358"], "languages": ["java", "kotlin"], "types": ["multiple"],
+                   "limits": {"memory_limit": 512000}}}
+
+    Single-file exercises run on the pool of their course's language,
+    multi-file exercises (Judge0's language 89) on the pool with "multiple" in its types.
+    """
+
+    pools = env("JUDGE0_POOLS", default="")
+    return json.loads(pools) if pools else {}
+
+
+def get_pool(exercise_type, language):
+    """
+    Returns the name of the pool running the exercises of this type and language
+    """
+
+    for name, pool in get_judge0_pools().items():
+        if exercise_type == "multiple":
+            if "multiple" in pool.get("types", []):
+                return name
+        elif language in pool.get("languages", []):
+            return name
+
+    return DEFAULT_POOL
+
+
+def get_pool_limits(pool):
+    """
+    Judge0 limits (cpu_time_limit, memory_limit...) sent with the submissions of a pool,
+    from its "limits", or JUDGE0_LIMITS (JSON) for the default pool.
+    Limits left out are the hosts' defaults.
+    """
+
+    pools = get_judge0_pools()
+    if pool in pools:
+        return pools[pool].get("limits", {})
+
+    limits = env("JUDGE0_LIMITS", default="")
+    return json.loads(limits) if limits else {}
+
+
+def get_pool_queue(queue, pool):
+    """
+    Name of the Celery queue of a dispatch queue (interactive, recovery, bulk) for a pool
+    """
+
+    if not pool or pool == DEFAULT_POOL:
+        return queue
+
+    return f"{queue}.{pool}"
+
+
+def is_legacy_queue_consumed():
+    return env.bool("LEGACY_QUEUE", default=True)
+
+
+def get_judge0_hosts(pool=None):
+    """
+    Returns the hosts of a pool, or every host if no pool is given
+    """
+
+    default_hosts = env.list("JUDGE0_HOSTNAMES", default=["localhost"])
+    pools = get_judge0_pools()
+
+    if pool is None:
+        hosts = list(default_hosts)
+        for pool_config in pools.values():
+            hosts += [host for host in pool_config["hosts"] if host not in hosts]
+        return hosts
+
+    if pool in pools:
+        return pools[pool]["hosts"]
+
+    return default_hosts
+
+
+def probe_host(hostname):
+    """
+    Returns the load of a Judge0 host, or None if it doesn't respond correctly.
+
+    `GET /workers` returns one item per queue, with its size (waiting submissions)
+    and its number of available, idle and working workers.
+    """
+
+    try:
+        # Failed probes are counted below, they are not retried
+        response = http_client.get(
+            f"http://{hostname}/workers",
+            timeout=env.float("JUDGE0_PROBE_TIMEOUT", default=2.0),
+            retry=False,
+        )
+        if response.status_code != 200:
+            return None
+        queues = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+    return {
+        "queue": sum(queue.get("size", 0) for queue in queues),
+        "available": sum(queue.get("available", 0) for queue in queues),
+        "working": sum(queue.get("working", 0) for queue in queues),
+    }
+
+
+def get_hosts_state():
+    """
+    Returns the last known state of every probed host : {hostname: state}
+    """
+
+    try:
+        states = get_redis().hgetall(HOSTS_STATE_KEY)
+    except Exception as e:
+        print(f"Couldn't read Judge0 hosts state: {e}")
+        return {}
+
+    return {hostname.decode(): json.loads(state) for hostname, state in states.items()}
+
+
+def probe_hosts():
+    """
+    Probes every Judge0 host and stores their state.
+    Returns the hosts that have just been taken out of rotation.
+    """
+
+    max_failures = env.int("JUDGE0_MAX_PROBE_FAILURES", default=3)
+    former_states = get_hosts_state()
+    dead_hosts = []
+
+    for hostname in get_judge0_hosts():
+        former_state = former_states.get(hostname, {"healthy": True, "failures": 0})
+        load = probe_host(hostname)
+
+        if load is not None:
+            state = {"healthy": load["available"] > 0, "failures": 0, **load}
+        else:
+            failures = former_state["failures"] + 1
+            state = {"healthy": failures < max_failures, "failures": failures}
+
+            if former_state["healthy"] and not state["healthy"]:
+                print(f"Judge0 host {hostname} is down, taking it out of rotation")
+                dead_hosts.append(hostname)
+
+        state["checked_at"] = time.time()
+        get_redis().hset(HOSTS_STATE_KEY, hostname, json.dumps(state))
+
+    return dead_hosts
+
+
+def get_host_weight(state):
+    """
+    The more available workers and the shorter the queue, the more submissions a host gets
+    """
+
+    return max(state.get("available", 1), 1) / (
+        1 + state.get("queue", 0) + state.get("working", 0)
+    )
+
+
+def choose_judge0_host(pool=None):
+    """
+    Choose the Judge0 host (of a pool) to send a submission to.
+    Falls back to a random host if no host is known to be healthy.
+    """
+
+    hosts = get_judge0_hosts(pool)
+    states = get_hosts_state()
+    open_circuits = http_client.get_open_circuits(hosts)
+
+    # Hosts not probed yet are considered healthy
+    healthy_hosts = [
+        hostname
+        for hostname in hosts
+        if states.get(hostname, {"healthy": True})["healthy"]
+        and hostname not in open_circuits
+    ]
+
+    if not healthy_hosts:
+        return random.choice(hosts)
+
+    weights = [get_host_weight(states.get(hostname, {})) for hostname in healthy_hosts]
+
+    return random.choices(healthy_hosts, weights=weights)[0]
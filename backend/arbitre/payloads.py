@@ -0,0 +1,269 @@
+"""
+Content-addressed store for the sources sent to the runners.
+
+Sources are stored once under the SHA-256 of their content, so that Celery
+messages only carry that key instead of the (possibly large) source itself.
+Runners fetch a payload by its key and keep the most recently used ones in memory.
+
+Two backends are available, selected with the PAYLOAD_STORE environment variable :
+    - "redis" (default) : shared by all runners, entries expire after PAYLOAD_STORE_TTL seconds.
+      Configure Redis with `maxmemory-policy volatile-lru` to evict the least recently used ones.
+    - "filesystem" : files in PAYLOAD_STORE_DIR, which must be shared with the runners.
+      Expired entries, then the least recently used ones, are removed
+      when the store grows over PAYLOAD_STORE_MAX_SIZE bytes.
+"""
+
+from abc import ABC, abstractmethod
+from arbitre.redis_client import get_redis
+from collections import OrderedDict
+from threading import Lock
+from typing_extensions import Optional
+import environ
+import hashlib
+import os
+import tempfile
+import time
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+
+def get_payload_key(payload: str) -> str:
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PayloadStore(ABC):
+    """
+    Base class for payload stores
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    @abstractmethod
+    def put(self, payload: str) -> str:
+        """
+        Store a payload (once) and return its key
+        """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """
+        Return the payload stored under this key, or None if it expired
+        """
+
+
+class RedisPayloadStore(PayloadStore):
+    """
+    Payloads in the Redis shared by the runners (see arbitre/redis_client.py)
+    """
+
+    PREFIX = "arbitre:payload:"
+
+    def put(self, payload: str) -> str:
+        key = get_payload_key(payload)
+
+        # Identical payloads are only written once, but their expiration is pushed back
+        if not get_redis().set(self.PREFIX + key, payload, ex=self.ttl, nx=True):
+            get_redis().expire(self.PREFIX + key, self.ttl)
+
+        return key
+
+    def get(self, key: str) -> Optional[str]:
+        pipeline = get_redis().pipeline()
+        pipeline.get(self.PREFIX + key)
+        pipeline.expire(self.PREFIX + key, self.ttl)
+        payload, _ = pipeline.execute()
+
+        return payload.decode("utf-8") if payload is not None else None
+
+
+class FileSystemPayloadStore(PayloadStore):
+    def __init__(self, directory: str, ttl: int, max_size: int):
+        super().__init__(ttl)
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def put(self, payload: str) -> str:
+        key = get_payload_key(payload)
+        path = self._path(key)
+
+        if os.path.exists(path):
+            # Mark as recently used
+            os.utime(path)
+            return key
+
+        # Write in a temporary file first, so that readers never see a partial payload
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+        return key
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl:
+                os.remove(path)
+                return None
+
+            with open(path, encoding="utf-8") as f:
+                payload = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Mark as recently used
+        os.utime(path)
+
+        return payload
+
+    def evict(self):
+        """
+        Remove expired payloads, then the least recently used ones until the store fits in max_size
+        """
+
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        expiration = time.time() - self.ttl
+
+        for mtime, size, path in entries:
+            if mtime >= expiration and total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class LocalPayloadCache:
+    """
+    In-memory LRU of the payloads already fetched by this process
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.payloads: OrderedDict[str, str] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            payload = self.payloads.get(key)
+            if payload is not None:
+                self.payloads.move_to_end(key)
+            return payload
+
+    def put(self, key: str, payload: str):
+        with self.lock:
+            if key in self.payloads:
+                self.payloads.move_to_end(key)
+                return
+
+            self.payloads[key] = payload
+            self.size += len(payload)
+
+            while self.size > self.max_size and self.payloads:
+                _, evicted = self.payloads.popitem(last=False)
+                self.size -= len(evicted)
+
+
+_payload_store: Optional[PayloadStore] = None
+_local_cache = LocalPayloadCache(
+    env.int("PAYLOAD_CACHE_MAX_SIZE", default=64 * 1024 * 1024)
+)
+
+
+def get_payload_store() -> Optional[PayloadStore]:
+    """
+    Return the configured payload store, or None if disabled (PAYLOAD_STORE=none)
+    """
+
+    global _payload_store
+
+    if _payload_store is None:
+        backend = env("PAYLOAD_STORE", default="redis")
+        ttl = env.int("PAYLOAD_STORE_TTL", default=24 * 3600)
+
+        if backend == "redis":
+            _payload_store = RedisPayloadStore(ttl)
+        elif backend == "filesystem":
+            _payload_store = FileSystemPayloadStore(
+                env(
+                    "PAYLOAD_STORE_DIR",
+                    default=os.path.join(tempfile.gettempdir(), "arbitre-payloads"),
+                ),
+                ttl,
+                env.int("PAYLOAD_STORE_MAX_SIZE", default=1024 * 1024 * 1024),
+            )
+
+    return _payload_store
+
+
+def store_payload(payload: str) -> Optional[str]:
+    """
+    Store a payload and return its key, or None if it couldn't be stored.
+    Without a key, the runners load the source from the REST API.
+    """
+
+    store = get_payload_store()
+    if store is None:
+        return None
+
+    try:
+        key = store.put(payload)
+    except Exception as e:
+        print(f"Couldn't store payload: {e}")
+        return None
+
+    _local_cache.put(key, payload)
+    return key
+
+
+def load_payload(key: str) -> Optional[str]:
+    """
+    Return the payload stored under this key, from the local cache if possible
+    """
+
+    payload = _local_cache.get(key)
+    if payload is not None:
+        return payload
+
+    store = get_payload_store()
+    if store is None:
+        return None
+
+    try:
+        payload = store.get(key)
+    except Exception as e:
+        print(f"Couldn't load payload {key}: {e}")
+        return None
+
+    # Make sure the payload has not been tampered with
+    if payload is None or get_payload_key(payload) != key:
+        return None
+
+    _local_cache.put(key, payload)
+    return payload
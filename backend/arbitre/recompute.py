@@ -0,0 +1,79 @@
+"""
+Debounced recomputation of the submissions' status and grade.
+
+Every stored test result used to refresh its submission, so a submission with 30 tests
+was refreshed 30 times in a row as callbacks arrived. Submissions are now marked dirty instead,
+in a Redis sorted set scored by when they're due : RECOMPUTE_WINDOW seconds after their first mark.
+Marking a submission already waiting doesn't postpone it, so each submission is refreshed
+at most once per window while updates keep coming.
+
+The `refresh_dirty_submissions` task refreshes the due submissions every RECOMPUTE_WINDOW seconds.
+A submission is unmarked before it's refreshed, so updates made meanwhile mark it again :
+the last update is always followed by a refresh.
+"""
+
+from arbitre.redis_client import get_redis
+import environ
+import os
+import time
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+DIRTY_KEY = "arbitre:submissions:dirty"
+
+# Pops the submissions due before ARGV[1], at most ARGV[2]
+POP_DUE_SCRIPT = """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call("ZREM", KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+def get_recompute_window():
+    return env.float("RECOMPUTE_WINDOW", default=1.0)
+
+
+def mark_dirty(submission_ids):
+    """
+    Schedules the refresh of submissions. Returns False if it couldn't be scheduled
+    (disabled with RECOMPUTE_WINDOW=0, or Redis unreachable) : the caller then refreshes them at once.
+    """
+
+    window = get_recompute_window()
+    if window <= 0:
+        return False
+
+    if not submission_ids:
+        return True
+
+    try:
+        # NX : submissions already waiting keep their due time
+        get_redis().zadd(
+            DIRTY_KEY,
+            {
+                str(submission_id): time.time() + window
+                for submission_id in submission_ids
+            },
+            nx=True,
+        )
+    except Exception as e:
+        print(f"Couldn't schedule the refresh of submissions {submission_ids}: {e}")
+        return False
+
+    return True
+
+
+def pop_due_submissions(limit=1000):
+    """
+    Returns the ids of the submissions due for a refresh, and unmarks them
+    """
+
+    due = get_redis().eval(POP_DUE_SCRIPT, 1, DIRTY_KEY, time.time(), limit)
+
+    return [int(submission_id) for submission_id in due]
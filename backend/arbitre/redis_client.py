@@ -0,0 +1,29 @@
+"""
+Redis connection shared by the runners' coordination state (hosts health, limits, caches).
+"""
+
+import environ
+import os
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+
+    if _redis is None:
+        import redis
+
+        _redis = redis.Redis.from_url(
+            env("REDIS_URL", default="redis://localhost:6379/0"),
+            socket_connect_timeout=2,
+            socket_timeout=5,
+        )
+
+    return _redis
@@ -0,0 +1,155 @@
+"""
+Cache of Judge0 execution results.
+
+Running the same source on the same stdin, with the same language and teacher files,
+on the same pool of hosts with the same limits, gives the same result. Requeues, resubmissions of an unchanged file and new tests
+therefore reuse the output stored by a former execution instead of sending it to Judge0 again.
+
+Results are stored in Redis under a hash of the execution's inputs, and the least recently
+used ones are evicted when there are more than RESULT_CACHE_MAX_ENTRIES.
+Only deterministic outcomes are cached : time limits and Judge0 internal errors are not.
+The cache can be turned off globally (RESULT_CACHE=False) or per exercise
+(Exercise.result_cache_enabled) for non-deterministic exercises.
+"""
+
+from arbitre.redis_client import get_redis
+import environ
+import hashlib
+import json
+import os
+import time
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+RESULT_PREFIX = "arbitre:result:"
+TOKEN_PREFIX = "arbitre:result-token:"
+LRU_KEY = "arbitre:results:lru"
+
+# Judge0 output fields needed to compute a test result
+CACHED_FIELDS = ["message", "stdout", "stderr", "compile_output", "time", "memory"]
+
+# Judge0 statuses : 3 Accepted, 4 Wrong Answer, 6 Compilation Error, 7 to 12 Runtime Errors
+# 5 (Time Limit Exceeded) depends on the host's load, 13 and 14 are Judge0 errors
+CACHEABLE_STATUSES = {3, 4, 6, 7, 8, 9, 10, 11, 12}
+
+
+def is_result_cache_enabled():
+    return env.bool("RESULT_CACHE", default=True)
+
+
+def get_execution_key(
+    source_code, student_files, teacher_files_version, stdin, language_id, pool, limits
+):
+    """
+    Hash of everything that determines the result of an execution.
+    The pool stands for the hosts' environment and default limits,
+    a memory limit reached on a small host must not be served for a larger one.
+    """
+
+    execution = {
+        "source_code": source_code,
+        "student_files": student_files,
+        "teacher_files_version": teacher_files_version,
+        "stdin": stdin,
+        "language_id": language_id,
+        "pool": pool,
+        "limits": limits,
+    }
+
+    return hashlib.sha256(
+        json.dumps(execution, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def get_cached_results(keys):
+    """
+    Returns the cached Judge0 outputs of the given executions : {id: output}
+    `keys` is a dict of {id: execution key}, ids without a cached result are left out.
+    """
+
+    if not keys:
+        return {}
+
+    ids = list(keys.keys())
+
+    try:
+        redis = get_redis()
+        outputs = redis.mget([RESULT_PREFIX + keys[id] for id in ids])
+
+        hits = {id: json.loads(output) for id, output in zip(ids, outputs) if output}
+
+        # Mark as recently used
+        if hits:
+            now = time.time()
+            redis.zadd(LRU_KEY, {keys[id]: now for id in hits})
+    except Exception as e:
+        print(f"Couldn't read result cache: {e}")
+        return {}
+
+    return hits
+
+
+def remember_execution(token, key):
+    """
+    Remember which execution a Judge0 token runs, to cache its result on callback
+    """
+
+    try:
+        get_redis().set(
+            TOKEN_PREFIX + token, key, ex=env.int("RESULT_CACHE_TOKEN_TTL", 24 * 3600)
+        )
+    except Exception as e:
+        print(f"Couldn't write result cache: {e}")
+
+
+def store_result(token, output_data):
+    """
+    Cache the Judge0 output of a token's execution, if it was remembered and is deterministic
+    """
+
+    if not is_result_cache_enabled():
+        return
+
+    try:
+        redis = get_redis()
+        key = redis.getdel(TOKEN_PREFIX + token)
+        if key is None:
+            return
+
+        status_id = (output_data.get("status") or {}).get("id")
+        if status_id not in CACHEABLE_STATUSES:
+            return
+
+        key = key.decode()
+        output = {field: output_data.get(field) for field in CACHED_FIELDS}
+
+        pipeline = redis.pipeline()
+        pipeline.set(RESULT_PREFIX + key, json.dumps(output))
+        pipeline.zadd(LRU_KEY, {key: time.time()})
+        pipeline.zcard(LRU_KEY)
+        size = pipeline.execute()[-1]
+
+        evict(redis, size)
+    except Exception as e:
+        print(f"Couldn't write result cache: {e}")
+
+
+def evict(redis, size):
+    """
+    Remove the least recently used results over RESULT_CACHE_MAX_ENTRIES
+    """
+
+    max_entries = env.int("RESULT_CACHE_MAX_ENTRIES", default=100000)
+    if size <= max_entries:
+        return
+
+    evicted = redis.zrange(LRU_KEY, 0, size - max_entries - 1)
+    if evicted:
+        pipeline = redis.pipeline()
+        pipeline.delete(*[RESULT_PREFIX + key.decode() for key in evicted])
+        pipeline.zrem(LRU_KEY, *evicted)
+        pipeline.execute()
@@ -1,10 +1,31 @@
+from arbitre.bundles import get_cached_exercise_bundle
+from arbitre.generations import is_stale_generation
+from arbitre.concurrency import acquire_judge0_host, commit_slots
+from arbitre import http_client
+from arbitre.judge0_hosts import (
+    get_judge0_hosts,
+    get_pool,
+    get_pool_limits,
+    probe_hosts,
+)
+from arbitre.payloads import load_payload
+from arbitre.redis_client import get_redis
+from arbitre.results_cache import (
+    get_cached_results,
+    get_execution_key,
+    is_result_cache_enabled,
+    remember_execution,
+)
 from celery import shared_task
+import base64
+import io
 import json
 import requests
 import environ
 import os
+import random
 import sys
-from rest_framework import status
+import zipfile
 
 # Reading .env file
 env = environ.Env()
@@ -37,12 +58,13 @@ def get_lang_id(lang):
         "javascript": 63,
         "kotlin": 78,
         "lua": 64,
-        "objective-c": 79,
+        "objectivec": 79,
         "ocaml": 65,
         "octave": 66,
         "pascal": 67,
         "perl": 85,
         "php": 68,
+        "prolog": 69,
         "python": 71,
         "r": 80,
         "ruby": 72,
@@ -53,6 +75,13 @@ def get_lang_id(lang):
         "typescript": 74,
         "vbnet": 84,
     }
+
+    # Retrying or replaying the dispatch wouldn't change anything
+    if lang not in JUDGE0_LANG_IDS:
+        raise SubmissionRejected(
+            "The language of this course is not supported. Please contact your teacher."
+        )
+
     return JUDGE0_LANG_IDS[lang]
 
 
@@ -90,51 +119,321 @@ def get_api_key():
     return api_key
 
 
-def get_test(base_url, test_id):
-    tests = requests.get(
-        f"{base_url}/test/{test_id}/",
+def get_submission_payload(base_url, submission_id, with_file=True):
+    """
+    Get everything needed to run the tests of a submission in one request :
+    the submission's source (unless with_file is False), its exercise's settings and tests
+    """
+
+    with_file = "true" if with_file else "false"
+    response = http_client.get(
+        f"{base_url}/submission-payload/?submission_id={submission_id}&with_file={with_file}",
+        headers={"Authorization": f"Api-Key {get_api_key()}"},
+    )
+    if response.status_code == 401:
+        print(
+            "ERROR while trying to get submission content : Unauthorized access to the REST API",
+            file=sys.stderr,
+        )
+        return
+    if response.status_code == 404:
+        print(f"Submission {submission_id} not found", file=sys.stderr)
+        return
+    return json.loads(response.content)
+
+
+def get_exercise_bundle(base_url, exercise_id):
+    """
+    Get the bundle of an exercise : everything needed to run its tests, with its version
+    """
+
+    response = http_client.get(
+        f"{base_url}/exercise-bundle/?exercise_id={exercise_id}",
         headers={"Authorization": f"Api-Key {get_api_key()}"},
     )
-    if tests.status_code == 401:
+    if response.status_code == 401:
         print(
-            "ERROR while trying to get tests content : Unauthorized access to the REST API",
+            "ERROR while trying to get exercise bundle : Unauthorized access to the REST API",
             file=sys.stderr,
         )
         return
-    return json.loads(tests.content)
+    if response.status_code == 404:
+        print(f"Exercise {exercise_id} not found", file=sys.stderr)
+        return
+    return json.loads(response.content)
+
 
+def post_testresults_with_tokens(
+    submission_id, tokens, host, testresult_tokens_url, generation=None
+):
+    """
+    Maps the Judge0 tokens of several tests of a submission to their TestResults in one request.
+
+    `tokens` is a dict of {test_id: token}, `host` the Judge0 host running them,
+    `generation` the upload they were sent for
+    """
 
-def post_testresult_with_token(submission_id, test_id, token, testresult_post_url):
     data = {
         "submission_pk": submission_id,
-        "exercise_test_pk": test_id,
-        "status": "running",
-        "token": token,
+        "tokens": {str(test_id): token for test_id, token in tokens.items()},
+        "host": host,
+        "generation": generation,
     }
-    requests.post(
-        testresult_post_url,
-        data=data,
+    http_client.post(
+        testresult_tokens_url,
+        json=data,
+        headers={"Authorization": f"Api-Key {get_api_key()}"},
+        retry=True,
+    )
+
+
+def post_testresults_cached_outputs(
+    submission_id, outputs, testresult_cached_url, generation=None
+):
+    """
+    Stores the results of several tests of a submission from cached Judge0 outputs in one request.
+
+    `outputs` is a dict of {test_id: Judge0 output}, `generation` the upload they're for
+    """
+
+    data = {
+        "submission_pk": submission_id,
+        "outputs": {str(test_id): output for test_id, output in outputs.items()},
+        "generation": generation,
+    }
+    http_client.post(
+        testresult_cached_url,
+        json=data,
         headers={"Authorization": f"Api-Key {get_api_key()}"},
+        retry=True,
     )
 
 
-def send_test_to_judge0(judge0_url, source_code, additional_files, language_id, stdin):
+class BatchSubmissionsRejected(Exception):
+    """
+    The Judge0 host doesn't accept batched submissions (disabled, or batch too large)
+    """
+
+
+def get_batch_size():
+    # Judge0's MAX_SUBMISSION_BATCH_SIZE defaults to 20
+    return env.int("JUDGE0_BATCH_SIZE", default=20)
+
+
+def is_batch_dispatch_enabled():
+    return env.bool("JUDGE0_BATCH_DISPATCH", default=True)
+
+
+def build_judge0_submission(
+    source_code, additional_files, language_id, stdin, limits=None
+):
     request = {
         "language_id": language_id,
         "source_code": source_code,
         "stdin": stdin,
         "callback_url": get_callback_url(),
+        **(limits or {}),
     }
 
     if additional_files:
         request["additional_files"] = additional_files
 
-    print("Sending to judge0 with callback_url:", get_callback_url())
+    return request
+
+
+def send_submission_to_judge0(judge0_url, request):
+    response_object = http_client.post(judge0_url, json=request, circuit_breaker=True)
+
+    # Judge0 didn't handle the submission, it's retried
+    if response_object.status_code >= 500:
+        raise requests.exceptions.ConnectionError(response_object.text)
 
-    response_object = requests.post(judge0_url, json=request)
     return json.loads(response_object.text)
 
 
+def send_tests_to_judge0_batch(judge0_url, submissions):
+    """
+    Sends several submissions to Judge0 in a single `POST /submissions/batch`.
+
+    Returns one item per submission, in the same order : either {"token": ...}
+    or the validation errors of that submission.
+    """
+
+    print(
+        f"Sending a batch of {len(submissions)} submissions to judge0 with callback_url:",
+        get_callback_url(),
+    )
+
+    response_object = http_client.post(
+        f"{judge0_url}/batch", json={"submissions": submissions}, circuit_breaker=True
+    )
+
+    if response_object.status_code >= 500:
+        raise requests.exceptions.ConnectionError
+
+    if response_object.status_code >= 400:
+        raise BatchSubmissionsRejected(response_object.text)
+
+    response = json.loads(response_object.text)
+    if not isinstance(response, list) or len(response) != len(submissions):
+        raise BatchSubmissionsRejected(response_object.text)
+
+    return response
+
+
+def dispatch_tests_to_judge0(judge0_url, submissions, responses):
+    """
+    Sends submissions to Judge0, in batches when the host allows it, one by one otherwise.
+
+    Fills `responses` with {index of the submission: Judge0 response} as they are sent :
+    if a chunk fails, the responses of the chunks Judge0 accepted before are kept.
+    """
+
+    if not is_batch_dispatch_enabled():
+        for i, submission in enumerate(submissions):
+            responses[i] = send_submission_to_judge0(judge0_url, submission)
+        return
+
+    batch_size = get_batch_size()
+
+    for i in range(0, len(submissions), batch_size):
+        chunk = submissions[i : i + batch_size]
+        try:
+            chunk_responses = send_tests_to_judge0_batch(judge0_url, chunk)
+        except BatchSubmissionsRejected as e:
+            print(f"Batch rejected by {judge0_url}, sending tests one by one: {e}")
+            for j, submission in enumerate(chunk):
+                responses[i + j] = send_submission_to_judge0(judge0_url, submission)
+            continue
+
+        responses.update(enumerate(chunk_responses, start=i))
+
+
+def get_judge0_results_batch(hostname, tokens):
+    """
+    Fetches the results of several submissions from a Judge0 host in one `GET /submissions/batch`.
+
+    Returns {token: output} with the same (base64-encoded) fields as the callback,
+    tokens unknown to the host are left out.
+    """
+
+    response_object = http_client.get(
+        f"http://{hostname}/submissions/batch",
+        params={
+            "tokens": ",".join(tokens),
+            "base64_encoded": "true",
+            "fields": "token,status,message,stdout,stderr,compile_output,time,memory",
+        },
+        timeout=env.float("JUDGE0_RESULTS_TIMEOUT", default=10.0),
+        circuit_breaker=True,
+    )
+
+    if response_object.status_code >= 400:
+        raise requests.exceptions.ConnectionError(response_object.text)
+
+    submissions = json.loads(response_object.text).get("submissions") or []
+
+    return {
+        submission["token"]: submission
+        for submission in submissions
+        if submission and submission.get("token")
+    }
+
+
+def reconcile_overdue_testresults():
+    """
+    Fetches the results of the tests whose Judge0 callback is late or lost,
+    and stores them as the callback would have, instead of running the tests again
+    """
+
+    from runner.models import TestResult
+
+    batch_size = get_batch_size()
+
+    for tokens_by_host in TestResult.get_overdue_tokens():
+        for hostname, tokens in tokens_by_host.items():
+            if hostname:
+                reconcile_host_tokens(hostname, tokens, batch_size)
+            else:
+                reconcile_hostless_tokens(tokens, batch_size)
+
+
+def reconcile_host_tokens(hostname, tokens, batch_size):
+    """
+    Fetches and stores the results of overdue tokens of a Judge0 host, in chunks of `batch_size`
+    """
+
+    from runner.models import TestResult
+
+    for i in range(0, len(tokens), batch_size):
+        chunk = tokens[i : i + batch_size]
+        try:
+            outputs = get_judge0_results_batch(hostname, chunk)
+        except requests.exceptions.RequestException as e:
+            # They're still running as far as we know : they wait for the next reconciliation,
+            # or are released by the probe if the host is down
+            print(f"Couldn't fetch results from {hostname}: {e}")
+            TestResult.extend_leases(tokens[i:])
+            return
+
+        # A chunk that can't be stored must not block the following ones
+        try:
+            TestResult.reconcile(chunk, outputs)
+        except Exception as e:
+            print(f"Couldn't reconcile results from {hostname}: {e}")
+            TestResult.extend_leases(chunk)
+
+
+def reconcile_hostless_tokens(tokens, batch_size):
+    """
+    Fetches and stores the results of overdue tokens whose host wasn't recorded
+    (dispatched before hosts were), from every Judge0 host, in chunks of `batch_size`.
+
+    Tokens are only dispatched again once every host answered without them.
+    """
+
+    from runner.models import TestResult
+
+    for i in range(0, len(tokens), batch_size):
+        chunk = tokens[i : i + batch_size]
+        outputs = {}
+        unreachable = False
+
+        for hostname in get_judge0_hosts():
+            try:
+                outputs.update(get_judge0_results_batch(hostname, chunk))
+            except requests.exceptions.RequestException as e:
+                print(f"Couldn't fetch results from {hostname}: {e}")
+                unreachable = True
+
+        # The tokens that weren't found could be on the unreachable hosts
+        if unreachable:
+            TestResult.extend_leases([token for token in chunk if token not in outputs])
+            chunk = [token for token in chunk if token in outputs]
+
+        try:
+            TestResult.reconcile(chunk, outputs)
+        except Exception as e:
+            print(f"Couldn't reconcile results: {e}")
+            TestResult.extend_leases(chunk)
+
+
+def post_testresults_leases(
+    submission_id, test_ids, delay, generation, testresult_leases_url
+):
+    data = {
+        "submission_pk": submission_id,
+        "test_ids": test_ids,
+        "delay": delay,
+        "generation": generation,
+    }
+    http_client.post(
+        testresult_leases_url,
+        json=data,
+        headers={"Authorization": f"Api-Key {get_api_key()}"},
+    )
+
+
 def post_error_testresult(message, submission_id, test_id, testresult_post_url):
     after_data = {
         "submission_pk": submission_id,
@@ -144,21 +443,149 @@ def post_error_testresult(message, submission_id, test_id, testresult_post_url):
         "time": 0,
         "memory": 0,
     }
-    requests.post(
+    http_client.post(
         testresult_post_url,
         data=after_data,
         headers={"Authorization": f"Api-Key {get_api_key()}"},
     )
 
 
-def zip_directory(path, zip_file_handle):
-    for root, _, files in os.walk(path):
-        for file in files:
-            zip_file_handle.write(
-                os.path.join(root, file), os.path.basename(os.path.join(root, file))
+def post_dead_letter(
+    submission_id, test_ids, generation, attempts, error, dead_letter_url
+):
+    data = {
+        "submission_pk": submission_id,
+        "test_ids": test_ids,
+        "generation": generation,
+        "attempts": attempts,
+        "error": error,
+    }
+    http_client.post(
+        dead_letter_url,
+        json=data,
+        headers={"Authorization": f"Api-Key {get_api_key()}"},
+    )
+
+
+class RestRunnerData:
+    """
+    Runner data access through Arbitre's REST API, for runners hosted away from the database
+    """
+
+    def get_submission_payload(self, submission_id, with_file=True):
+        return get_submission_payload(get_base_runner_url(), submission_id, with_file)
+
+    def get_exercise_bundle(self, exercise_id):
+        return get_exercise_bundle(get_base_runner_url(), exercise_id)
+
+    def register_tokens(self, submission_id, tokens, host, generation=None):
+        post_testresults_with_tokens(
+            submission_id,
+            tokens,
+            host,
+            f"{get_base_runner_url()}/testresult-tokens/",
+            generation,
+        )
+
+    def apply_cached_outputs(self, submission_id, outputs, generation=None):
+        post_testresults_cached_outputs(
+            submission_id,
+            outputs,
+            f"{get_base_runner_url()}/testresult-cached/",
+            generation,
+        )
+
+    def extend_pending_leases(self, submission_id, test_ids, delay, generation=None):
+        post_testresults_leases(
+            submission_id,
+            test_ids,
+            delay,
+            generation,
+            f"{get_base_runner_url()}/testresult-leases/",
+        )
+
+    def post_error(self, submission_id, test_id, message):
+        post_error_testresult(
+            message, submission_id, test_id, f"{get_base_runner_url()}/testresult/"
+        )
+
+    def dead_letter(self, submission_id, test_ids, generation, attempts, error):
+        post_dead_letter(
+            submission_id,
+            test_ids,
+            generation,
+            attempts,
+            error,
+            f"{get_base_runner_url()}/dead-letter/",
+        )
+
+
+class DatabaseRunnerData:
+    """
+    Runner data access through the Django ORM, for runners running inside the Django project.
+    Saves the HTTP round-trips through the REST API.
+    """
+
+    def get_submission_payload(self, submission_id, with_file=True):
+        from runner.models import Submission
+
+        try:
+            submission = Submission.objects.select_related(
+                "exercise__session__course"
+            ).get(pk=submission_id)
+            return submission.get_runner_payload(with_file=with_file)
+        except (Submission.DoesNotExist, FileNotFoundError):
+            print(f"Submission {submission_id} not found", file=sys.stderr)
+            return None
+
+    def get_exercise_bundle(self, exercise_id):
+        from api.models import Exercise
+
+        try:
+            exercise = Exercise.objects.select_related("session__course").get(
+                pk=exercise_id
             )
+        except Exercise.DoesNotExist:
+            print(f"Exercise {exercise_id} not found", file=sys.stderr)
+            return None
+
+        return exercise.get_bundle()
+
+    def register_tokens(self, submission_id, tokens, host, generation=None):
+        from runner.models import TestResult
+
+        TestResult.register_tokens(submission_id, tokens, host, generation)
+
+    def apply_cached_outputs(self, submission_id, outputs, generation=None):
+        from runner.models import TestResult
+
+        TestResult.apply_cached_outputs(submission_id, outputs, generation)
+
+    def extend_pending_leases(self, submission_id, test_ids, delay, generation=None):
+        from runner.models import TestResult
+
+        TestResult.extend_pending_leases(submission_id, test_ids, delay, generation)
+
+    def post_error(self, submission_id, test_id, message):
+        from runner.models import TestResult
 
-    print(f"Directory {path} zipped successfully")
+        TestResult.store_error(submission_id, test_id, message)
+
+    def dead_letter(self, submission_id, test_ids, generation, attempts, error):
+        from runner.models import DeadLetter
+
+        DeadLetter.record(submission_id, test_ids, generation, attempts, error)
+
+
+def get_runner_data():
+    """
+    Runners running inside the Django project can access the database directly
+    (RUNNER_DATA_ACCESS=database), others go through the REST API (RUNNER_DATA_ACCESS=rest)
+    """
+
+    if env("RUNNER_DATA_ACCESS", default="rest") == "database":
+        return DatabaseRunnerData()
+    return RestRunnerData()
 
 
 def process_source_single_file(file_content, prefix, suffix):
@@ -170,136 +597,476 @@ def process_source_single_file(file_content, prefix, suffix):
     return source_code
 
 
-def process_source_multifile(student_files, exercise_id, submission_id, test_id):
-    # student_files is the base64-encoded zip file containing the student's files
-    import base64
-    import tempfile
-    import zipfile
-    import os
+class SubmissionRejected(Exception):
+    """
+    The submission can't be run, the message is shown to the student as the test result
+    """
 
-    teacher_files_request = requests.get(
-        f"{get_base_api_url()}/exercise_teacher_files?exercise_id={exercise_id}",
-        headers={"Authorization": f"Api-Key {get_api_key()}"},
+
+def get_archive_limits():
+    return (
+        env.int("MULTIFILE_MAX_ENTRIES", default=500),
+        env.int("MULTIFILE_MAX_SIZE", default=20 * 1024 * 1024),
     )
 
-    # Handle 401 error
-    if teacher_files_request.status_code == status.HTTP_401_UNAUTHORIZED:
-        raise FileNotFoundError("Unauthorized access to the REST API")
 
-    # Handle 404 error
-    if teacher_files_request.status_code == status.HTTP_404_NOT_FOUND:
-        testresult_post_url = f"{get_base_runner_url()}/testresult/"
-        post_error_testresult(
-            "The files required to run tests are missing. Please contact your teacher.",
-            submission_id,
-            test_id,
-            testresult_post_url,
+def merge_zip_archives(teacher_files_data, student_files_data):
+    """
+    Merges the teacher's and the student's zip files in memory, without extracting them.
+    Files are put at the root of the final archive, student files override teacher files.
+
+    Raises SubmissionRejected if the merged archive has too many entries or is too large
+    once uncompressed (zip bombs), according to MULTIFILE_MAX_ENTRIES and MULTIFILE_MAX_SIZE.
+    """
+
+    max_entries, max_size = get_archive_limits()
+
+    teacher_zip = zipfile.ZipFile(io.BytesIO(teacher_files_data))
+    student_zip = zipfile.ZipFile(io.BytesIO(student_files_data))
+
+    # Later archives override earlier ones
+    entries = {}
+    for archive in (teacher_zip, student_zip):
+        for info in archive.infolist():
+            if not info.is_dir():
+                entries[os.path.basename(info.filename)] = (archive, info)
+
+    if len(entries) > max_entries:
+        raise SubmissionRejected(
+            f"The submitted archive contains too many files (maximum {max_entries})."
         )
-        raise FileNotFoundError("Teacher files not found")
 
-    teacher_files = teacher_files_request.content.decode().replace('"', "")
+    too_large = SubmissionRejected(
+        f"The submitted archive is too large once uncompressed (maximum {max_size // (1024 * 1024)} MB)."
+    )
 
-    student_files_data = base64.b64decode(student_files)
-    teacher_files_data = base64.b64decode(teacher_files)
+    if sum(info.file_size for _, info in entries.values()) > max_size:
+        raise too_large
 
-    student_files_zip = tempfile.NamedTemporaryFile(prefix="studentfiles-")
-    teacher_files_zip = tempfile.NamedTemporaryFile(prefix="teacherfiles-")
+    final = io.BytesIO()
+    total_size = 0
 
-    with open(student_files_zip.name, "wb") as f:
-        f.write(student_files_data)
+    with zipfile.ZipFile(
+        final, mode="w", compression=zipfile.ZIP_DEFLATED
+    ) as final_zip:
+        for name, (archive, info) in entries.items():
+            with archive.open(info) as source, final_zip.open(name, "w") as target:
+                # Declared sizes can't be trusted, count what is actually decompressed
+                while chunk := source.read(64 * 1024):
+                    total_size += len(chunk)
+                    if total_size > max_size:
+                        raise too_large
+                    target.write(chunk)
 
-    with open(teacher_files_zip.name, "wb") as f:
-        f.write(teacher_files_data)
+    return final.getvalue()
 
-    with tempfile.TemporaryDirectory(prefix="finaldir-") as tmp:
-        # Extract zips in temp folder
-        zipfile.ZipFile(teacher_files_zip).extractall(tmp)
-        zipfile.ZipFile(student_files_zip).extractall(tmp)
 
-        print("ls : " + str(os.listdir(tmp)))
+def process_source_multifile(student_files, teacher_files):
+    # student_files and teacher_files are the base64-encoded zip files
+    # containing the student's and the teacher's files
+    if teacher_files is None:
+        raise SubmissionRejected(
+            "The files required to run tests are missing. Please contact your teacher."
+        )
 
-        # Create final zip file
-        final = tempfile.NamedTemporaryFile(prefix="final-")
+    try:
+        final = merge_zip_archives(
+            base64.b64decode(teacher_files), base64.b64decode(student_files)
+        )
+    except zipfile.BadZipFile:
+        raise SubmissionRejected("The submitted file is not a valid zip archive.")
 
-        # Zip whole tmp directory
-        with zipfile.ZipFile(final.name, mode="w") as final_zip:
-            zip_directory(tmp, final_zip)
-            print("I am now done zipping. This is my content")
-            print(final_zip.namelist())
+    # Convert zip to b64
+    return base64.b64encode(final).decode()
 
-        # Convert zip to b64
-        final_b64 = base64.b64encode(final.read())
-        final_b64_str = final_b64.decode().replace('"', "")
 
-        final.close()
+DISPATCH_DONE_PREFIX = "arbitre:dispatch-done:"
 
-    student_files_zip.close()
-    teacher_files_zip.close()
 
-    return final_b64_str
+def is_dispatch_done(dispatch_id):
+    try:
+        return bool(get_redis().exists(DISPATCH_DONE_PREFIX + dispatch_id))
+    except Exception as e:
+        print(f"Couldn't check dispatch {dispatch_id}: {e}")
+        return False
 
 
-@shared_task(acks_late=True)
-def run_test(
-    hostname, exercise_type, submission_id, test_id, file_content, prefix, suffix, lang
-) -> None:
+def mark_dispatch_done(dispatch_id):
+    try:
+        get_redis().set(
+            DISPATCH_DONE_PREFIX + dispatch_id,
+            1,
+            ex=env.int("OUTBOX_RETENTION", default=24 * 3600),
+        )
+    except Exception as e:
+        print(f"Couldn't mark dispatch {dispatch_id} as done: {e}")
+
+
+def prepare_submission(
+    runner_data,
+    submission_id,
+    test_ids,
+    payload_key=None,
+    exercise_id=None,
+    bundle_version=None,
+    generation=None,
+):
     """
-    Runs one test on a submission, and stores the result in the database.
+    Prepares the Judge0 submissions of the given tests of a submission.
+
+    The submission's source is loaded once for all the tests, from the payload store
+    if a payload_key is given, and combined with the exercise bundle, cached by version.
+    Tests whose execution already ran are answered from the results cache.
+
+    Returns {"test_ids", "submissions", "execution_keys", "pool"} for the tests left to send
+    to Judge0 (on the hosts of `pool`), or None if there are none (or the submission was uploaded again since `generation`).
     """
 
-    # Arbitre API base URL
-    base_url = get_base_runner_url()
-    testresult_post_url = f"{base_url}/testresult/"
+    if generation is not None and is_stale_generation(submission_id, generation):
+        print(f"Submission {submission_id} was uploaded again, skipping")
+        return None
 
-    try:
-        # Get test data from REST API
-        test = get_test(base_url, test_id)
-
-        judge0_url = f"http://{hostname}/submissions"
-
-        if exercise_type == "single":
-            language_id = get_lang_id(lang)
-            source_code = process_source_single_file(file_content, prefix, suffix)
-            additional_files = ""
-        elif exercise_type == "multiple":
-            language_id = 89
-            source_code = ""
-            additional_files = process_source_multifile(
-                file_content, test["exercise"], submission_id, test_id
+    file_content = load_payload(payload_key) if payload_key else None
+
+    # The source is only loaded if it's not in the payload store anymore
+    if file_content is None or exercise_id is None:
+        payload = runner_data.get_submission_payload(
+            submission_id, with_file=file_content is None
+        )
+        if payload is None:
+            return None
+
+        if file_content is None:
+            file_content = payload["file_content"]
+        exercise_id = payload["exercise"]
+        bundle_version = payload["bundle_version"]
+
+    bundle = get_cached_exercise_bundle(runner_data, exercise_id, bundle_version)
+    if bundle is None:
+        return None
+
+    tests = [test for test in bundle["tests"] if test["id"] in test_ids]
+    if not tests:
+        return None
+
+    exercise_type = bundle["type"]
+
+    if exercise_type == "single":
+        language_id = get_lang_id(bundle["language"])
+        source_code = process_source_single_file(
+            file_content, bundle["prefix"], bundle["suffix"]
+        )
+        additional_files = ""
+    elif exercise_type == "multiple":
+        language_id = 89
+        source_code = ""
+        additional_files = process_source_multifile(
+            file_content, bundle["teacher_files"]
+        )
+    else:
+        raise SubmissionRejected(
+            "The type of this exercise is not supported. Please contact your teacher."
+        )
+
+    pool = get_pool(exercise_type, bundle["language"])
+    limits = get_pool_limits(pool)
+
+    # Identical executions that already ran are not sent to Judge0 again
+    cached_outputs = {}
+    if bundle.get("result_cache") and is_result_cache_enabled():
+        execution_keys = {
+            test["id"]: get_execution_key(
+                source_code,
+                file_content if exercise_type == "multiple" else None,
+                bundle.get("teacher_files_version"),
+                test["stdin"],
+                language_id,
+                pool,
+                limits,
+            )
+            for test in tests
+        }
+        cached_outputs = get_cached_results(execution_keys)
+    else:
+        execution_keys = {}
+
+    if cached_outputs:
+        runner_data.apply_cached_outputs(submission_id, cached_outputs, generation)
+        tests = [test for test in tests if test["id"] not in cached_outputs]
+        if not tests:
+            return None
+
+    # The upload may have been replaced while the source was prepared
+    if generation is not None and is_stale_generation(submission_id, generation):
+        print(f"Submission {submission_id} was uploaded again, skipping")
+        return None
+
+    # The source is prepared once, only stdin changes from one test to another
+    return {
+        "test_ids": [test["id"] for test in tests],
+        "submissions": [
+            build_judge0_submission(
+                source_code, additional_files, language_id, test["stdin"], limits
             )
+            for test in tests
+        ],
+        "execution_keys": execution_keys,
+        "pool": pool,
+    }
+
+
+def register_judge0_responses(
+    runner_data,
+    submission_id,
+    hostname,
+    reservations,
+    test_ids,
+    responses,
+    execution_keys,
+    tokens,
+    generation=None,
+):
+    """
+    Stores the tokens Judge0 returned for the tests of a submission (filling `tokens`),
+    and an error for the tests it rejected. Tokens for a former upload (`generation`) are dropped.
+
+    `responses` is {index of the test in `test_ids`: Judge0 response}, see `dispatch_tests_to_judge0` :
+    after an error, it only holds the tests sent before. The slots of the others are freed.
+    """
+
+    for i, response in sorted(responses.items()):
+        test_id = test_ids[i]
+        if "token" in response:
+            tokens[test_id] = response["token"]
+            if test_id in execution_keys:
+                remember_execution(response["token"], execution_keys[test_id])
         else:
-            raise Exception("Invalid exercise type")
+            print(f"Test {test_id} rejected by Judge0: {response}")
+            runner_data.post_error(
+                submission_id,
+                test_id,
+                "An error occured while running the test.",
+            )
 
-        response = send_test_to_judge0(
-            judge0_url, source_code, additional_files, language_id, test["stdin"]
-        )
+    # Callbacks free the slots of the accepted tests
+    commit_slots(hostname, reservations, list(tokens.values()))
+
+    if tokens:
+        runner_data.register_tokens(submission_id, tokens, hostname, generation)
+
+
+def get_unsent_test_ids(test_ids, responses):
+    return [test_id for i, test_id in enumerate(test_ids) if i not in responses]
+
+
+def get_retry_delay(attempt):
+    """
+    Exponential backoff (with jitter) before retrying a dispatch for the `attempt`-th time
+    """
+
+    delay = min(
+        env.float("DISPATCH_RETRY_DELAY", default=2.0) * 2**attempt,
+        env.float("DISPATCH_RETRY_MAX_DELAY", default=300.0),
+    )
+    return random.uniform(delay / 2, delay)
+
+
+def report_dispatch_error(
+    runner_data,
+    submission_id,
+    test_ids,
+    tokens,
+    dispatched,
+    error,
+    attempt=0,
+    generation=None,
+):
+    """
+    Handles an error while sending the tests of a submission to Judge0.
+
+    Errors of the submission itself, or of its exercise's configuration (SubmissionRejected),
+    are stored as error results : dispatching it again would fail the same way.
+    Transient errors (Judge0 or the REST API unreachable) are retried DISPATCH_MAX_RETRIES times,
+    then the tests are put in the dead letters, like after unexpected errors,
+    until they are replayed from the admin.
+
+    Returns the delay before retrying the dispatch, or None if it shouldn't be retried.
+    The pending leases of the tests are extended by that delay, not to be swept meanwhile.
+    """
+
+    if isinstance(error, FileNotFoundError):
+        return None
 
-        if "token" not in response:
-            raise requests.exceptions.ConnectionError
+    test_ids = [test_id for test_id in test_ids if test_id not in tokens]
 
-        token = response["token"]
-        post_testresult_with_token(submission_id, test_id, token, testresult_post_url)
+    if isinstance(error, SubmissionRejected):
+        for test_id in test_ids:
+            runner_data.post_error(submission_id, test_id, str(error))
+        return None
 
+    if isinstance(error, requests.exceptions.RequestException):
+        if dispatched:
+            # Results stay pending, they will be requeued
+            return None
+        if attempt < env.int("DISPATCH_MAX_RETRIES", default=5):
+            print(f"Couldn't dispatch submission {submission_id}, retrying: {error}")
+            delay = get_retry_delay(attempt)
+            try:
+                runner_data.extend_pending_leases(
+                    submission_id, test_ids, delay, generation
+                )
+            except Exception as e:
+                print(f"Couldn't extend the leases of submission {submission_id}: {e}")
+            return delay
+    else:
+        print("Exception: " + str(error))
+
+    print(f"Couldn't dispatch submission {submission_id}, dead-lettered: {error}")
+    runner_data.dead_letter(
+        submission_id, test_ids, generation, attempt + 1, repr(error)
+    )
+    return None
+
+
+def postpone_submission(countdown, *args, **kwargs):
+    """
+    Sends the `run_submission` task running again, on the same queue, in `countdown` seconds
+    """
+
+    run_submission.apply_async(
+        args,
+        kwargs,
+        countdown=countdown,
+        queue=(run_submission.request.delivery_info or {}).get("routing_key"),
+    )
+
+
+@shared_task(acks_late=True)
+def run_submission(
+    submission_id,
+    test_ids,
+    payload_key=None,
+    exercise_id=None,
+    bundle_version=None,
+    dispatch_id=None,
+    generation=None,
+    attempt=0,
+) -> None:
+    """
+    Runs the given tests on a submission, and stores the tokens of the results in the database.
+
+    The tests are prepared by `prepare_submission`, and sent to Judge0 with as few requests as possible.
+
+    `dispatch_id` is the idempotency key of the outbox entry : a dispatch published twice only runs once.
+    `generation` is the upload it was dispatched for : it's dropped if the student uploaded again.
+    `attempt` counts the retries after errors, see `report_dispatch_error`.
+    """
+
+    if dispatch_id and is_dispatch_done(dispatch_id):
+        print(f"Dispatch {dispatch_id} already ran, skipping")
         return
-    except requests.exceptions.ConnectionError:
-        post_error_testresult(
-            "No response from runner. Please contact the administrator.",
+
+    runner_data = get_runner_data()
+
+    tokens = {}
+    dispatched = False
+
+    try:
+        prepared = prepare_submission(
+            runner_data,
             submission_id,
-            test_id,
-            testresult_post_url,
+            test_ids,
+            payload_key,
+            exercise_id,
+            bundle_version,
+            generation,
         )
-        return
-    except FileNotFoundError as e:
-        return
+        if prepared is None:
+            return
+
+        test_ids = prepared["test_ids"]
+
+        # decide Judge0 host to use, according to the hosts' health, load and concurrency window
+        hostname, reservations = acquire_judge0_host(len(test_ids), prepared["pool"])
+        if hostname is None:
+            # Every host is saturated, try again later instead of piling work on Judge0
+            print(f"Judge0 hosts saturated, submission {submission_id} postponed")
+            delay = env.float("JUDGE0_SATURATED_RETRY_DELAY", default=2.0)
+            runner_data.extend_pending_leases(
+                submission_id, test_ids, delay, generation
+            )
+            postpone_submission(
+                delay,
+                submission_id,
+                test_ids,
+                payload_key,
+                exercise_id=exercise_id,
+                bundle_version=bundle_version,
+                dispatch_id=dispatch_id,
+                generation=generation,
+                attempt=attempt,
+            )
+            return
+
+        responses = {}
+        try:
+            dispatch_tests_to_judge0(
+                f"http://{hostname}/submissions", prepared["submissions"], responses
+            )
+        except Exception:
+            # The tests Judge0 accepted before the error run anyway, only the others are retried
+            sent_test_ids, test_ids = test_ids, get_unsent_test_ids(test_ids, responses)
+            register_judge0_responses(
+                runner_data,
+                submission_id,
+                hostname,
+                reservations,
+                sent_test_ids,
+                responses,
+                prepared["execution_keys"],
+                tokens,
+                generation,
+            )
+            raise
+        dispatched = True
+
+        register_judge0_responses(
+            runner_data,
+            submission_id,
+            hostname,
+            reservations,
+            test_ids,
+            responses,
+            prepared["execution_keys"],
+            tokens,
+            generation,
+        )
+
+        if dispatch_id:
+            mark_dispatch_done(dispatch_id)
     except Exception as e:
-        print("Exception: " + str(e))
-        post_error_testresult(
-            "An error occured while running the test.",
+        delay = report_dispatch_error(
+            runner_data,
             submission_id,
-            test_id,
-            testresult_post_url,
+            test_ids,
+            tokens,
+            dispatched,
+            e,
+            attempt,
+            generation,
         )
-        return
+        if delay is not None:
+            postpone_submission(
+                delay,
+                submission_id,
+                test_ids,
+                payload_key,
+                exercise_id=exercise_id,
+                bundle_version=bundle_version,
+                dispatch_id=dispatch_id,
+                generation=generation,
+                attempt=attempt + 1,
+            )
 
 
 @shared_task(ignore_result=True)
@@ -307,7 +1074,89 @@ def run_all_pending_testresults() -> None:
     from runner.models import TestResult
 
     """
-    Runs all pending submissions in the database
+    Runs all pending submissions in the database,
+    after fetching the results of the running ones whose callback was lost
     """
 
+    # Pending results are dispatched even if the running ones couldn't be reconciled
+    try:
+        reconcile_overdue_testresults()
+    except Exception as e:
+        print(f"Couldn't reconcile overdue test results: {e}")
+
     TestResult.run_all_pending_testresults()
+
+
+@shared_task(ignore_result=True)
+def refresh_dirty_submissions() -> None:
+    """
+    Refreshes the status and grade of the submissions updated during the last RECOMPUTE_WINDOW
+    """
+
+    from runner.models import Submission
+
+    Submission.refresh_dirty_submissions()
+
+
+@shared_task(ignore_result=True)
+def relay_dispatch_outbox() -> None:
+    """
+    Publishes the dispatch outbox entries missed by the relay (not running, or not notified)
+    """
+
+    from runner.models import DispatchOutbox
+
+    count = DispatchOutbox.relay()
+    if count:
+        print(f"Relayed {count} outbox entries")
+
+    DispatchOutbox.purge()
+
+
+def delete_judge0_submission(hostname, token):
+    """
+    Deletes a submission from a Judge0 host.
+    Judge0 only allows it with ENABLE_SUBMISSION_DELETE, and may refuse it while the submission runs.
+    """
+
+    headers = {}
+    if env("JUDGE0_AUTHZ_TOKEN", default=""):
+        headers["X-Auth-User"] = env("JUDGE0_AUTHZ_TOKEN")
+
+    response_object = http_client.delete(
+        f"http://{hostname}/submissions/{token}",
+        headers=headers,
+        timeout=env.float("JUDGE0_RESULTS_TIMEOUT", default=10.0),
+        circuit_breaker=True,
+    )
+
+    return response_object.status_code < 400
+
+
+@shared_task(ignore_result=True)
+def delete_judge0_submissions(tokens_by_host) -> None:
+    """
+    Deletes the executions of former uploads from Judge0, where it allows it
+    """
+
+    for hostname, tokens in tokens_by_host.items():
+        for token in tokens:
+            try:
+                if not delete_judge0_submission(hostname, token):
+                    print(f"Judge0 host {hostname} refused to delete {token}")
+            except requests.exceptions.RequestException as e:
+                print(f"Couldn't delete {token} from {hostname}: {e}")
+                break
+
+
+@shared_task(ignore_result=True)
+def probe_judge0_hosts() -> None:
+    """
+    Probes the health and load of the Judge0 hosts,
+    and sends the work of the hosts that are down to the other ones
+    """
+
+    from runner.models import TestResult
+
+    for hostname in probe_hosts():
+        TestResult.release_host(hostname)
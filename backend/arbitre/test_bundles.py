@@ -0,0 +1,81 @@
+from arbitre import bundles
+from arbitre.testing import ArbitreTestCase
+from runner.models import Test
+from unittest import mock
+
+
+class BundleVersionTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=2)
+
+    def assertVersionChanges(self, change):
+        version = self.exercise.refresh_bundle_version()
+        change()
+        self.exercise.refresh_from_db()
+        self.assertNotEqual(self.exercise.bundle_version, version)
+
+    def test_saving_unchanged_exercise_keeps_its_version(self):
+        version = self.exercise.bundle_version
+        self.exercise.save()
+        self.assertEqual(self.exercise.bundle_version, version)
+
+    def test_editing_the_exercise_changes_its_version(self):
+        def change():
+            self.exercise.prefix = "import sys"
+            self.exercise.save()
+
+        self.assertVersionChanges(change)
+
+    def test_editing_its_tests_changes_its_version(self):
+        def change():
+            test = Test.objects.first()
+            test.stdin = "42"
+            test.save()
+
+        self.assertVersionChanges(change)
+        self.assertVersionChanges(lambda: Test.objects.first().delete())
+
+    def test_changing_the_course_language_changes_its_version(self):
+        def change():
+            course = self.exercise.session.course
+            course.language = "c"
+            course.save()
+
+        self.assertVersionChanges(change)
+
+
+class BundleCacheTests(ArbitreTestCase):
+    def setUp(self):
+        self.cache = bundles.BundleCache(2)
+        patcher = mock.patch.object(bundles, "_bundle_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.runner_data = mock.Mock()
+        self.runner_data.get_exercise_bundle.side_effect = lambda exercise_id: {
+            "exercise": exercise_id,
+            "version": f"version-{exercise_id}",
+        }
+
+    def test_cached_versions_are_not_fetched_again(self):
+        bundle = bundles.get_cached_exercise_bundle(self.runner_data, 1, "version-1")
+        self.assertEqual(
+            bundles.get_cached_exercise_bundle(self.runner_data, 1, "version-1"),
+            bundle,
+        )
+        self.runner_data.get_exercise_bundle.assert_called_once_with(1)
+
+    def test_unknown_versions_are_fetched(self):
+        bundles.get_cached_exercise_bundle(self.runner_data, 1, "version-1")
+        bundles.get_cached_exercise_bundle(self.runner_data, 1, "version-2")
+        bundles.get_cached_exercise_bundle(self.runner_data, 1, None)
+
+        self.assertEqual(self.runner_data.get_exercise_bundle.call_count, 3)
+
+    def test_least_recently_used_bundles_are_evicted(self):
+        for exercise_id in [1, 2, 1, 3]:
+            bundles.get_cached_exercise_bundle(
+                self.runner_data, exercise_id, f"version-{exercise_id}"
+            )
+
+        self.assertEqual(list(self.cache.bundles), ["version-1", "version-3"])
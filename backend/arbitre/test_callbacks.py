@@ -0,0 +1,78 @@
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from django.core.management import call_command
+from runner.models import Test, TestResult
+from unittest import mock
+import base64
+
+
+class CallbackBufferTests(RedisTestMixin, ArbitreTestCase):
+    env = {"CALLBACK_BUFFER": "True"}
+
+    def get_output(self, token, stdout):
+        return {"token": token, "stdout": base64.b64encode(stdout).decode()}
+
+    def test_callbacks_are_drained_in_arrival_order(self):
+        from arbitre.callbacks import buffer_callback, drain_callbacks, get_backlog
+
+        for i in range(3):
+            self.assertTrue(buffer_callback(self.get_output(f"token-{i}", b"0")))
+
+        outputs = drain_callbacks(2)
+        self.assertEqual(
+            [output["token"] for output in outputs], ["token-0", "token-1"]
+        )
+        self.assertEqual(get_backlog(), 1)
+
+        self.assertEqual(drain_callbacks(2)[0]["token"], "token-2")
+        self.assertEqual(drain_callbacks(2, timeout=0.1), [])
+
+    def test_buffered_callbacks_are_ingested(self):
+        from arbitre.callbacks import buffer_callback, drain_callbacks
+
+        exercise = self.create_exercise(tests=2)
+        submission = self.create_submission(exercise)
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+        TestResult.register_tokens(
+            submission.id,
+            {test_id: f"token-{i}" for i, test_id in enumerate(test_ids)},
+        )
+
+        buffer_callback(self.get_output("token-0", b"0"))
+        buffer_callback(self.get_output("token-1", b"wrong"))
+
+        # Stops the consumer after its first batch
+        with mock.patch(
+            "runner.management.commands.ingest_callbacks.drain_callbacks",
+            side_effect=[drain_callbacks(200), KeyboardInterrupt],
+        ), self.assertRaises(KeyboardInterrupt):
+            call_command("ingest_callbacks")
+
+        self.assertEqual(
+            dict(TestResult.objects.values_list("token", "status")),
+            {
+                "token-0": TestResult.TestResultStatus.SUCCESS,
+                "token-1": TestResult.TestResultStatus.FAILED,
+            },
+        )
+
+    def test_consumer_backs_off_after_errors(self):
+        from redis.exceptions import ConnectionError
+
+        # Redis fails twice, answers, then fails again
+        drain_callbacks = mock.Mock(
+            side_effect=[
+                ConnectionError,
+                ConnectionError,
+                [],
+                ConnectionError,
+                KeyboardInterrupt,
+            ]
+        )
+
+        with mock.patch(
+            "runner.management.commands.ingest_callbacks.drain_callbacks",
+            drain_callbacks,
+        ), mock.patch("time.sleep") as sleep, self.assertRaises(KeyboardInterrupt):
+            call_command("ingest_callbacks", retry_delay=1, max_retry_delay=30)
+
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1, 2, 1])
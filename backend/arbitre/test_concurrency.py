@@ -0,0 +1,87 @@
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from unittest import mock
+
+
+class ConcurrencyWindowTests(RedisTestMixin, ArbitreTestCase):
+    env = {
+        "JUDGE0_CONCURRENCY_LIMIT": "True",
+        "JUDGE0_INITIAL_WINDOW": "4",
+        "JUDGE0_MIN_WINDOW": "1.5",
+        "JUDGE0_MAX_WINDOW": "4.2",
+        "JUDGE0_TARGET_LATENCY": "10",
+    }
+
+    host = "judge0:2358"
+
+    def get_window(self):
+        from arbitre.concurrency import WINDOW_PREFIX
+        from arbitre.redis_client import get_redis
+
+        return float(get_redis().hget(WINDOW_PREFIX + self.host, "window"))
+
+    def run_executions(self, count):
+        from arbitre.concurrency import acquire_slots, commit_slots
+
+        reservations = acquire_slots(self.host, count)
+        tokens = [f"token-{i}" for i in range(count)]
+        commit_slots(self.host, reservations, tokens)
+        return tokens
+
+    def test_reservations_are_limited_by_the_window(self):
+        from arbitre.concurrency import acquire_slots, release_slots
+
+        reservations = acquire_slots(self.host, 3)
+        self.assertIsNotNone(reservations)
+        self.assertIsNone(acquire_slots(self.host, 2))
+
+        release_slots(self.host, reservations)
+        self.assertIsNotNone(acquire_slots(self.host, 2))
+
+    def test_idle_host_accepts_any_reservation(self):
+        from arbitre.concurrency import acquire_slots
+
+        self.assertEqual(len(acquire_slots(self.host, 10)), 10)
+
+    def test_fast_executions_grow_the_window(self):
+        from arbitre.concurrency import record_completion
+
+        tokens = self.run_executions(2)
+
+        self.assertLess(record_completion(self.host, tokens[0]), 10)
+        # 4 + 1/4, capped by JUDGE0_MAX_WINDOW
+        self.assertEqual(self.get_window(), 4.2)
+
+    def test_errors_shrink_the_window_once_per_target_latency(self):
+        from arbitre.concurrency import record_completion
+
+        tokens = self.run_executions(3)
+
+        record_completion(self.host, tokens[0], error=True)
+        self.assertEqual(self.get_window(), 2)
+
+        record_completion(self.host, tokens[1], error=True)
+        self.assertEqual(self.get_window(), 2)
+
+    def test_untracked_executions_are_ignored(self):
+        from arbitre.concurrency import record_completion
+
+        self.assertIsNone(record_completion(self.host, "unknown"))
+
+    def test_hosts_with_an_open_circuit_are_skipped(self):
+        from arbitre.concurrency import acquire_judge0_host
+        from arbitre.http_client import CIRCUIT_PREFIX
+        from arbitre.redis_client import get_redis
+        import time
+
+        get_redis().hset(CIRCUIT_PREFIX + self.host, "opened_until", time.time() + 60)
+
+        with mock.patch.dict(
+            "os.environ", {"JUDGE0_HOSTNAMES": f"{self.host},judge0-b:2358"}
+        ):
+            for _ in range(3):
+                self.assertEqual(acquire_judge0_host(1)[0], "judge0-b:2358")
+
+            get_redis().hset(
+                CIRCUIT_PREFIX + "judge0-b:2358", "opened_until", time.time() + 60
+            )
+            self.assertEqual(acquire_judge0_host(1), (None, None))
@@ -0,0 +1,165 @@
+from arbitre.dispatcher import Dispatcher
+from arbitre.testing import (
+    ArbitreTestCase,
+    ArbitreTransactionTestCase,
+    RedisTestMixin,
+)
+from asgiref.sync import sync_to_async
+from django.db import connection
+from runner.models import DispatchOutbox, TestResult
+from unittest import mock
+import asyncio
+import httpx
+import requests
+
+
+class DispatcherTests(ArbitreTransactionTestCase):
+    env = {"DISPATCHER": "async"}
+
+    def test_dispatcher_starts_and_claims_new_entries(self):
+        exercise = self.create_exercise(tests=2)
+        dispatched = []
+
+        async def run_submission(self, submission_id, test_ids, *args, **kwargs):
+            dispatched.append((submission_id, sorted(test_ids)))
+
+        # On Postgres, the entry committed after the start must wake the dispatcher up
+        listening = connection.vendor == "postgresql"
+        dispatcher = Dispatcher(
+            concurrency=10, batch_size=10, poll_interval=30 if listening else 0.1
+        )
+
+        async def scenario():
+            running = asyncio.create_task(dispatcher.run())
+            try:
+                # Started, and nothing to dispatch yet
+                await asyncio.sleep(0.2)
+                self.assertFalse(running.done())
+                self.assertEqual(dispatcher.listen_connection is not None, listening)
+
+                submission = await sync_to_async(self.create_submission)(exercise)
+
+                for _ in range(50):
+                    if dispatched:
+                        break
+                    await asyncio.sleep(0.1)
+
+                return submission
+            finally:
+                running.cancel()
+                await asyncio.gather(running, return_exceptions=True)
+
+        with mock.patch.object(Dispatcher, "run_submission", run_submission):
+            submission = asyncio.run(scenario())
+
+        self.assertEqual(
+            dispatched,
+            [(submission.id, sorted(test.id for test in exercise.test_set.all()))],
+        )
+        self.assertFalse(DispatchOutbox.get_queued(submission).exists())
+        self.assertIsNone(dispatcher.listen_connection)
+
+
+class DispatchTestsTests(ArbitreTestCase):
+    env = {"JUDGE0_BATCH_SIZE": "2"}
+
+    def test_responses_of_accepted_chunks_are_kept_when_a_later_chunk_fails(self):
+        from arbitre import dispatcher
+
+        responses = {}
+
+        with mock.patch.object(
+            dispatcher,
+            "send_tests_batch",
+            side_effect=[
+                [{"token": "token-0"}, {"token": "token-1"}],
+                requests.exceptions.ConnectionError,
+            ],
+        ), self.assertRaises(requests.exceptions.ConnectionError):
+            asyncio.run(
+                dispatcher.dispatch_tests(None, "http://judge0", [{}] * 3, responses)
+            )
+
+        self.assertEqual(responses, {0: {"token": "token-0"}, 1: {"token": "token-1"}})
+
+
+class SaturatedHostsTests(ArbitreTransactionTestCase):
+    env = {"JUDGE0_SATURATED_RETRY_DELAY": "0.01"}
+
+    def test_leases_are_extended_while_waiting_for_a_host(self):
+        from arbitre import dispatcher as dispatcher_module
+
+        exercise = self.create_exercise(tests=2)
+        self.create_submission(exercise)
+        args, kwargs = DispatchOutbox.objects.get().get_task_arguments()
+
+        async def dispatch_tests(client, judge0_url, submissions, responses):
+            responses.update(
+                {i: {"token": f"token-{i}"} for i in range(len(submissions))}
+            )
+
+        dispatcher = Dispatcher(concurrency=1, batch_size=1, poll_interval=1)
+        extend_pending_leases = mock.Mock(
+            wraps=dispatcher.runner_data.extend_pending_leases
+        )
+
+        with mock.patch.object(
+            dispatcher_module,
+            "acquire_judge0_host",
+            side_effect=[(None, None), (None, None), ("judge0:2358", [])],
+        ), mock.patch.object(
+            dispatcher_module, "dispatch_tests", dispatch_tests
+        ), mock.patch.object(
+            dispatcher.runner_data, "extend_pending_leases", extend_pending_leases
+        ):
+            asyncio.run(dispatcher.run_submission(*args, **kwargs))
+
+        self.assertEqual(extend_pending_leases.call_count, 2)
+        self.assertEqual(
+            set(TestResult.objects.values_list("status", flat=True)),
+            {TestResult.TestResultStatus.RUNNING},
+        )
+
+
+class Judge0RequestsTests(RedisTestMixin, ArbitreTestCase):
+    env = {
+        "DISPATCHER_MAX_ATTEMPTS": "2",
+        "DISPATCHER_BACKOFF_BASE": "0",
+        "HTTP_CIRCUIT_FAILURES": "2",
+    }
+
+    def post(self, handler):
+        from arbitre.dispatcher import post_with_backoff
+
+        async def post():
+            async with httpx.AsyncClient(
+                transport=httpx.MockTransport(handler)
+            ) as client:
+                return await post_with_backoff(
+                    client, "http://judge0:2358/submissions", {}
+                )
+
+        return asyncio.run(post())
+
+    def test_latency_of_the_requests_is_recorded(self):
+        from arbitre.http_client import get_latency_histograms
+
+        self.post(lambda request: httpx.Response(201, json={"token": "token"}))
+
+        histogram = get_latency_histograms()["judge0:2358"]
+        self.assertEqual(histogram["count"], 1)
+        self.assertEqual(histogram["errors"], 0)
+
+    def test_failing_hosts_have_their_circuit_opened(self):
+        from arbitre.http_client import CircuitOpen, get_latency_histograms
+
+        handler = mock.Mock(return_value=httpx.Response(503))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.post(handler)
+        self.assertEqual(get_latency_histograms()["judge0:2358"]["errors"], 2)
+
+        # Not sent anymore until the cooldown ends
+        handler.reset_mock()
+        with self.assertRaises(CircuitOpen):
+            self.post(handler)
+        handler.assert_not_called()
@@ -0,0 +1,87 @@
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from unittest import mock
+import requests
+
+
+class HttpClientTests(RedisTestMixin, ArbitreTestCase):
+    env = {
+        "HTTP_MAX_RETRIES": "2",
+        "HTTP_BACKOFF_BASE": "0",
+        "HTTP_CIRCUIT_FAILURES": "2",
+        "HTTP_CIRCUIT_COOLDOWN": "30",
+    }
+
+    url = "http://judge0:2358/submissions"
+
+    def patch_request(self, *responses):
+        return mock.patch.object(
+            requests.Session, "request", autospec=True, side_effect=responses
+        )
+
+    def test_idempotent_requests_are_retried(self):
+        from arbitre import http_client
+
+        with self.patch_request(
+            requests.exceptions.ConnectionError,
+            mock.Mock(status_code=503),
+            mock.Mock(status_code=200),
+        ) as request:
+            response = http_client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 3)
+
+    def test_retries_are_limited(self):
+        from arbitre import http_client
+
+        with self.patch_request(
+            *[requests.exceptions.Timeout] * 3
+        ) as request, self.assertRaises(requests.exceptions.Timeout):
+            http_client.get(self.url)
+
+        self.assertEqual(request.call_count, 3)
+
+    def test_answered_and_non_idempotent_requests_are_not_retried(self):
+        from arbitre import http_client
+
+        with self.patch_request(mock.Mock(status_code=404)) as request:
+            self.assertEqual(http_client.get(self.url).status_code, 404)
+        self.assertEqual(request.call_count, 1)
+
+        with self.patch_request(
+            requests.exceptions.ConnectionError
+        ) as request, self.assertRaises(requests.exceptions.ConnectionError):
+            http_client.post(self.url)
+        self.assertEqual(request.call_count, 1)
+
+    def test_circuit_opens_after_failures_in_a_row(self):
+        from arbitre import http_client
+
+        with self.patch_request(*[mock.Mock(status_code=500)] * 2) as request:
+            http_client.post(self.url, circuit_breaker=True)
+            http_client.post(self.url, circuit_breaker=True)
+
+            with self.assertRaises(http_client.CircuitOpen):
+                http_client.post(self.url, circuit_breaker=True)
+
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(
+            http_client.get_open_circuits(["judge0:2358"]), ["judge0:2358"]
+        )
+
+    def test_trial_request_closes_or_opens_the_circuit_again(self):
+        from arbitre import http_client
+        from arbitre.redis_client import get_redis
+
+        key = http_client.CIRCUIT_PREFIX + "judge0:2358"
+
+        # The cooldown is over
+        get_redis().hset(key, mapping={"failures": 2, "opened_until": 0})
+        with self.patch_request(mock.Mock(status_code=500)):
+            http_client.post(self.url, circuit_breaker=True)
+        self.assertTrue(http_client.is_circuit_open("judge0:2358"))
+
+        get_redis().hset(key, "opened_until", 0)
+        with self.patch_request(mock.Mock(status_code=200)):
+            http_client.post(self.url, circuit_breaker=True)
+        self.assertFalse(get_redis().exists(key))
@@ -0,0 +1,143 @@
+from arbitre import judge0_hosts
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from runner.models import Test, TestResult
+from unittest import mock
+
+
+class HostProbeTests(RedisTestMixin, ArbitreTestCase):
+    env = {
+        "JUDGE0_HOSTNAMES": "judge0-a:2358,judge0-b:2358",
+        "JUDGE0_MAX_PROBE_FAILURES": "2",
+    }
+
+    load = {"queue": 0, "available": 2, "working": 0}
+
+    def hosts_down(self, *down):
+        return mock.patch.object(
+            judge0_hosts,
+            "probe_host",
+            side_effect=lambda hostname: None if hostname in down else self.load,
+        )
+
+    def probe(self, *down):
+        with self.hosts_down(*down):
+            return judge0_hosts.probe_hosts()
+
+    def test_failing_host_is_taken_out_of_rotation_once(self):
+        self.assertEqual(self.probe("judge0-b:2358"), [])
+        self.assertEqual(self.probe("judge0-b:2358"), ["judge0-b:2358"])
+        self.assertEqual(self.probe("judge0-b:2358"), [])
+
+        for _ in range(20):
+            self.assertEqual(judge0_hosts.choose_judge0_host(), "judge0-a:2358")
+
+        # Back in rotation as soon as a probe succeeds
+        self.probe()
+        self.assertTrue(judge0_hosts.get_hosts_state()["judge0-b:2358"]["healthy"])
+
+    def test_busy_hosts_get_less_work(self):
+        self.assertGreater(
+            judge0_hosts.get_host_weight(self.load),
+            judge0_hosts.get_host_weight({"queue": 10, "available": 2, "working": 2}),
+        )
+
+    def test_results_running_on_a_dead_host_go_back_to_pending(self):
+        from arbitre.tasks import probe_judge0_hosts
+
+        exercise = self.create_exercise(tests=2)
+        submission = self.create_submission(exercise)
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+        TestResult.register_tokens(
+            submission.id, {test_ids[0]: "token-0"}, "judge0-b:2358"
+        )
+        TestResult.register_tokens(
+            submission.id, {test_ids[1]: "token-1"}, "judge0-a:2358"
+        )
+
+        self.probe("judge0-b:2358")
+        with self.hosts_down("judge0-b:2358"):
+            probe_judge0_hosts()
+
+        self.assertEqual(
+            dict(TestResult.objects.values_list("token", "status")),
+            {
+                "token-0": TestResult.TestResultStatus.PENDING,
+                "token-1": TestResult.TestResultStatus.RUNNING,
+            },
+        )
+        self.assertEqual(submission.get_counters()["pending_count"], 1)
+
+
+class PoolRoutingTests(ArbitreTestCase):
+    env = {
+        "RUNNER_DATA_ACCESS": "database",
+        "JUDGE0_BATCH_DISPATCH": "False",
+        "JUDGE0_HOSTNAMES": "judge0:2358",
+        "JUDGE0_LIMITS": '{"cpu_time_limit": 2}',
+        "JUDGE0_POOLS": '{"large": {"hosts": ["judge0-large:2358"], "languages": ["java"],'
+        ' "types": ["multiple"], "limits": {"memory_limit": 512000}}}',
+    }
+
+    def test_exercises_are_routed_to_the_pool_of_their_language_or_type(self):
+        self.assertEqual(judge0_hosts.get_pool("single", "java"), "large")
+        self.assertEqual(judge0_hosts.get_pool("multiple", "python"), "large")
+        self.assertEqual(
+            judge0_hosts.get_pool("single", "python"), judge0_hosts.DEFAULT_POOL
+        )
+
+    def test_pools_have_their_hosts_limits_and_queues(self):
+        self.assertEqual(judge0_hosts.get_judge0_hosts("large"), ["judge0-large:2358"])
+        self.assertEqual(
+            judge0_hosts.get_judge0_hosts(judge0_hosts.DEFAULT_POOL), ["judge0:2358"]
+        )
+        self.assertEqual(
+            judge0_hosts.get_judge0_hosts(), ["judge0:2358", "judge0-large:2358"]
+        )
+
+        self.assertEqual(
+            judge0_hosts.get_pool_limits("large"), {"memory_limit": 512000}
+        )
+        self.assertEqual(
+            judge0_hosts.get_pool_limits(judge0_hosts.DEFAULT_POOL),
+            {"cpu_time_limit": 2},
+        )
+
+        self.assertEqual(
+            judge0_hosts.get_pool_queue("interactive", "large"), "interactive.large"
+        )
+        self.assertEqual(
+            judge0_hosts.get_pool_queue("interactive", judge0_hosts.DEFAULT_POOL),
+            "interactive",
+        )
+
+    def test_submissions_run_on_the_hosts_of_their_pool(self):
+        from arbitre import celery_app, tasks
+        from runner.models import DispatchOutbox
+
+        exercise = self.create_exercise(tests=2, language="java")
+        submission = self.create_submission(exercise, content=b"class Main {}")
+        entry = DispatchOutbox.objects.get(submission=submission)
+        self.assertEqual(entry.pool, "large")
+
+        with mock.patch.object(celery_app, "send_task") as send_task:
+            entry.publish_to_celery()
+        self.assertEqual(send_task.call_args.kwargs["queue"], "interactive.large")
+
+        args, kwargs = entry.get_task_arguments()
+        with mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0-large:2358", [])
+        ) as acquire_judge0_host, mock.patch.object(
+            tasks,
+            "send_submission_to_judge0",
+            side_effect=[{"token": "token-0"}, {"token": "token-1"}],
+        ) as send_submission_to_judge0:
+            tasks.run_submission(*args, **kwargs)
+
+        acquire_judge0_host.assert_called_once_with(2, "large")
+        for call in send_submission_to_judge0.call_args_list:
+            self.assertEqual(call.args[0], "http://judge0-large:2358/submissions")
+            self.assertEqual(call.args[1]["memory_limit"], 512000)
+        self.assertEqual(
+            set(TestResult.objects.values_list("host", flat=True)),
+            {"judge0-large:2358"},
+        )
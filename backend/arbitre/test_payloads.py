@@ -0,0 +1,71 @@
+from arbitre import payloads
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from unittest import mock
+import os
+import shutil
+import tempfile
+
+
+class PayloadStoreTestMixin:
+    def setUp(self):
+        super().setUp()
+
+        # The store is created again from the environment of the test, with an empty local cache
+        for name, value in [
+            ("_payload_store", None),
+            ("_local_cache", payloads.LocalPayloadCache(1024)),
+        ]:
+            patcher = mock.patch.object(payloads, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_payloads_are_loaded_back_by_their_key(self):
+        key = payloads.store_payload("print(input())")
+
+        self.assertEqual(key, payloads.get_payload_key("print(input())"))
+        self.assertEqual(payloads.store_payload("print(input())"), key)
+
+        # From the store itself, not from the local cache of this process
+        payloads._local_cache.payloads.clear()
+        self.assertEqual(payloads.load_payload(key), "print(input())")
+
+    def test_unknown_keys_are_not_loaded(self):
+        self.assertIsNone(payloads.load_payload(payloads.get_payload_key("unknown")))
+
+
+class FileSystemPayloadStoreTests(PayloadStoreTestMixin, ArbitreTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+        patcher = mock.patch.dict(
+            os.environ,
+            {
+                "PAYLOAD_STORE": "filesystem",
+                "PAYLOAD_STORE_DIR": self.directory,
+                "PAYLOAD_STORE_MAX_SIZE": "20",
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        super().setUp()
+
+    def test_tampered_payloads_are_not_loaded(self):
+        key = payloads.store_payload("print(1)")
+        with open(os.path.join(self.directory, key), "w") as f:
+            f.write("print(2)")
+
+        payloads._local_cache.payloads.clear()
+        self.assertIsNone(payloads.load_payload(key))
+
+    def test_least_recently_used_payloads_are_evicted(self):
+        first = payloads.store_payload("print(11111)")
+        os.utime(os.path.join(self.directory, first), (0, 0))
+        second = payloads.store_payload("print(22222)")
+
+        self.assertEqual(os.listdir(self.directory), [second])
+
+
+class RedisPayloadStoreTests(PayloadStoreTestMixin, RedisTestMixin, ArbitreTestCase):
+    env = {"PAYLOAD_STORE": "redis"}
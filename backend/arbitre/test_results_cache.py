@@ -0,0 +1,120 @@
+from arbitre import results_cache
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from runner.models import Test, TestResult
+from unittest import mock
+import base64
+
+
+class ResultsCacheTests(RedisTestMixin, ArbitreTestCase):
+    env = {
+        "RESULT_CACHE": "True",
+        "RUNNER_DATA_ACCESS": "database",
+        "JUDGE0_BATCH_DISPATCH": "False",
+    }
+
+    def get_output(self, stdout, status_id=3):
+        return {
+            "stdout": base64.b64encode(stdout.encode()).decode(),
+            "status": {"id": status_id},
+            "time": "0.01",
+            "memory": 1024,
+        }
+
+    def get_key(self, **execution):
+        return results_cache.get_execution_key(
+            **{
+                "source_code": "print(input())",
+                "student_files": None,
+                "teacher_files_version": None,
+                "stdin": "0",
+                "language_id": 71,
+                "pool": "default",
+                "limits": {},
+                **execution,
+            }
+        )
+
+    def test_executions_on_other_hosts_or_limits_have_other_keys(self):
+        self.assertEqual(self.get_key(), self.get_key())
+        self.assertNotEqual(self.get_key(), self.get_key(pool="large"))
+        self.assertNotEqual(self.get_key(), self.get_key(limits={"memory_limit": 1}))
+        self.assertNotEqual(self.get_key(), self.get_key(stdin="1"))
+
+    def test_only_deterministic_outputs_are_cached(self):
+        results_cache.remember_execution("token-0", "accepted")
+        results_cache.remember_execution("token-1", "time-limit")
+        results_cache.store_result("token-0", self.get_output("0"))
+        results_cache.store_result("token-1", self.get_output("", status_id=5))
+        results_cache.store_result("token-2", self.get_output("2"))
+
+        self.assertEqual(
+            list(
+                results_cache.get_cached_results(
+                    {"a": "accepted", "t": "time-limit"}
+                ).keys()
+            ),
+            ["a"],
+        )
+
+    def test_disabled_cache_is_not_read_or_written(self):
+        with mock.patch.dict(
+            "os.environ", {"RESULT_CACHE": "False"}
+        ), mock.patch.object(results_cache, "get_redis") as get_redis:
+            results_cache.store_result("token-0", self.get_output("0"))
+
+        get_redis.assert_not_called()
+
+    def test_identical_executions_are_answered_from_the_cache(self):
+        from arbitre import tasks
+
+        exercise = self.create_exercise(tests=2)
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+
+        with mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0:2358", [])
+        ), mock.patch.object(
+            tasks,
+            "send_submission_to_judge0",
+            side_effect=[{"token": "token-0"}, {"token": "token-1"}],
+        ) as send_submission_to_judge0:
+            first = self.create_submission(exercise, username="first")
+            tasks.run_submission(first.id, test_ids)
+            TestResult.store_judge0_outputs(
+                [
+                    {**self.get_output("0"), "token": "token-0"},
+                    {**self.get_output("wrong"), "token": "token-1"},
+                ]
+            )
+
+            second = self.create_submission(exercise, username="second")
+            tasks.run_submission(second.id, test_ids)
+
+        self.assertEqual(send_submission_to_judge0.call_count, 2)
+        self.assertEqual(
+            dict(
+                TestResult.objects.filter(submission=second).values_list(
+                    "exercise_test_id", "status"
+                )
+            ),
+            {
+                test_ids[0]: TestResult.TestResultStatus.SUCCESS,
+                test_ids[1]: TestResult.TestResultStatus.FAILED,
+            },
+        )
+
+    def test_exercises_can_disable_the_cache(self):
+        exercise = self.create_exercise(tests=1)
+        exercise.result_cache_enabled = False
+        exercise.save()
+
+        submission = self.create_submission(exercise)
+        TestResult.register_tokens(
+            submission.id, {Test.objects.get().id: "token-0"}, "judge0:2358"
+        )
+
+        with mock.patch.object(results_cache, "store_result") as store_result:
+            TestResult.store_judge0_outputs(
+                [{**self.get_output("0"), "token": "token-0"}]
+            )
+
+        store_result.assert_not_called()
@@ -0,0 +1,306 @@
+from api.models import Course
+from arbitre.testing import ArbitreTestCase
+from datetime import timedelta
+from django.utils import timezone
+from runner.models import DeadLetter, Test, TestResult
+from unittest import mock
+import io
+import requests
+import zipfile
+
+
+def make_zip(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+
+class DispatchErrorTests(ArbitreTestCase):
+    env = {"RUNNER_DATA_ACCESS": "database"}
+
+    def test_every_course_language_has_a_judge0_id(self):
+        from arbitre.tasks import get_lang_id
+
+        for language in Course.Languages.values:
+            with self.subTest(language=language):
+                self.assertIsInstance(get_lang_id(language), int)
+
+    def test_unsupported_language_is_stored_as_error_results(self):
+        from arbitre.tasks import run_submission
+
+        exercise = self.create_exercise(tests=2)
+        submission = self.create_submission(exercise)
+        course = Course.objects.get()
+        course.language = "scratch"
+        course.save()
+
+        run_submission(
+            submission.id,
+            list(Test.objects.values_list("id", flat=True)),
+            exercise_id=exercise.id,
+        )
+
+        self.assertFalse(DeadLetter.objects.exists())
+        self.assertEqual(
+            set(
+                TestResult.objects.filter(submission=submission).values_list(
+                    "status", flat=True
+                )
+            ),
+            {TestResult.TestResultStatus.ERROR},
+        )
+
+
+class BatchDispatchTests(ArbitreTestCase):
+    env = {"RUNNER_DATA_ACCESS": "database", "JUDGE0_BATCH_SIZE": "2"}
+
+    def test_tokens_of_accepted_chunks_are_kept_when_a_later_chunk_fails(self):
+        from arbitre import tasks
+
+        exercise = self.create_exercise(tests=3)
+        submission = self.create_submission(exercise)
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+
+        with mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0:2358", [])
+        ), mock.patch.object(
+            tasks,
+            "send_tests_to_judge0_batch",
+            side_effect=[
+                [{"token": "token-0"}, {"token": "token-1"}],
+                requests.exceptions.ConnectionError,
+            ],
+        ), mock.patch.object(
+            tasks, "postpone_submission"
+        ) as postpone_submission:
+            tasks.run_submission(submission.id, test_ids, exercise_id=exercise.id)
+
+        self.assertEqual(
+            dict(
+                TestResult.objects.filter(status=TestResult.TestResultStatus.RUNNING)
+                .order_by("exercise_test_id")
+                .values_list("exercise_test_id", "token")
+            ),
+            {test_ids[0]: "token-0", test_ids[1]: "token-1"},
+        )
+
+        # Only the test of the failed chunk is sent again
+        self.assertEqual(postpone_submission.call_args.args[2], [test_ids[2]])
+
+
+class RunSubmissionTests(ArbitreTestCase):
+    env = {"RUNNER_DATA_ACCESS": "database", "JUDGE0_BATCH_DISPATCH": "False"}
+
+    def test_source_is_loaded_once_for_all_tests(self):
+        from arbitre import tasks
+
+        exercise = self.create_exercise(tests=3)
+        submission = self.create_submission(exercise)
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+
+        get_submission_payload = mock.Mock(
+            wraps=tasks.DatabaseRunnerData().get_submission_payload
+        )
+
+        with mock.patch.object(
+            tasks.DatabaseRunnerData, "get_submission_payload", get_submission_payload
+        ), mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0:2358", [])
+        ), mock.patch.object(
+            tasks,
+            "send_submission_to_judge0",
+            side_effect=[{"token": f"token-{i}"} for i in range(3)],
+        ) as send_submission_to_judge0:
+            tasks.run_submission(submission.id, test_ids)
+
+        get_submission_payload.assert_called_once()
+        self.assertEqual(send_submission_to_judge0.call_count, 3)
+        self.assertEqual(
+            TestResult.objects.filter(
+                status=TestResult.TestResultStatus.RUNNING
+            ).count(),
+            3,
+        )
+
+
+class SaturatedHostsTests(ArbitreTestCase):
+    env = {"RUNNER_DATA_ACCESS": "database", "JUDGE0_SATURATED_RETRY_DELAY": "600"}
+
+    def test_postponed_tests_are_not_swept_meanwhile(self):
+        from arbitre import tasks
+
+        exercise = self.create_exercise(tests=2)
+        submission = self.create_submission(exercise)
+        test_ids = list(Test.objects.values_list("id", flat=True))
+
+        with mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=(None, None)
+        ), mock.patch.object(tasks, "postpone_submission") as postpone_submission:
+            tasks.run_submission(
+                submission.id, test_ids, generation=submission.generation
+            )
+
+        self.assertEqual(postpone_submission.call_args.args[0], 600)
+        for test_result in TestResult.objects.all():
+            self.assertEqual(test_result.status, TestResult.TestResultStatus.PENDING)
+            self.assertGreater(
+                test_result.lease_expires_at, timezone.now() + timedelta(seconds=590)
+            )
+
+
+class RetryTests(ArbitreTestCase):
+    env = {
+        "RUNNER_DATA_ACCESS": "database",
+        "JUDGE0_BATCH_DISPATCH": "False",
+        "DISPATCH_MAX_RETRIES": "2",
+        "DISPATCH_RETRY_DELAY": "600",
+        "DISPATCH_RETRY_MAX_DELAY": "3600",
+    }
+
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=2)
+        self.submission = self.create_submission(self.exercise)
+        self.test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+
+    def run_submission(self, attempt=0):
+        from arbitre import tasks
+
+        with mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0:2358", [])
+        ), mock.patch.object(tasks, "postpone_submission") as postpone_submission:
+            tasks.run_submission(
+                self.submission.id,
+                self.test_ids,
+                generation=self.submission.generation,
+                attempt=attempt,
+            )
+
+        return postpone_submission
+
+    def test_unavailable_judge0_is_retried_and_not_stored(self):
+
+        with mock.patch.object(
+            requests.Session,
+            "request",
+            return_value=mock.Mock(status_code=503, text="Service Unavailable"),
+        ):
+            postpone_submission = self.run_submission()
+
+        delay = postpone_submission.call_args.args[0]
+        self.assertGreaterEqual(delay, 300)
+        self.assertEqual(postpone_submission.call_args.kwargs["attempt"], 1)
+
+        # Still pending, and not swept before the retry
+        self.assertFalse(DeadLetter.objects.exists())
+        for test_result in TestResult.objects.all():
+            self.assertEqual(test_result.status, TestResult.TestResultStatus.PENDING)
+            self.assertGreater(
+                test_result.lease_expires_at,
+                timezone.now() + timedelta(seconds=delay - 10),
+            )
+
+    def test_exhausted_retries_are_dead_lettered_then_replayed(self):
+        from arbitre import tasks
+        from runner.models import DispatchOutbox, DispatchQueue
+
+        with mock.patch.object(
+            tasks,
+            "send_submission_to_judge0",
+            side_effect=requests.exceptions.ConnectionError,
+        ):
+            postpone_submission = self.run_submission(attempt=2)
+
+        postpone_submission.assert_not_called()
+        dead_letter = DeadLetter.objects.get()
+        self.assertEqual(sorted(dead_letter.test_ids), self.test_ids)
+        self.assertEqual(dead_letter.attempts, 3)
+
+        DispatchOutbox.objects.update(dispatched_at=timezone.now())
+        self.assertEqual(DeadLetter.replay(DeadLetter.objects.all()), 1)
+
+        dead_letter.refresh_from_db()
+        self.assertIsNotNone(dead_letter.resolved_at)
+        entry = DispatchOutbox.get_queued(self.submission).get()
+        self.assertEqual(entry.queue, DispatchQueue.RECOVERY)
+        self.assertEqual(sorted(entry.test_ids), self.test_ids)
+
+
+class DatabaseRunnerDataTests(ArbitreTestCase):
+    env = {"RUNNER_DATA_ACCESS": "database", "JUDGE0_BATCH_DISPATCH": "False"}
+
+    def test_runner_data_access_is_configurable(self):
+        from arbitre import tasks
+
+        self.assertIsInstance(tasks.get_runner_data(), tasks.DatabaseRunnerData)
+
+        with mock.patch.dict("os.environ", {"RUNNER_DATA_ACCESS": "rest"}):
+            self.assertIsInstance(tasks.get_runner_data(), tasks.RestRunnerData)
+
+    def test_submissions_run_without_calling_the_rest_api(self):
+        from arbitre import http_client, tasks
+
+        exercise = self.create_exercise(tests=2)
+        submission = self.create_submission(exercise)
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+
+        # Only Judge0 is called
+        with mock.patch.object(
+            http_client, "request", side_effect=AssertionError("REST API called")
+        ), mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0:2358", [])
+        ), mock.patch.object(
+            tasks,
+            "send_submission_to_judge0",
+            side_effect=[{"token": "token-0"}, {"bad": "request"}],
+        ):
+            tasks.run_submission(submission.id, test_ids)
+
+        self.assertEqual(
+            dict(TestResult.objects.values_list("exercise_test_id", "status")),
+            {
+                test_ids[0]: TestResult.TestResultStatus.RUNNING,
+                test_ids[1]: TestResult.TestResultStatus.ERROR,
+            },
+        )
+        self.assertFalse(DeadLetter.objects.exists())
+
+
+class ArchiveTests(ArbitreTestCase):
+    env = {"MULTIFILE_MAX_ENTRIES": "3", "MULTIFILE_MAX_SIZE": "1024"}
+
+    def test_student_files_override_teacher_files(self):
+        from arbitre.tasks import merge_zip_archives
+
+        merged = merge_zip_archives(
+            make_zip({"main.py": "teacher", "tests/test.py": "tests"}),
+            make_zip({"src/main.py": "student"}),
+        )
+
+        with zipfile.ZipFile(io.BytesIO(merged)) as archive:
+            files = {name: archive.read(name) for name in archive.namelist()}
+
+        self.assertEqual(files, {"main.py": b"student", "test.py": b"tests"})
+
+    def test_too_many_entries_are_rejected(self):
+        from arbitre.tasks import SubmissionRejected, merge_zip_archives
+
+        with self.assertRaisesMessage(SubmissionRejected, "too many files"):
+            merge_zip_archives(
+                make_zip({"a.py": "", "b.py": ""}), make_zip({"c.py": "", "d.py": ""})
+            )
+
+    def test_overriden_entries_are_not_counted(self):
+        from arbitre.tasks import merge_zip_archives
+
+        merge_zip_archives(
+            make_zip({"a.py": "", "b.py": ""}), make_zip({"a.py": "", "c.py": ""})
+        )
+
+    def test_too_large_archives_are_rejected(self):
+        from arbitre.tasks import SubmissionRejected, merge_zip_archives
+
+        # 2 KB of zeros, a few bytes once compressed
+        with self.assertRaisesMessage(SubmissionRejected, "too large"):
+            merge_zip_archives(make_zip({"a.py": ""}), make_zip({"b.txt": "0" * 2048}))
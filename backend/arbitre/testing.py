@@ -0,0 +1,146 @@
+"""
+Helpers shared by the test suites of the runners and the models they drive.
+
+The tests run against the test database, with an in-memory channel layer.
+Those touching the shared coordination state need a Redis server : they use TEST_REDIS_URL
+(default redis://localhost:6379/15, flushed before each test) and are skipped if it's unreachable.
+"""
+
+from django.core.files.base import ContentFile
+from django.test import TestCase, TransactionTestCase, override_settings
+from unittest import mock
+import environ
+import os
+import shutil
+import tempfile
+
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+# Refreshes happen at once, sources are not sent to the payload store
+TEST_ENV = {
+    "RECOMPUTE_WINDOW": "0",
+    "PAYLOAD_STORE": "none",
+    "CALLBACK_BUFFER": "False",
+    "RESULT_CACHE": "False",
+    "JUDGE0_CONCURRENCY_LIMIT": "False",
+}
+
+
+class ArbitreTestMixin:
+    """
+    Runs the tests with the runners' environment of TEST_ENV, an in-memory channel layer,
+    and uploads in a temporary MEDIA_ROOT
+    """
+
+    env = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            CHANNEL_LAYERS={
+                "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+            },
+        )
+        cls.media_settings.enable()
+
+        cls.environ = mock.patch.dict(os.environ, {**TEST_ENV, **cls.env})
+        cls.environ.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+        super().tearDownClass()
+
+    def create_exercise(self, tests=3, type="single", grade=20, language="python"):
+        from api.models import Course, Exercise, Session
+        from runner.models import Test
+
+        course = Course.objects.create(title="Course", language=language)
+        session = Session.objects.create(course=course, title="Session")
+        exercise = Exercise.objects.create(
+            session=session, title="Exercise", grade=grade, type=type
+        )
+        for i in range(tests):
+            Test.objects.create(
+                exercise=exercise, name=f"Test {i}", stdin=str(i), stdout=str(i)
+            )
+
+        return exercise
+
+    def create_submission(
+        self, exercise, username="student", content=b"print(input())"
+    ):
+        from django.contrib.auth.models import User
+        from runner.models import Submission
+
+        owner, _ = User.objects.get_or_create(username=username)
+        submission = Submission(exercise=exercise, owner=owner)
+        submission.file.save("main.py", ContentFile(content), save=False)
+        submission.save()
+
+        return submission
+
+
+class ArbitreTestCase(ArbitreTestMixin, TestCase):
+    pass
+
+
+class ArbitreTransactionTestCase(ArbitreTestMixin, TransactionTestCase):
+    """
+    For the tests whose code runs in other threads, which only see committed data
+    """
+
+
+class RedisTestMixin:
+    """
+    Runs the tests against TEST_REDIS_URL, flushed before each test.
+    Skipped if no Redis server answers.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import redis
+        import unittest
+
+        from arbitre import redis_client
+
+        url = env("TEST_REDIS_URL", default="redis://localhost:6379/15")
+        try:
+            redis.Redis.from_url(url, socket_connect_timeout=1).ping()
+        except redis.exceptions.RedisError:
+            raise unittest.SkipTest(f"Redis is not reachable at {url}")
+
+        super().setUpClass()
+
+        cls.redis_url = mock.patch.dict(os.environ, {"REDIS_URL": url})
+        cls.redis_url.start()
+
+        # The connection of the process is opened again on the test database
+        cls.former_redis = redis_client._redis
+        redis_client._redis = None
+
+    @classmethod
+    def tearDownClass(cls):
+        from arbitre import redis_client
+
+        redis_client._redis = cls.former_redis
+        cls.redis_url.stop()
+
+        super().tearDownClass()
+
+    def setUp(self):
+        from arbitre.redis_client import get_redis
+
+        super().setUp()
+        get_redis().flushdb()
@@ -1,4 +1,4 @@
-from .models import Submission, Test, TestResult
+from .models import DeadLetter, Submission, Test, TestResult
 from api.models import Exercise, Session, Course, StudentGroup
 from django.contrib import admin
 
@@ -33,6 +33,7 @@ class ExerciseAdmin(admin.ModelAdmin):
         "type",
         "grade",
         "teacher_files",
+        "result_cache_enabled",
     ]
     list_display = ["title", "session", "type", "grade"]
     list_filter = ["session", "type"]
@@ -77,14 +78,42 @@ class CourseAdmin(admin.ModelAdmin):
 
 
 class TestResultAdmin(admin.ModelAdmin):
-    fields = ["status", "id", "submission", "exercise_test", "stdout", "token"]
-    readonly_fields = ["id", "submission", "exercise_test", "stdout", "token"]
-    list_display = ["id", "submission", "status", "exercise_test", "stdout"]
-    list_filter = ["status"]
+    fields = ["status", "id", "submission", "exercise_test", "stdout", "token", "queue"]
+    readonly_fields = ["id", "submission", "exercise_test", "stdout", "token", "queue"]
+    list_display = ["id", "submission", "status", "exercise_test", "stdout", "queue"]
+    list_filter = ["status", "queue"]
+
+    def delete_queryset(self, request, queryset):
+        submission_ids = set(queryset.values_list("submission_id", flat=True))
+        super().delete_queryset(request, queryset)
+        Submission.recount(pk__in=submission_ids)
+
+
+class DeadLetterAdmin(admin.ModelAdmin):
+    fields = [
+        "id",
+        "submission",
+        "test_ids",
+        "generation",
+        "attempts",
+        "error",
+        "created",
+        "resolved_at",
+    ]
+    readonly_fields = fields
+    list_display = ["id", "submission", "attempts", "error", "created", "resolved_at"]
+    list_filter = [("resolved_at", admin.EmptyFieldListFilter), "created"]
+    actions = ["replay"]
+
+    @admin.action(description="Replay the selected dead letters")
+    def replay(self, request, queryset):
+        count = DeadLetter.replay(queryset)
+        self.message_user(request, f"{count} dead letters replayed")
 
 
 admin.site.register(Submission, SubmissionAdmin)
 admin.site.register(TestResult, TestResultAdmin)
+admin.site.register(DeadLetter, DeadLetterAdmin)
 
 admin.site.register(Exercise, ExerciseAdmin)
 admin.site.register(Session)
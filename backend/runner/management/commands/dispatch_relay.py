@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from runner.models import DispatchOutbox
+import select
+import time
+
+"""
+Publishes the submission dispatch outbox to the runners, as soon as entries are committed.
+
+> python manage.py dispatch_relay [--batch-size 100] [--poll-interval 5]
+
+With Postgres, the relay sleeps until it's notified of new entries (LISTEN/NOTIFY).
+Other databases are polled every `poll-interval` seconds.
+"""
+
+
+class Command(BaseCommand):
+    help = "Publishes the submission dispatch outbox to the runners"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--poll-interval", type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        if DispatchOutbox.is_consumed_by_dispatcher():
+            self.stdout.write(
+                "The outbox is consumed by the asynchronous dispatcher (DISPATCHER=async)"
+            )
+            return
+
+        batch_size = options["batch_size"]
+        poll_interval = options["poll_interval"]
+
+        listening = connection.vendor == "postgresql"
+        if listening:
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {DispatchOutbox.NOTIFY_CHANNEL}")
+
+        self.stdout.write("Dispatch relay started")
+
+        while True:
+            # Entries committed while the relay was not listening are published as well
+            count = DispatchOutbox.relay(batch_size)
+            if count:
+                self.stdout.write(f"Relayed {count} outbox entries")
+
+            if not listening:
+                time.sleep(poll_interval)
+                continue
+
+            # Wait for a notification, or the poll interval as a safety net
+            pg_connection = connection.connection
+            if select.select([pg_connection], [], [], poll_interval) != ([], [], []):
+                pg_connection.poll()
+                pg_connection.notifies.clear()
@@ -0,0 +1,52 @@
+from arbitre.callbacks import drain_callbacks
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from runner.models import TestResult
+import time
+
+"""
+Applies the buffered Judge0 callbacks in micro-batches.
+
+> python manage.py ingest_callbacks [--batch-size 200] [--retry-delay 1] [--max-retry-delay 30]
+
+Several consumers can run at once, each callback is popped by only one of them.
+After errors (Redis or the database unreachable), consumers wait `retry-delay` seconds,
+doubled after each error in a row, up to `max-retry-delay` seconds.
+"""
+
+
+class Command(BaseCommand):
+    help = "Applies the buffered Judge0 callbacks in micro-batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument("--retry-delay", type=float, default=1.0)
+        parser.add_argument("--max-retry-delay", type=float, default=30.0)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        errors = 0
+
+        self.stdout.write("Callback ingestion started")
+
+        while True:
+            try:
+                outputs = drain_callbacks(batch_size)
+                errors = 0
+                if not outputs:
+                    continue
+
+                close_old_connections()
+                count = TestResult.store_judge0_outputs(outputs)
+                self.stdout.write(f"Applied {count} callbacks")
+            except Exception as e:
+                # The results of a lost batch are fetched from Judge0 once their lease expires
+                self.stderr.write(f"Couldn't apply callbacks: {e}")
+
+                time.sleep(
+                    min(
+                        options["retry_delay"] * 2**errors,
+                        options["max_retry_delay"],
+                    )
+                )
+                errors += 1
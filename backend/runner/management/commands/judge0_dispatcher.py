@@ -0,0 +1,33 @@
+from arbitre.dispatcher import Dispatcher
+from django.core.management.base import BaseCommand
+import asyncio
+
+"""
+Sends the submissions of the dispatch outbox to Judge0 asynchronously, instead of Celery runners.
+Requires DISPATCHER=async, so that the outbox is not published to Celery as well.
+
+> python manage.py judge0_dispatcher [--concurrency 1000] [--batch-size 100] [--poll-interval 5]
+"""
+
+
+class Command(BaseCommand):
+    help = "Sends the submissions of the dispatch outbox to Judge0 asynchronously"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=1000)
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--poll-interval", type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        from runner.models import DispatchOutbox
+
+        if not DispatchOutbox.is_consumed_by_dispatcher():
+            self.stderr.write(
+                "Set DISPATCHER=async, the outbox is published to Celery otherwise"
+            )
+            return
+
+        dispatcher = Dispatcher(
+            options["concurrency"], options["batch_size"], options["poll_interval"]
+        )
+        asyncio.run(dispatcher.run())
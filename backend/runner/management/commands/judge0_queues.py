@@ -0,0 +1,38 @@
+from arbitre.judge0_hosts import (
+    DEFAULT_POOL,
+    LEGACY_QUEUE,
+    get_judge0_pools,
+    get_pool_queue,
+    is_legacy_queue_consumed,
+)
+from django.core.management.base import BaseCommand
+
+"""
+Prints the Celery queues of a dispatch queue for every pool of Judge0 hosts,
+to start the workers consuming them (see run.sh).
+The recovery workers also drain the legacy queue, unless LEGACY_QUEUE=False.
+
+> python manage.py judge0_queues interactive [--pool large]
+interactive,interactive.large
+"""
+
+
+class Command(BaseCommand):
+    help = "Prints the Celery queues of a dispatch queue for the pools of Judge0 hosts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue", choices=["interactive", "recovery", "bulk"])
+        parser.add_argument("--pool", action="append")
+
+    def handle(self, *args, **options):
+        pools = options["pool"] or [DEFAULT_POOL, *get_judge0_pools().keys()]
+        queues = [get_pool_queue(options["queue"], pool) for pool in pools]
+
+        if (
+            options["queue"] == "recovery"
+            and not options["pool"]
+            and is_legacy_queue_consumed()
+        ):
+            queues.append(LEGACY_QUEUE)
+
+        self.stdout.write(",".join(queues))
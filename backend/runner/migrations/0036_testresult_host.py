@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0035_remove_uuid_null"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="testresult",
+            name="host",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+    ]
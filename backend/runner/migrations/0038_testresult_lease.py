@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0037_dispatchoutbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="testresult",
+            name="lease_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="testresult",
+            index=models.Index(
+                fields=["status", "id"], name="runner_testresult_status_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0038_testresult_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dispatchoutbox",
+            name="queue",
+            field=models.CharField(
+                choices=[
+                    ("interactive", "Interactive"),
+                    ("recovery", "Recovery"),
+                    ("bulk", "Bulk"),
+                ],
+                default="interactive",
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="testresult",
+            name="queue",
+            field=models.CharField(
+                choices=[
+                    ("interactive", "Interactive"),
+                    ("recovery", "Recovery"),
+                    ("bulk", "Bulk"),
+                ],
+                default="interactive",
+                max_length=20,
+            ),
+        ),
+    ]
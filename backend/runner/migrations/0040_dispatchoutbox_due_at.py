@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0039_dispatch_queues"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="dispatchoutbox",
+            name="runner_outbox_pending_idx",
+        ),
+        migrations.AddField(
+            model_name="dispatchoutbox",
+            name="due_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="dispatchoutbox",
+            index=models.Index(
+                condition=models.Q(("dispatched_at__isnull", True)),
+                fields=["due_at", "id"],
+                name="runner_outbox_due_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0040_dispatchoutbox_due_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dispatchoutbox",
+            name="generation",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="generation",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0042_deadletter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dispatchoutbox",
+            name="pool",
+            field=models.CharField(default="default", max_length=64),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:46
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_results(apps, schema_editor):
+    Submission = apps.get_model("runner", "Submission")
+    TestResult = apps.get_model("runner", "TestResult")
+
+    def aggregate(expression, **result_filters):
+        return Coalesce(
+            models.Subquery(
+                TestResult.objects.filter(
+                    submission=models.OuterRef("pk"), **result_filters
+                )
+                .order_by()
+                .values("submission")
+                .annotate(value=expression)
+                .values("value")
+            ),
+            0,
+        )
+
+    Submission.objects.update(
+        **{
+            f"{status}_count": aggregate(models.Count("id"), status=status)
+            for status in ["pending", "running", "success", "failed", "error"]
+        },
+        coefficient_sum=aggregate(models.Sum("exercise_test__coefficient")),
+        success_coefficient_sum=aggregate(
+            models.Sum("exercise_test__coefficient"), status="success"
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0043_dispatchoutbox_pool"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="submission",
+            name="coefficient_sum",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="error_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="failed_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="pending_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="running_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="success_coefficient_sum",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="success_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_results, reverse_code=migrations.RunPython.noop),
+    ]
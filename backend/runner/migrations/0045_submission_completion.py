@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+def mark_completed(apps, schema_editor):
+    # Submissions already done must not fire their completion on their next refresh
+    Submission = apps.get_model("runner", "Submission")
+    Submission.objects.filter(pending_count=0, running_count=0).update(
+        completed_generation=models.F("generation")
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0044_submission_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="submission",
+            name="completed_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="submission",
+            name="completed_generation",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(mark_completed, reverse_code=migrations.RunPython.noop),
+    ]
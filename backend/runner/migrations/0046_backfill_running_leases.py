@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:12
+
+from datetime import timedelta
+from django.db import migrations
+from django.utils import timezone
+
+
+def lease_running_results(apps, schema_editor):
+    # Results running before leases existed are reconciled with Judge0 once it expires,
+    # instead of being dispatched again
+    TestResult = apps.get_model("runner", "TestResult")
+    TestResult.objects.filter(status="running", lease_expires_at__isnull=True).update(
+        lease_expires_at=timezone.now() + timedelta(seconds=120)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0045_submission_completion"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            lease_running_results, reverse_code=migrations.RunPython.noop
+        ),
+    ]
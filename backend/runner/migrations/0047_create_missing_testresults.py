@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:05
+
+from django.db import migrations
+
+
+def create_missing_testresults(apps, schema_editor):
+    # Submissions uploaded before the deployment may only be waiting for a `run_test` message
+    # of the former runners, which are dropped : their results are created pending,
+    # so that the sweep dispatches them
+    Submission = apps.get_model("runner", "Submission")
+    Test = apps.get_model("runner", "Test")
+    TestResult = apps.get_model("runner", "TestResult")
+
+    submissions = Submission.objects.filter(
+        ignore=False, testresult__isnull=True
+    ).select_related("exercise")
+
+    for submission in submissions.iterator():
+        tests = list(Test.objects.filter(exercise=submission.exercise))
+        if not tests:
+            continue
+
+        TestResult.objects.bulk_create(
+            [TestResult(submission=submission, exercise_test=test) for test in tests],
+            ignore_conflicts=True,
+        )
+        Submission.objects.filter(pk=submission.pk).update(
+            status="pending",
+            pending_count=len(tests),
+            coefficient_sum=sum(test.coefficient or 0 for test in tests),
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("runner", "0046_backfill_running_leases"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            create_missing_testresults, reverse_code=migrations.RunPython.noop
+        ),
+    ]
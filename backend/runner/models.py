@@ -1,20 +1,36 @@
 from api.models import Exercise
 from asgiref.sync import async_to_sync
-from celery import Celery
 from channels.layers import get_channel_layer
 from datetime import timedelta
 from decimal import Decimal
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import Sum, Case, When, F
+from django.db import connection, models, transaction
+from django.db.models import Sum, Case, When, F, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from typing_extensions import Optional
+import base64
 import environ
 import os
-import random
 import uuid
 
+# Reading .env file
+env = environ.Env()
+environ.Env.read_env(
+    env_file=os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
+)
+
+
+class DispatchQueue(models.TextChoices):
+    """
+    Celery queues the tests are dispatched to, by decreasing priority
+    """
+
+    INTERACTIVE = "interactive", _("Interactive")  # Live submissions
+    RECOVERY = "recovery", _("Recovery")  # Lost dispatches and callbacks
+    BULK = "bulk", _("Bulk")  # Requeues and regrades
+
 
 class Submission(models.Model):
     """
@@ -61,37 +77,196 @@ class Submission(models.Model):
     )
     created = models.DateTimeField(auto_now=True)
     ignore = models.BooleanField(default=False, blank=True)
+    generation = models.PositiveIntegerField(
+        default=0, editable=False
+    )  # Incremented on each upload, runners drop the work of former generations
     grade = models.FloatField(blank=True, null=True)
+    completed_generation = models.PositiveIntegerField(
+        default=0, editable=False
+    )  # Last generation whose results were all done, see `complete`
+    completed_at = models.DateTimeField(blank=True, null=True, editable=False)
+
+    # Test results by status, and sum of their coefficients (all, and successful ones).
+    # Kept up to date as results change (see `update_counters`), the status and grade derive from them
+    pending_count = models.IntegerField(default=0, editable=False)
+    running_count = models.IntegerField(default=0, editable=False)
+    success_count = models.IntegerField(default=0, editable=False)
+    failed_count = models.IntegerField(default=0, editable=False)
+    error_count = models.IntegerField(default=0, editable=False)
+    coefficient_sum = models.IntegerField(default=0, editable=False)
+    success_coefficient_sum = models.IntegerField(default=0, editable=False)
+
+    COUNTERS = [
+        "pending_count",
+        "running_count",
+        "success_count",
+        "failed_count",
+        "error_count",
+        "coefficient_sum",
+        "success_coefficient_sum",
+    ]
 
     def __str__(self):
         return self.file.name
 
+    def read_file_content(self):
+        """
+        Read the submitted file, as it is sent to the runners :
+        plain text for single-file exercises, base64-encoded zip for multiple-file ones
+        """
+
+        with self.file.open(mode="rb") as f:
+            if self.exercise.type == "single":
+                return f.read().decode("utf-8", "ignore")
+            elif self.exercise.type == "multiple":
+                import base64
+
+                return base64.b64encode(f.read()).decode("utf-8", "ignore")
+
+        raise Exception("Invalid exercise type")
+
+    def get_runner_payload(self, with_file=True):
+        """
+        What a runner needs to run the tests of this submission, besides the exercise bundle :
+        its source (unless with_file is False), and its exercise's bundle version
+        """
+
+        exercise = self.exercise
+
+        return {
+            "submission": self.id,
+            "exercise": exercise.id,
+            "bundle_version": exercise.bundle_version,
+            "file_content": self.read_file_content() if with_file else None,
+        }
+
+    def store_payload(self):
+        """
+        Put the submitted file in the payload store, so that runner tasks only carry its key.
+        Returns None if it couldn't be stored, the runners then load it from the REST API.
+        """
+
+        from arbitre.payloads import store_payload
+
+        try:
+            return store_payload(self.read_file_content())
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def get_status_counter(status):
+        return f"{status}_count"
+
+    @classmethod
+    def update_counters(cls, transitions):
+        """
+        Updates the counters of submissions for results changing status, atomically (F expressions).
+
+        `transitions` is a list of (submission_id, former status, new status, coefficient),
+        the former status being None for new results
+        """
+
+        deltas = {}
+        for submission_id, former_status, status, coefficient in transitions:
+            if former_status == status:
+                continue
+
+            coefficient = coefficient or 0
+            submission_deltas = deltas.setdefault(submission_id, {})
+
+            def add(counter, value):
+                submission_deltas[counter] = submission_deltas.get(counter, 0) + value
+
+            if former_status is None:
+                add("coefficient_sum", coefficient)
+            else:
+                add(cls.get_status_counter(former_status), -1)
+                if former_status == TestResult.TestResultStatus.SUCCESS:
+                    add("success_coefficient_sum", -coefficient)
+
+            add(cls.get_status_counter(status), 1)
+            if status == TestResult.TestResultStatus.SUCCESS:
+                add("success_coefficient_sum", coefficient)
+
+        for submission_id, submission_deltas in deltas.items():
+            cls.objects.filter(pk=submission_id).update(
+                **{
+                    counter: F(counter) + value
+                    for counter, value in submission_deltas.items()
+                    if value
+                }
+            )
+
+    @classmethod
+    def recount(cls, **filters):
+        """
+        Recomputes the counters of the submissions matching `filters` from their results,
+        after results were changed in bulk (queryset updates, deletions, coefficients edits)
+        """
+
+        def aggregate(expression, **result_filters):
+            return Coalesce(
+                models.Subquery(
+                    TestResult.objects.filter(
+                        submission=models.OuterRef("pk"), **result_filters
+                    )
+                    .order_by()
+                    .values("submission")
+                    .annotate(value=expression)
+                    .values("value")
+                ),
+                0,
+            )
+
+        return cls.objects.filter(**filters).update(
+            **{
+                cls.get_status_counter(status): aggregate(
+                    models.Count("id"), status=status
+                )
+                for status in TestResult.TestResultStatus.values
+            },
+            coefficient_sum=aggregate(Sum("exercise_test__coefficient")),
+            success_coefficient_sum=aggregate(
+                Sum("exercise_test__coefficient"),
+                status=TestResult.TestResultStatus.SUCCESS,
+            ),
+        )
+
+    def get_counters(self):
+        return Submission.objects.filter(pk=self.id).values(*self.COUNTERS).first()
+
     def refresh_status(self):
-        # Refresh submission status
+        # Refresh submission status, from the counters of its results
 
         old_status = self.status
 
-        test_results = TestResult.objects.filter(submission=self)
-        status = ""
-        if test_results:
-            statuses = set([result.status for result in test_results])
-
-            if statuses == set(["success"]):
-                status = "success"
-            elif "error" in statuses:
-                status = "error"
-            elif "failed" in statuses:
-                status = "failed"
-            elif "pending" in statuses:
-                status = "pending"
-            else:
-                status = "running"
-        else:
+        counters = self.get_counters() or {}
+        total = sum(
+            counters.get(self.get_status_counter(status), 0)
+            for status in TestResult.TestResultStatus.values
+        )
+
+        if total and counters["success_count"] == total:
+            status = "success"
+        elif counters.get("error_count"):
+            status = "error"
+        elif counters.get("failed_count"):
+            status = "failed"
+        elif not total or counters["pending_count"]:
             status = "pending"
+        else:
+            status = "running"
+
         submission = Submission.objects.filter(pk=self.id)
         submission.update(status=status)
+        self.status = status
 
-        self.refresh_grade()
+        # The grade is only final once no result is pending or running anymore
+        finished = not counters.get("pending_count") and not counters.get(
+            "running_count"
+        )
+        if finished:
+            self.refresh_grade(counters)
 
         if status != old_status:
             print(f"Submission status changed : {old_status} -> {status}")
@@ -107,6 +282,130 @@ class Submission(models.Model):
                 f"submission_{self.exercise.id}_{self.owner.id}", message
             )
 
+        if finished:
+            self.complete()
+
+    def complete(self):
+        """
+        Completion barrier of the current upload : once all its results are done,
+        marks it complete, records its latency from upload to final result,
+        and sends one `submission_completed` WebSocket update.
+
+        Fires once per generation, the conditional update only succeeds for the first caller.
+        Returns whether it fired.
+        """
+
+        completed_at = timezone.now()
+
+        completed = (
+            Submission.objects.filter(
+                pk=self.id,
+                generation=self.generation,
+                pending_count=0,
+                running_count=0,
+            )
+            .exclude(completed_generation=self.generation)
+            .update(completed_generation=self.generation, completed_at=completed_at)
+        )
+        if not completed:
+            return False
+
+        self.completed_generation = self.generation
+        self.completed_at = completed_at
+        latency = (completed_at - self.created).total_seconds()
+        print(f"Submission {self.id} completed in {latency:.2f}s")
+
+        message = {
+            "type": "submission_completed",
+            "message": {
+                "completed": {
+                    "submission": self.id,
+                    "generation": self.generation,
+                    "status": self.status,
+                    "grade": self.grade,
+                    "latency": latency,
+                }
+            },
+        }
+        group = f"submission_{self.exercise_id}_{self.owner_id}"
+
+        def on_commit():
+            from arbitre.completions import record_completion_latency
+
+            record_completion_latency(latency)
+            async_to_sync(get_channel_layer().group_send)(group, message)
+
+        transaction.on_commit(on_commit)
+
+        return True
+
+    @classmethod
+    def schedule_refresh(cls, submission_ids):
+        """
+        Refreshes the status and grade of submissions within RECOMPUTE_WINDOW seconds,
+        once for all the updates made meanwhile (see arbitre/recompute.py)
+        """
+
+        from arbitre.recompute import mark_dirty
+
+        submission_ids = set(submission_ids)
+        if mark_dirty(submission_ids):
+            return
+
+        for submission in cls.objects.filter(pk__in=submission_ids).select_related(
+            "exercise", "owner"
+        ):
+            submission.refresh_status()
+
+    @classmethod
+    def refresh_dirty_submissions(cls):
+        """
+        Refreshes the submissions whose scheduled refresh is due.
+        Those which couldn't be refreshed are scheduled again, they were already unmarked.
+        """
+
+        from arbitre.recompute import mark_dirty, pop_due_submissions
+
+        submission_ids = pop_due_submissions()
+
+        try:
+            submissions = list(
+                cls.objects.filter(pk__in=submission_ids).select_related(
+                    "exercise", "owner"
+                )
+            )
+        except Exception:
+            mark_dirty(submission_ids)
+            raise
+
+        failed_ids = []
+        for submission in submissions:
+            try:
+                submission.refresh_status()
+            except Exception as e:
+                print(f"Couldn't refresh submission {submission.id}: {e}")
+                failed_ids.append(submission.id)
+
+        if failed_ids:
+            mark_dirty(failed_ids)
+
+        return len(submission_ids)
+
+    def send_test_results(self):
+        """
+        Sends the submission and all its test results in a single WebSocket update
+        """
+
+        channel_layer = get_channel_layer()
+
+        from arbitre.util import prepare_submission_message
+
+        message = prepare_submission_message(self.id, with_test_results=True)
+
+        async_to_sync(channel_layer.group_send)(
+            f"submission_{self.exercise_id}_{self.owner_id}", message
+        )
+
     def _update_grade(self, grade: Optional[Decimal]):
         """
         Helper function for updating grade field
@@ -115,34 +414,28 @@ class Submission(models.Model):
         """
 
         Submission.objects.filter(pk=self.id).update(grade=grade)
+        self.grade = grade
 
-    def refresh_grade(self):
-        test_results = TestResult.objects.filter(submission=self).select_related(
-            "exercise_test__exercise__session__course"
-        )
+    def refresh_grade(self, counters=None):
+        if counters is None:
+            counters = self.get_counters()
 
-        if not test_results.exists():
+        if not counters or not any(
+            counters[self.get_status_counter(status)]
+            for status in TestResult.TestResultStatus.values
+        ):
             self._update_grade(None)
             return
 
-        exercise = test_results.first().exercise_test.exercise
+        exercise = Exercise.objects.select_related("session__course").get(
+            pk=self.exercise_id
+        )
         if not exercise.grade:
             self._update_grade(None)
             return
 
-        # Compute grade using aggregation
-        grade_calculation = test_results.aggregate(
-            sum_of_coefficients=Sum("exercise_test__coefficient"),
-            successful_tests=Sum(
-                Case(
-                    When(status="success", then=F("exercise_test__coefficient")),
-                    default=0,
-                )
-            ),
-        )
-
-        sum_of_coefficients = grade_calculation["sum_of_coefficients"]
-        successful_tests = grade_calculation["successful_tests"]
+        sum_of_coefficients = counters["coefficient_sum"]
+        successful_tests = counters["success_coefficient_sum"]
 
         if not sum_of_coefficients:
             self._update_grade(None)
@@ -160,81 +453,165 @@ class Submission(models.Model):
 
         self._update_grade(grade)
 
+    @classmethod
+    def refresh_grades(cls, **filters):
+        """
+        Recomputes in a single UPDATE the grade of the finished submissions matching `filters`
+        (e.g. `exercise__session__course=course`), like `refresh_grade` does for one submission :
+        from their counters, the grade of their exercise, and the late penalty of its course
+        """
+
+        exercise = Exercise.objects.filter(pk=models.OuterRef("exercise_id"))
+
+        # No grade if the exercise has none
+        exercise_grade = NullIf(
+            models.Subquery(exercise.values("grade")[:1]), Value(0.0)
+        )
+
+        # Only late submissions have a penalty
+        late_penalty = Coalesce(
+            models.Subquery(
+                exercise.filter(
+                    session__deadline__lt=models.OuterRef("created")
+                ).values("session__course__late_penalty")[:1]
+            ),
+            Value(0.0),
+        )
+
+        grade = models.ExpressionWrapper(
+            Cast("success_coefficient_sum", models.FloatField())
+            / F("coefficient_sum")
+            * exercise_grade
+            * (1 - late_penalty / 100),
+            output_field=models.FloatField(),
+        )
+
+        # Running submissions are graded once complete
+        return cls.objects.filter(pending_count=0, running_count=0, **filters).update(
+            grade=Case(
+                When(coefficient_sum__gt=0, then=grade),
+                default=None,
+                output_field=models.FloatField(),
+            )
+        )
+
     def save(self, *args, **kwargs):
         if self.ignore:
             super(Submission, self).save(*args, **kwargs)
+            Submission.recount(pk=self.pk)
             return
 
-        celery = Celery("arbitre", include=["arbitre.tasks"])
-
-        exercise = self.exercise
-        course = exercise.session.course
         tests = Test.objects.filter(exercise=self.exercise)
 
-        type = exercise.type
-
-        prefix = exercise.prefix
-        suffix = exercise.suffix
+        # The dispatch intent is written in the same transaction as the submission,
+        # so runners are only told about committed submissions, and never miss one
+        with transaction.atomic():
+            self.generation += 1
+            lease_expires_at = TestResult.get_pending_lease_expiration()
+
+            # Tests of the former upload still running on Judge0, by host
+            superseded_tokens = {}
+
+            # put all former tests (if any) in pending state, the submission is refreshed once below
+            test_results = list(TestResult.objects.filter(submission__id=self.id))
+            for test_result in test_results:
+                if (
+                    test_result.status == TestResult.TestResultStatus.RUNNING
+                    and test_result.host
+                ):
+                    superseded_tokens.setdefault(test_result.host, []).append(
+                        test_result.token
+                    )
+
+                # Callbacks of the former upload must not match the new results
+                test_result.token = str(uuid.uuid4())
+                test_result.host = ""
+                test_result.status = Submission.SubmissionStatus.PENDING
+                test_result.memory = -1
+                test_result.time = -1
+                test_result.stdout = ""
+                test_result.lease_expires_at = lease_expires_at
+                test_result.queue = DispatchQueue.INTERACTIVE
+
+            TestResult.objects.bulk_update(
+                test_results,
+                [
+                    "token",
+                    "host",
+                    "status",
+                    "memory",
+                    "time",
+                    "stdout",
+                    "lease_expires_at",
+                    "queue",
+                ],
+            )
 
-        # Read env
-        env = environ.Env()
-        env_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
-        environ.Env.read_env(env_file=env_file)
+            if self.pk:
+                Submission.recount(pk=self.pk)
 
-        # decide Judge0 host to use
-        hosts = env.list("JUDGE0_HOSTNAMES", default=["localhost"])
-        host = random.choice(hosts)
+                # The failed dispatches of the former upload don't need to be replayed
+                DeadLetter.resolve(submission_id=self.pk)
 
-        # put all former tests (if any) in pending state
-        # using save() in a for loop instead of update() on the queryset, because it would skip save()
-        test_results = TestResult.objects.filter(submission__id=self.id)
-        for test_result in test_results:
-            test_result.status = Submission.SubmissionStatus.PENDING
-            test_result.memory = -1
-            test_result.time = -1
-            test_result.stdout = ""
-            test_result.save()
-
-        self.refresh_status()
+            self.refresh_status()
+            if test_results:
+                self.send_test_results()
+
+            if tests:
+                if self.exercise.type not in Exercise.ExerciseTypes.values:
+                    raise Exception("Invalid exercise type")
+
+                super(Submission, self).save(*args, **kwargs)
+
+                # The results of new tests are created pending, so that the sweep finds them
+                # if the dispatch is lost
+                TestResult.objects.bulk_create(
+                    [
+                        TestResult(
+                            submission=self,
+                            exercise_test=test,
+                            lease_expires_at=lease_expires_at,
+                        )
+                        for test in tests
+                    ],
+                    ignore_conflicts=True,
+                )
 
-        if tests:
-            super(Submission, self).save(*args, **kwargs)
+                # Saving wrote the counters as they were loaded
+                Submission.recount(pk=self.pk)
 
-            file_content = ""
+                # Add one Judge0 task for all the tests to the outbox,
+                # replacing the ones of former uploads that were not dispatched yet
+                DispatchOutbox.enqueue(
+                    self, [test.id for test in tests], supersede=True
+                )
+            else:
+                self.status = Submission.SubmissionStatus.SUCCESS
+                super(Submission, self).save(*args, **kwargs)
+                Submission.recount(pk=self.pk)
+                self.refresh_status()
 
-            if type == "single":
-                with self.file.open(mode="rb") as f:
-                    file_content = f.read().decode("utf-8", "ignore")
+            transaction.on_commit(
+                lambda: self.on_new_generation(self.generation, superseded_tokens)
+            )
 
-            elif type == "multiple":
-                # convert zip file to base64
-                import base64
+    def on_new_generation(self, generation, superseded_tokens):
+        """
+        Tells the runners to drop the work of the former uploads,
+        and deletes the executions of the former upload running on Judge0
+        """
 
-                with self.file.open(mode="rb") as f:
-                    file_content = base64.b64encode(f.read()).decode("utf-8", "ignore")
+        from arbitre import celery_app
+        from arbitre.generations import publish_generation
 
-            else:
-                raise Exception("Invalid exercise type")
+        publish_generation(self.id, generation)
 
-            for test in tests:
-                # Add Judge0 task to queue
-                celery.send_task(
-                    "arbitre.tasks.run_test",
-                    (
-                        host,
-                        type,
-                        self.id,
-                        test.id,
-                        file_content,
-                        prefix,
-                        suffix,
-                        course.language,
-                    ),
-                )
-        else:
-            self.status = Submission.SubmissionStatus.SUCCESS
-            super(Submission, self).save(*args, **kwargs)
-            self.refresh_status()
+        if superseded_tokens:
+            celery_app.send_task(
+                "arbitre.tasks.delete_judge0_submissions",
+                (superseded_tokens,),
+                queue=DispatchQueue.RECOVERY,
+            )
 
     class Meta:
         unique_together = ("exercise", "owner")
@@ -252,6 +629,18 @@ class Test(models.Model):
     def __str__(self):
         return self.name + " (" + str(self.exercise) + ")"
 
+    def save(self, *args, **kwargs):
+        super(Test, self).save(*args, **kwargs)
+        self.exercise.refresh_bundle_version()
+
+    def delete(self, *args, **kwargs):
+        result = super(Test, self).delete(*args, **kwargs)
+        self.exercise.refresh_bundle_version()
+
+        # Its results were deleted along
+        Submission.recount(exercise_id=self.exercise_id)
+        return result
+
     class Meta:
         unique_together = ("exercise", "name")
 
@@ -274,6 +663,15 @@ class TestResult(models.Model):
         unique=True, default=uuid.uuid4, editable=True
     )  # Judge0 token, used for callback. Populated with a random uuid just for initialization.
     exercise_test = models.ForeignKey(Test, on_delete=models.CASCADE)
+    host = models.CharField(
+        max_length=255, blank=True, default=""
+    )  # Judge0 host running the test
+    lease_expires_at = models.DateTimeField(
+        blank=True, null=True
+    )  # The recovery sweep dispatches the result again after that
+    queue = models.CharField(
+        max_length=20, choices=DispatchQueue.choices, default=DispatchQueue.INTERACTIVE
+    )  # Celery queue the test was last dispatched to
     stdout = models.TextField(default="")
     time = models.FloatField(default=-1)
     memory = models.IntegerField(default=-1)
@@ -285,6 +683,9 @@ class TestResult(models.Model):
 
     class Meta:
         unique_together = ("submission", "exercise_test")
+        indexes = [
+            models.Index(fields=["status", "id"], name="runner_testresult_status_idx")
+        ]
 
     def __str__(self):
         return (
@@ -296,9 +697,114 @@ class TestResult(models.Model):
             + ")"
         )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        test_result = super().from_db(db, field_names, values)
+
+        # The status it had, to update its submission's counters when it's saved
+        if "status" in test_result.__dict__:
+            test_result._former_status = test_result.status
+
+        return test_result
+
+    @classmethod
+    def get_locked(cls, **filters):
+        """
+        Loads the results matching `filters` locked until the end of the transaction,
+        in id order so that concurrent writers don't deadlock
+        """
+
+        return list(
+            cls.objects.select_for_update(of=("self",))
+            .filter(**filters)
+            .select_related("exercise_test__exercise")
+            .order_by("id")
+        )
+
+    @classmethod
+    def get_locked_of_generation(cls, submission_id, test_ids, generation=None):
+        """
+        Loads the results of the given tests of a submission locked, by test id,
+        or None if the submission was uploaded again since `generation` :
+        the runner's writes for a former upload are dropped
+        """
+
+        filters = {"submission_id": submission_id, "exercise_test_id__in": test_ids}
+
+        if generation is not None:
+            if not Submission.objects.filter(
+                pk=submission_id, generation=generation
+            ).exists():
+                print(f"Submission {submission_id} was uploaded again, dropping")
+                return None
+            filters["submission__generation"] = generation
+
+        return {
+            test_result.exercise_test_id: test_result
+            for test_result in cls.get_locked(**filters)
+        }
+
+    @classmethod
+    def update_submission_counters(cls, test_results):
+        """
+        Updates the counters of the submissions of results just saved, with their former status.
+        Submissions of results whose former status is unknown (created in bulk) are recounted.
+
+        The results must have been loaded locked (select_for_update), in the transaction saving them :
+        otherwise a result stored twice at once (callback and reconciliation) would be counted twice.
+        """
+
+        transitions = []
+        recounted_submission_ids = set()
+
+        for test_result in test_results:
+            if not hasattr(test_result, "_former_status"):
+                recounted_submission_ids.add(test_result.submission_id)
+            elif test_result._former_status != test_result.status:
+                # The coefficient only matters for new and successful results
+                coefficient = 0
+                if (
+                    test_result._former_status is None
+                    or cls.TestResultStatus.SUCCESS
+                    in [
+                        test_result._former_status,
+                        test_result.status,
+                    ]
+                ):
+                    coefficient = test_result.exercise_test.coefficient
+
+                transitions.append(
+                    (
+                        test_result.submission_id,
+                        test_result._former_status,
+                        test_result.status,
+                        coefficient,
+                    )
+                )
+
+            test_result._former_status = test_result.status
+
+        Submission.update_counters(transitions)
+        if recounted_submission_ids:
+            Submission.recount(pk__in=recounted_submission_ids)
+
     def save(self, *args, **kwargs):
-        super(TestResult, self).save(*args, **kwargs)
-        self.submission.refresh_status()
+        with transaction.atomic():
+            if self._state.adding:
+                self._former_status = None
+            else:
+                # The status may have changed since it was loaded, the row is locked until it's counted
+                self._former_status = (
+                    TestResult.objects.select_for_update()
+                    .filter(pk=self.pk)
+                    .values_list("status", flat=True)
+                    .first()
+                )
+
+            super(TestResult, self).save(*args, **kwargs)
+            TestResult.update_submission_counters([self])
+
+        Submission.schedule_refresh([self.submission_id])
 
         # Get group to send to
         channel_layer = get_channel_layer()
@@ -312,72 +818,923 @@ class TestResult(models.Model):
 
         async_to_sync(channel_layer.group_send)(channels_group, message)
 
-    def run_all_pending_testresults():
-        celery = Celery("arbitre", include=["arbitre.tasks"])
+    def delete(self, *args, **kwargs):
+        result = super(TestResult, self).delete(*args, **kwargs)
+        Submission.recount(pk=self.submission_id)
+        return result
 
-        pending_testresults = TestResult.objects.filter(
-            status=TestResult.TestResultStatus.PENDING
-        ).prefetch_related("submission", "exercise_test")
+    @classmethod
+    def register_tokens(cls, submission_id, tokens, host="", generation=None):
+        """
+        Stores the Judge0 tokens of several tests of a submission at once,
+        and puts their results in running state.
 
-        if len(pending_testresults) == 0:
-            return
+        `tokens` is a dict of {test_id: token}, `host` the Judge0 host running them.
+        They're dropped if the submission was uploaded again since `generation`.
+
+        NOTE : Not using `save()` in a loop because it refreshes the submission for every test
+        """
+
+        lease_expires_at = cls.get_running_lease_expiration()
 
-        print("Running all pending testresults...")
+        with transaction.atomic():
+            test_results = cls.get_locked_of_generation(
+                submission_id, tokens.keys(), generation
+            )
+            if test_results is None:
+                return
+
+            new_test_results = []
+            for test_id, token in tokens.items():
+                test_result = test_results.get(test_id)
+                if test_result is None:
+                    test_result = cls(
+                        submission_id=submission_id, exercise_test_id=test_id
+                    )
+                    new_test_results.append(test_result)
+
+                test_result.token = token
+                test_result.host = host
+                test_result.lease_expires_at = lease_expires_at
+                test_result.status = cls.TestResultStatus.RUNNING
+                test_result.stdout = ""
+                test_result.time = -1
+                test_result.memory = -1
+
+            cls.objects.bulk_create(new_test_results)
+            cls.objects.bulk_update(
+                test_results.values(),
+                [
+                    "token",
+                    "host",
+                    "lease_expires_at",
+                    "status",
+                    "stdout",
+                    "time",
+                    "memory",
+                ],
+            )
+            cls.update_submission_counters([*test_results.values(), *new_test_results])
+
+        Submission.schedule_refresh([submission_id])
+        Submission.objects.get(pk=submission_id).send_test_results()
 
-        # Read env
-        env = environ.Env()
-        env_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
-        environ.Env.read_env(env_file=env_file)
+    def apply_judge0_output(self, output_data):
+        """
+        Sets the result of the test from a Judge0 output (base64-encoded streams), without saving it.
+        Bytes that aren't UTF-8 (binary output) are shown as replacement characters.
+        """
 
-        # decide judge0 host to use
-        hosts = env.list("JUDGE0_HOSTNAMES", default=["localhost"])
-        host = random.choice(hosts)
+        # Decode and concatenate all output streams
+        stdout = ""
+        for key in ["message", "stdout", "stderr", "compile_output"]:
+            if output_data.get(key):
+                stdout += base64.b64decode(output_data[key]).decode(
+                    "utf-8", errors="replace"
+                )
+
+        # Determine execution status
+        status_value = self.TestResultStatus.ERROR
+        if output_data.get("stdout"):
+            decoded_stdout = base64.b64decode(output_data["stdout"]).decode(
+                "utf-8", errors="replace"
+            )
+            expected_stdout = self.exercise_test.stdout
+            if not expected_stdout or decoded_stdout.rstrip("\n") == expected_stdout:
+                status_value = self.TestResultStatus.SUCCESS
+            else:
+                status_value = self.TestResultStatus.FAILED
+
+        self.stdout = stdout
+        self.status = status_value
+        self.time = output_data.get("time") or 0
+        self.memory = output_data.get("memory") or 0
+
+    def store_judge0_output(self, output_data):
+        """
+        Stores the result of the test from a Judge0 output, and caches it for identical executions
+        """
+
+        from arbitre.concurrency import record_completion
+
+        self.apply_judge0_output(output_data)
+        self.save()
+
+        # Frees the execution's slot on its host, 13 and 14 are Judge0 errors
+        status_id = (output_data.get("status") or {}).get("id")
+        record_completion(self.host, self.token, error=status_id in [13, 14])
+
+        self.cache_judge0_output(output_data)
+
+    def cache_judge0_output(self, output_data):
+        """
+        Caches the Judge0 output of the test for identical executions, unless its exercise disabled it
+        """
+
+        from arbitre.results_cache import store_result
+
+        if self.exercise_test.exercise.result_cache_enabled:
+            store_result(self.token, output_data)
+
+    @classmethod
+    def store_judge0_outputs(cls, outputs):
+        """
+        Stores the results of several tests from their Judge0 outputs at once (buffered callbacks).
+        Each submission is refreshed, and sent to the frontend, once.
+
+        NOTE : Not using `save()` in a loop because it refreshes the submission for every test
+        """
+
+        from arbitre.concurrency import record_completion
+        from arbitre.judge0_hosts import get_judge0_hosts
+
+        # A token called back twice keeps its last output
+        outputs_by_token = {
+            output_data["token"]: output_data
+            for output_data in outputs
+            if output_data.get("token")
+        }
+
+        with transaction.atomic():
+            test_results = []
+            for test_result in cls.get_locked(token__in=outputs_by_token.keys()):
+                try:
+                    test_result.apply_judge0_output(outputs_by_token[test_result.token])
+                except Exception as e:
+                    # Doesn't drop the rest of the batch, the result is fetched from Judge0 once its lease expires
+                    print(
+                        f"Couldn't apply the output of token {test_result.token}: {e}"
+                    )
+                    continue
+                test_results.append(test_result)
+
+            cls.objects.bulk_update(
+                test_results, ["status", "stdout", "time", "memory"]
+            )
+            cls.update_submission_counters(test_results)
+
+        for test_result in test_results:
+            output_data = outputs_by_token.pop(test_result.token)
 
-        for testresult in pending_testresults:
-            submission = testresult.submission
-            if submission.ignore:
-                print(f"Submission {submission.id} ({submission.owner}) ignored")
+            # Frees the execution's slot on its host, 13 and 14 are Judge0 errors
+            status_id = (output_data.get("status") or {}).get("id")
+            record_completion(
+                test_result.host, test_result.token, error=status_id in [13, 14]
+            )
+
+            test_result.cache_judge0_output(output_data)
+
+        # Executions of replaced uploads, or whose output couldn't be applied, their slots are freed anyway
+        for token in outputs_by_token.keys():
+            for hostname in get_judge0_hosts():
+                record_completion(hostname, token)
+
+        submission_ids = set(test_result.submission_id for test_result in test_results)
+        Submission.schedule_refresh(submission_ids)
+        for submission in Submission.objects.filter(pk__in=submission_ids):
+            submission.send_test_results()
+
+        return len(test_results)
+
+    @classmethod
+    def get_overdue_tokens(cls, batch_size=500):
+        """
+        Yields the tokens of the results running past their lease, by Judge0 host : {host: [token]},
+        `batch_size` results at a time, until all of them were yielded.
+        Their callback is late, or was lost.
+
+        Results dispatched before their host was recorded are yielded under the "" host.
+        """
+
+        now = timezone.now()
+        last_id = 0
+
+        while True:
+            test_results = list(
+                cls.objects.filter(
+                    status=cls.TestResultStatus.RUNNING,
+                    lease_expires_at__lt=now,
+                    id__gt=last_id,
+                )
+                .order_by("id")
+                .values_list("id", "token", "host")[:batch_size]
+            )
+            if not test_results:
+                return
+
+            last_id = test_results[-1][0]
+
+            tokens_by_host = {}
+            for _, token, host in test_results:
+                tokens_by_host.setdefault(host, []).append(token)
+
+            yield tokens_by_host
+
+            if len(test_results) < batch_size:
+                return
+
+    @classmethod
+    def extend_leases(cls, tokens):
+        """
+        Gives running results more time, when their results couldn't be fetched from Judge0.
+        They're reconciled again once it expires, or released if their host is taken out of rotation.
+        """
+
+        cls.objects.filter(
+            token__in=tokens, status=cls.TestResultStatus.RUNNING
+        ).update(lease_expires_at=cls.get_running_lease_expiration())
+
+    @classmethod
+    def extend_pending_leases(cls, submission_id, test_ids, delay, generation=None):
+        """
+        Gives pending results `delay` more seconds, when their dispatch is postponed
+        (Judge0 hosts saturated, or retrying after an error), so that the sweep doesn't
+        dispatch them again meanwhile. Results of a former upload (`generation`) are left alone.
+        """
+
+        filters = {}
+        if generation is not None:
+            filters["submission__generation"] = generation
+
+        cls.objects.filter(
+            submission_id=submission_id,
+            exercise_test_id__in=test_ids,
+            status=cls.TestResultStatus.PENDING,
+            **filters,
+        ).update(
+            lease_expires_at=cls.get_pending_lease_expiration()
+            + timedelta(seconds=delay)
+        )
+
+    @classmethod
+    def reconcile(cls, tokens, outputs):
+        """
+        Stores the results of running tests from the Judge0 outputs fetched for their tokens,
+        as their callback would have.
+
+        `outputs` is a dict of {token: Judge0 output}. Tokens without output are unknown to Judge0
+        (lost), their results are put back in pending state to be dispatched again.
+        """
+
+        test_results = cls.objects.filter(
+            token__in=tokens, status=cls.TestResultStatus.RUNNING
+        ).select_related("exercise_test")
+
+        finished_outputs = []
+        for test_result in test_results:
+            output_data = outputs.get(test_result.token)
+
+            if output_data is None:
+                test_result.status = cls.TestResultStatus.PENDING
+                test_result.host = ""
+                test_result.lease_expires_at = None
+                test_result.save()
+                continue
+
+            # In Queue or Processing : still running, wait for the callback
+            if (output_data.get("status") or {}).get("id") in [1, 2]:
+                cls.objects.filter(pk=test_result.pk).update(
+                    lease_expires_at=cls.get_running_lease_expiration()
+                )
                 continue
-            exercise_test = testresult.exercise_test
 
-            print(
-                f"Re-running testresult {testresult.id} (status: {testresult.status}) in {submission.id} by {submission.owner} (created {submission.created}, submission status {submission.status})"
+            finished_outputs.append({**output_data, "token": test_result.token})
+
+        cls.store_judge0_outputs(finished_outputs)
+
+    @classmethod
+    def apply_cached_outputs(cls, submission_id, outputs, generation=None):
+        """
+        Stores the results of several tests of a submission from cached Judge0 outputs,
+        for executions that already ran and didn't need to be sent to Judge0 again.
+
+        `outputs` is a dict of {test_id: Judge0 output}.
+        They're dropped if the submission was uploaded again since `generation`.
+        """
+
+        with transaction.atomic():
+            test_results = cls.get_locked_of_generation(
+                submission_id, outputs.keys(), generation
+            )
+            if test_results is None:
+                return
+
+            new_test_results = []
+            for test_id, output_data in outputs.items():
+                test_result = test_results.get(test_id)
+                if test_result is None:
+                    test_result = cls(
+                        submission_id=submission_id, exercise_test_id=test_id
+                    )
+                    new_test_results.append(test_result)
+
+                test_result.host = ""
+                test_result.apply_judge0_output(output_data)
+
+            cls.objects.bulk_create(new_test_results)
+            cls.objects.bulk_update(
+                test_results.values(), ["host", "status", "stdout", "time", "memory"]
             )
+            cls.update_submission_counters([*test_results.values(), *new_test_results])
 
-            # Read file content
-            file_content = ""
+        Submission.schedule_refresh([submission_id])
+        Submission.objects.get(pk=submission_id).send_test_results()
 
-            if submission.exercise.type == "single":
-                with submission.file.open(mode="rb") as f:
-                    file_content = f.read().decode("utf-8", "ignore")
+    @classmethod
+    def release_host(cls, host):
+        """
+        Puts back in pending state the results that were running on a Judge0 host
+        taken out of rotation, so that they're sent to another host
+        """
 
-            elif submission.exercise.type == "multiple":
-                # convert zip file to base64
-                import base64
+        test_results = cls.objects.filter(
+            status=cls.TestResultStatus.RUNNING, host=host
+        )
+        submission_ids = set(test_results.values_list("submission_id", flat=True))
 
-                with submission.file.open(mode="rb") as f:
-                    file_content = base64.b64encode(f.read()).decode("utf-8", "ignore")
+        count = test_results.update(
+            status=cls.TestResultStatus.PENDING, host="", lease_expires_at=None
+        )
+        Submission.recount(pk__in=submission_ids)
 
-            lang = submission.exercise.session.course.language
-            type = submission.exercise.type
-            prefix = submission.exercise.prefix
-            suffix = submission.exercise.suffix
+        for submission in Submission.objects.filter(pk__in=submission_ids):
+            submission.refresh_status()
 
-            # if submission created more than 20 seconds ago
-            if submission.created < timezone.now() - timedelta(seconds=20):
-                # Add Judge0 task to queue
-                celery.send_task(
-                    "arbitre.tasks.run_test",
-                    (
-                        host,
-                        type,
-                        submission.id,
-                        exercise_test.id,
-                        file_content,
-                        prefix,
-                        suffix,
-                        lang,
+        print(f"{count} test results released from Judge0 host {host}")
+
+    @classmethod
+    def store_error(cls, submission_id, test_id, message):
+        """
+        Stores an error result for a test that couldn't be run
+        """
+
+        test_result, _ = cls.objects.get_or_create(
+            submission_id=submission_id, exercise_test_id=test_id
+        )
+        test_result.status = cls.TestResultStatus.ERROR
+        test_result.stdout = message
+        test_result.time = 0
+        test_result.memory = 0
+        test_result.save()
+
+    @classmethod
+    def run_all_pending_testresults(cls, **filters):
+        """
+        Dispatches again the results left pending past their lease (lost messages),
+        and the running ones that never reached a Judge0 host. `filters` restrict the results to dispatch.
+
+        Results running on a host are never dispatched again from here, that would run the code twice :
+        they're reconciled with Judge0 (see `reconcile`), which only puts back in pending state
+        the ones it doesn't know, or released when their host is taken out of rotation.
+
+        The table is walked in batches by id. Each batch is claimed (SKIP LOCKED) and leased
+        in a transaction, so that concurrent sweeps never dispatch the same result twice.
+
+        Requeued results stay on the bulk queue, the others go to the recovery queue.
+        """
+
+        batch_size = env.int("PENDING_SWEEP_BATCH_SIZE", default=500)
+        last_id = 0
+        count = 0
+
+        while True:
+            with transaction.atomic():
+                now = timezone.now()
+
+                test_results = list(
+                    cls.objects.select_for_update(skip_locked=True, of=("self",))
+                    .filter(
+                        models.Q(lease_expires_at__isnull=True)
+                        | models.Q(lease_expires_at__lt=now),
+                        # Submissions waiting in the outbox are dispatched by the relay
+                        ~models.Exists(
+                            DispatchOutbox.get_queued(models.OuterRef("submission"))
+                        ),
+                        # Dead-lettered submissions wait to be replayed from the admin
+                        ~models.Exists(
+                            DeadLetter.get_open(models.OuterRef("submission"))
+                        ),
+                        models.Q(status=cls.TestResultStatus.PENDING)
+                        | models.Q(status=cls.TestResultStatus.RUNNING, host=""),
+                        submission__ignore=False,
+                        id__gt=last_id,
+                        **filters,
+                    )
+                    .order_by("id")
+                    .values_list(
+                        "id", "submission_id", "exercise_test_id", "status", "queue"
+                    )[:batch_size]
+                )
+
+                if not test_results:
+                    break
+
+                last_id = test_results[-1][0]
+
+                cls.objects.filter(
+                    pk__in=[test_result[0] for test_result in test_results]
+                ).update(
+                    status=cls.TestResultStatus.PENDING,
+                    host="",
+                    lease_expires_at=cls.get_pending_lease_expiration(),
+                    queue=Case(
+                        When(queue=DispatchQueue.BULK, then=Value(DispatchQueue.BULK)),
+                        default=Value(DispatchQueue.RECOVERY),
                     ),
                 )
 
-        print(f"Ran {len(pending_testresults)} pending testresults")
+                # Group tests by submission and queue, so that each submission is sent in one task
+                tests_by_submission = {}
+                stuck_submission_ids = set()
+                for _, submission_id, test_id, status, queue in test_results:
+                    if queue != DispatchQueue.BULK:
+                        queue = DispatchQueue.RECOVERY
+                    tests_by_submission.setdefault(submission_id, {}).setdefault(
+                        queue, []
+                    ).append(test_id)
+                    if status == cls.TestResultStatus.RUNNING:
+                        stuck_submission_ids.add(submission_id)
+
+                if stuck_submission_ids:
+                    Submission.recount(pk__in=stuck_submission_ids)
+
+                # Requeued payloads are usually still in the store, their files are not read again
+                submissions = (
+                    Submission.objects.filter(pk__in=tests_by_submission.keys())
+                    .select_related("exercise__session__course")
+                    .annotate(
+                        latest_payload_key=models.Subquery(
+                            DispatchOutbox.objects.filter(
+                                submission=models.OuterRef("pk")
+                            )
+                            .order_by("-id")
+                            .values("payload_key")[:1]
+                        )
+                    )
+                )
+
+                for submission in submissions:
+                    for queue, test_ids in tests_by_submission[submission.id].items():
+                        DispatchOutbox.enqueue(
+                            submission,
+                            test_ids,
+                            submission.latest_payload_key,
+                            queue,
+                        )
+
+                    if submission.id in stuck_submission_ids:
+                        submission.refresh_status()
+
+            count += len(test_results)
+            if len(test_results) < batch_size:
+                break
+
+        if count:
+            print(f"Dispatched {count} pending or stuck test results again")
+
+    @staticmethod
+    def get_pending_lease_expiration():
+        """
+        Pending results are not swept before their dispatch had time to reach a runner
+        """
+
+        return timezone.now() + timedelta(seconds=env.int("PENDING_LEASE", default=30))
+
+    @staticmethod
+    def get_running_lease_expiration():
+        """
+        Running results are reconciled with Judge0 if it didn't call back by then
+        """
+
+        return timezone.now() + timedelta(seconds=env.int("RUNNING_LEASE", default=120))
+
+
+class DispatchOutbox(models.Model):
+    """
+    Intent to run tests on a submission, written in the same transaction as the submission.
+
+    The relay (`python manage.py dispatch_relay`) publishes the entries to the runners
+    as soon as they're committed, using Postgres' LISTEN/NOTIFY.
+    Each entry is published with its dispatch_id as Celery task id and idempotency key,
+    so that entries published twice (relay crashed before marking them) only run once.
+
+    Entries are published earliest deadline first : by the deadline of their session,
+    capped by their creation plus DISPATCH_AGING_HORIZON seconds, hours by default (see `get_due_at`),
+    so that work without a close deadline still progresses.
+
+    Owners are served round-robin, and an owner's entries wait in the outbox while they have
+    DISPATCH_MAX_IN_FLIGHT_PER_OWNER tests or more in flight. A new upload replaces
+    the entries of the former ones that are still waiting.
+    """
+
+    NOTIFY_CHANNEL = "arbitre_dispatch"
+
+    # RabbitMQ message priorities, for workers consuming several queues.
+    # Entries due soon get one more (see `get_priority`)
+    PRIORITIES = {
+        DispatchQueue.INTERACTIVE: 8,
+        DispatchQueue.RECOVERY: 4,
+        DispatchQueue.BULK: 1,
+    }
+
+    id: int
+    dispatch_id = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    submission = models.ForeignKey(Submission, on_delete=models.CASCADE)
+    test_ids = models.JSONField(default=list)
+    payload_key = models.CharField(max_length=64, blank=True, null=True)
+    bundle_version = models.CharField(max_length=64, blank=True)
+    generation = models.PositiveIntegerField(default=0)
+    queue = models.CharField(
+        max_length=20, choices=DispatchQueue.choices, default=DispatchQueue.INTERACTIVE
+    )
+    pool = models.CharField(max_length=64, default="default")  # Pool of Judge0 hosts
+    created = models.DateTimeField(auto_now_add=True)
+    due_at = models.DateTimeField(default=timezone.now)
+    dispatched_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["due_at", "id"],
+                condition=models.Q(dispatched_at__isnull=True),
+                name="runner_outbox_due_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"Dispatch {self.dispatch_id} of submission {self.submission_id}"
+
+    @classmethod
+    def get_queued(cls, submission):
+        """
+        Entries of a submission (or OuterRef) waiting in the outbox
+        """
+
+        return cls.objects.filter(submission=submission, dispatched_at__isnull=True)
+
+    @classmethod
+    def enqueue(
+        cls,
+        submission,
+        test_ids,
+        payload_key=None,
+        queue=DispatchQueue.INTERACTIVE,
+        supersede=False,
+    ):
+        """
+        Writes a dispatch intent, and wakes up the relay when the transaction commits.
+        The submission's source is stored unless the key of its payload is given.
+
+        With `supersede`, the entries of the submission still waiting in the outbox are removed
+        (except the ones being published).
+        """
+
+        from arbitre.judge0_hosts import get_pool
+
+        exercise = submission.exercise
+
+        if supersede:
+            superseded = cls.get_queued(submission).select_for_update(skip_locked=True)
+            cls.objects.filter(
+                pk__in=list(superseded.values_list("pk", flat=True))
+            ).delete()
+
+        # The message only carries the key of the source in the payload store,
+        # and the version of the exercise bundle that runners keep in cache
+        entry = cls.objects.create(
+            submission=submission,
+            test_ids=list(test_ids),
+            payload_key=payload_key or submission.store_payload(),
+            generation=submission.generation,
+            queue=queue,
+            pool=get_pool(exercise.type, exercise.session.course.language),
+            bundle_version=exercise.bundle_version or exercise.refresh_bundle_version(),
+            due_at=cls.get_due_at(exercise.session.deadline),
+        )
+
+        # Notifications are only delivered on commit
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, '')", [cls.NOTIFY_CHANNEL])
+
+        return entry
+
+    @staticmethod
+    def get_due_at(deadline):
+        """
+        When an entry should be dispatched : the session's deadline, or later work ages
+        until its creation plus DISPATCH_AGING_HORIZON seconds.
+        The horizon spans hours, so that the deadlines of the day keep their order.
+        Passed deadlines (late submissions) don't make entries more urgent.
+        """
+
+        now = timezone.now()
+        horizon = now + timedelta(
+            seconds=env.int("DISPATCH_AGING_HORIZON", default=6 * 3600)
+        )
+
+        if deadline is None or deadline < now:
+            return horizon
+
+        return min(deadline, horizon)
+
+    def get_priority(self):
+        """
+        Message priority : the queue's, plus one when the entry is due soon
+        (close deadline, or aged for long enough)
+        """
+
+        priority = self.PRIORITIES.get(self.queue, 1)
+
+        if self.due_at <= timezone.now() + timedelta(
+            seconds=env.int("DISPATCH_URGENT_WINDOW", default=5 * 60)
+        ):
+            priority += 1
+
+        return priority
+
+    @staticmethod
+    def get_in_flight_by_owner():
+        """
+        Number of tests in flight by owner : dispatched, and not finished yet
+        """
+
+        return dict(
+            TestResult.objects.filter(
+                ~models.Exists(
+                    DispatchOutbox.get_queued(models.OuterRef("submission"))
+                ),
+                ~models.Exists(DeadLetter.get_open(models.OuterRef("submission"))),
+                status__in=[
+                    TestResult.TestResultStatus.PENDING,
+                    TestResult.TestResultStatus.RUNNING,
+                ],
+            )
+            .values_list("submission__owner_id")
+            .annotate(count=models.Count("id"))
+        )
+
+    @staticmethod
+    def pick_fairly(entries, batch_size, in_flight):
+        """
+        Picks up to `batch_size` entries round-robin across their owners, skipping the owners
+        reaching DISPATCH_MAX_IN_FLIGHT_PER_OWNER tests in flight.
+        Each owner's entries keep their (earliest deadline first) order.
+
+        `in_flight` is the number of tests in flight by owner, updated with the picked entries
+        """
+
+        max_in_flight = env.int("DISPATCH_MAX_IN_FLIGHT_PER_OWNER", default=40)
+
+        entries_by_owner = {}
+        for entry in entries:
+            entries_by_owner.setdefault(entry.submission.owner_id, []).append(entry)
+
+        picked = []
+        while entries_by_owner and len(picked) < batch_size:
+            for owner_id in list(entries_by_owner.keys()):
+                owner_entries = entries_by_owner[owner_id]
+                entry = owner_entries.pop(0)
+
+                # An owner with nothing in flight can always run one submission
+                owner_in_flight = in_flight.get(owner_id, 0)
+                if (
+                    owner_in_flight
+                    and owner_in_flight + len(entry.test_ids) > max_in_flight
+                ):
+                    del entries_by_owner[owner_id]
+                    continue
+
+                in_flight[owner_id] = owner_in_flight + len(entry.test_ids)
+                picked.append(entry)
+
+                if not owner_entries:
+                    del entries_by_owner[owner_id]
+                if len(picked) == batch_size:
+                    break
+
+        return picked
+
+    def get_task_arguments(self):
+        """
+        Arguments of the `run_submission` task running this entry : (args, kwargs)
+        """
+
+        return (self.submission_id, self.test_ids, self.payload_key), {
+            "exercise_id": self.submission.exercise_id,
+            "bundle_version": self.bundle_version,
+            "dispatch_id": str(self.dispatch_id),
+            "generation": self.generation,
+        }
+
+    def publish_to_celery(self):
+        # The configured app declares the queues (see arbitre/celery.py)
+        from arbitre import celery_app as celery
+        from arbitre.judge0_hosts import get_pool_queue
+
+        args, kwargs = self.get_task_arguments()
+        celery.send_task(
+            "arbitre.tasks.run_submission",
+            args,
+            kwargs,
+            task_id=str(self.dispatch_id),
+            queue=get_pool_queue(self.queue, self.pool),
+            priority=self.get_priority(),
+        )
+
+    @staticmethod
+    def is_consumed_by_dispatcher():
+        """
+        With DISPATCHER=async, entries are consumed by the asynchronous dispatcher
+        (`python manage.py judge0_dispatcher`) instead of being published to Celery
+        """
+
+        return env("DISPATCHER", default="celery") == "async"
+
+    @classmethod
+    def relay(cls, batch_size=100, publish=None, limit=None):
+        """
+        Publishes the entries of the outbox that were not dispatched yet, in batches,
+        earliest deadline first and round-robin across owners.
+        Several relays can run at once, locked entries are skipped.
+
+        Entries held back by the in-flight cap are published by a later relay,
+        once their owner's tests finish.
+
+        `publish` is called with each entry, and defaults to publishing it to Celery.
+        At most `limit` entries are published, if given.
+
+        Returns the number of published entries
+        """
+
+        if publish is None:
+            if cls.is_consumed_by_dispatcher():
+                return 0
+            publish = cls.publish_to_celery
+
+        max_in_flight = env.int("DISPATCH_MAX_IN_FLIGHT_PER_OWNER", default=40)
+        count = 0
+
+        while limit is None or count < limit:
+            if limit is not None:
+                batch_size = min(batch_size, limit - count)
+
+            with transaction.atomic():
+                in_flight = cls.get_in_flight_by_owner()
+                capped_owners = [
+                    owner_id
+                    for owner_id, owner_in_flight in in_flight.items()
+                    if owner_in_flight >= max_in_flight
+                ]
+
+                # Several entries per owner are considered, to interleave owners
+                candidates = list(
+                    cls.objects.select_for_update(skip_locked=True, of=("self",))
+                    .filter(dispatched_at__isnull=True)
+                    .exclude(submission__owner_id__in=capped_owners)
+                    .select_related("submission")
+                    .order_by("due_at", "id")[: batch_size * 4]
+                )
+                entries = cls.pick_fairly(candidates, batch_size, in_flight)
+
+                for entry in entries:
+                    publish(entry)
+
+                cls.objects.filter(pk__in=[entry.pk for entry in entries]).update(
+                    dispatched_at=timezone.now()
+                )
+
+                # The sweep waits for the dispatched tests to reach a runner
+                lease_expires_at = TestResult.get_pending_lease_expiration()
+                for entry in entries:
+                    TestResult.objects.filter(
+                        submission_id=entry.submission_id,
+                        exercise_test_id__in=entry.test_ids,
+                        status=TestResult.TestResultStatus.PENDING,
+                    ).update(lease_expires_at=lease_expires_at)
+
+            count += len(entries)
+            if len(entries) < batch_size:
+                break
+
+        return count
+
+    @classmethod
+    def purge(cls):
+        """
+        Removes the entries dispatched more than OUTBOX_RETENTION seconds ago
+        """
+
+        cls.objects.filter(
+            dispatched_at__lt=timezone.now()
+            - timedelta(seconds=env.int("OUTBOX_RETENTION", default=24 * 3600))
+        ).delete()
+
+
+class DeadLetter(models.Model):
+    """
+    Tests of a submission that couldn't be sent to Judge0 : after DISPATCH_MAX_RETRIES
+    transient errors (Judge0 or the REST API unreachable), or after an unexpected error.
+
+    Their results stay pending, and are left out of the sweep until the dead letter
+    is replayed from the admin, or the submission is uploaded again.
+    """
+
+    submission = models.ForeignKey(
+        Submission, on_delete=models.CASCADE, related_name="dead_letters"
+    )
+    test_ids = models.JSONField(default=list)
+    generation = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=1)
+    error = models.TextField(blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    # Replayed, or the upload was replaced
+    resolved_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    class Meta:
+        ordering = ["-created"]
+
+    def __str__(self):
+        return f"Dead letter of submission {self.submission_id}"
+
+    @classmethod
+    def get_open(cls, submission):
+        return cls.objects.filter(submission=submission, resolved_at__isnull=True)
+
+    @classmethod
+    def record(cls, submission_id, test_ids, generation, attempts, error):
+        """
+        Puts the tests of a submission in the dead letters,
+        unless the submission was uploaded again since `generation`
+        """
+
+        submission = Submission.objects.filter(pk=submission_id).first()
+        if submission is None or not test_ids:
+            return None
+
+        if generation is None:
+            generation = submission.generation
+        elif generation != submission.generation:
+            return None
+
+        return cls.objects.create(
+            submission=submission,
+            test_ids=list(test_ids),
+            generation=generation,
+            attempts=attempts,
+            error=error,
+        )
+
+    @classmethod
+    def resolve(cls, **filters):
+        """
+        Closes the open dead letters matching `filters`, without replaying them
+        """
+
+        return cls.objects.filter(resolved_at__isnull=True, **filters).update(
+            resolved_at=timezone.now()
+        )
+
+    @classmethod
+    def replay(cls, dead_letters):
+        """
+        Dispatches again the tests of the open dead letters among `dead_letters`,
+        on the recovery queue. Returns the number of replayed dead letters.
+        """
+
+        count = 0
+
+        for dead_letter in dead_letters.filter(resolved_at__isnull=True).select_related(
+            "submission__exercise__session__course"
+        ):
+            with transaction.atomic():
+                submission = dead_letter.submission
+
+                # Only the tests still waiting for a result are sent
+                test_ids = list(
+                    TestResult.objects.filter(
+                        submission=submission,
+                        exercise_test_id__in=dead_letter.test_ids,
+                        status=TestResult.TestResultStatus.PENDING,
+                    ).values_list("exercise_test_id", flat=True)
+                )
+
+                dead_letter.resolved_at = timezone.now()
+                dead_letter.save(update_fields=["resolved_at"])
+
+                if dead_letter.generation != submission.generation or not test_ids:
+                    continue
+
+                TestResult.objects.filter(
+                    submission=submission, exercise_test_id__in=test_ids
+                ).update(
+                    queue=DispatchQueue.RECOVERY,
+                    lease_expires_at=TestResult.get_pending_lease_expiration(),
+                )
+                DispatchOutbox.enqueue(
+                    submission, test_ids, queue=DispatchQueue.RECOVERY
+                )
+
+            count += 1
+
+        return count
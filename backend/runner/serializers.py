@@ -70,7 +70,9 @@ class TestResultSerializer(RoleBasedSerializer):
             "memory",
             "status",
             "token",
+            "queue",
         )
+        read_only_fields = ("queue",)
 
     role_fields = {
         "teacher": None,
@@ -0,0 +1,764 @@
+from arbitre.testing import ArbitreTestCase, RedisTestMixin
+from datetime import timedelta
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from django.urls import reverse
+from runner.models import DispatchOutbox, Submission, Test, TestResult
+from types import SimpleNamespace
+from unittest import mock
+import base64
+
+
+class PendingSweepTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=3)
+        self.submission = self.create_submission(self.exercise)
+
+        # The upload was dispatched, its leases expired
+        DispatchOutbox.objects.update(dispatched_at=timezone.now())
+        TestResult.objects.update(
+            lease_expires_at=timezone.now() - timedelta(minutes=5)
+        )
+
+        self.running = TestResult.objects.order_by("id").first()
+        TestResult.objects.filter(pk=self.running.pk).update(
+            status=TestResult.TestResultStatus.RUNNING, host="judge0:2358"
+        )
+
+    def test_pending_results_are_dispatched_when_reconcile_fails(self):
+        from arbitre import tasks
+
+        with mock.patch.object(
+            tasks, "get_judge0_results_batch", return_value={}
+        ), mock.patch.object(
+            TestResult, "reconcile", side_effect=RuntimeError("Undecodable output")
+        ):
+            tasks.run_all_pending_testresults()
+
+        entry = DispatchOutbox.get_queued(self.submission).get()
+        self.assertEqual(
+            sorted(entry.test_ids),
+            sorted(
+                TestResult.objects.exclude(pk=self.running.pk).values_list(
+                    "exercise_test_id", flat=True
+                )
+            ),
+        )
+
+    def test_running_results_are_not_dispatched_again(self):
+        from arbitre import tasks
+        import requests
+
+        with mock.patch.object(
+            tasks,
+            "get_judge0_results_batch",
+            side_effect=requests.exceptions.ConnectionError,
+        ):
+            tasks.run_all_pending_testresults()
+
+        # Its lease is extended until the next reconciliation
+        self.running.refresh_from_db()
+        self.assertEqual(self.running.status, TestResult.TestResultStatus.RUNNING)
+        self.assertGreater(self.running.lease_expires_at, timezone.now())
+
+        entry = DispatchOutbox.get_queued(self.submission).get()
+        self.assertNotIn(self.running.exercise_test_id, entry.test_ids)
+
+    def test_tokens_unknown_to_judge0_are_dispatched_again(self):
+        from arbitre import tasks
+
+        with mock.patch.object(tasks, "get_judge0_results_batch", return_value={}):
+            tasks.run_all_pending_testresults()
+
+        self.running.refresh_from_db()
+        self.assertEqual(self.running.status, TestResult.TestResultStatus.PENDING)
+
+        entry = DispatchOutbox.get_queued(self.submission).get()
+        self.assertIn(self.running.exercise_test_id, entry.test_ids)
+
+    def test_overdue_tokens_are_all_paged_through(self):
+        TestResult.objects.update(
+            status=TestResult.TestResultStatus.RUNNING, host="judge0:2358"
+        )
+
+        tokens = [
+            token
+            for tokens_by_host in TestResult.get_overdue_tokens(batch_size=2)
+            for token in tokens_by_host["judge0:2358"]
+        ]
+
+        self.assertCountEqual(
+            tokens, TestResult.objects.values_list("token", flat=True)
+        )
+
+
+class HostlessReconcileTests(ArbitreTestCase):
+    env = {"JUDGE0_HOSTNAMES": "judge0-a:2358,judge0-b:2358"}
+
+    def setUp(self):
+        exercise = self.create_exercise(tests=2)
+        self.submission = self.create_submission(exercise)
+        DispatchOutbox.objects.update(dispatched_at=timezone.now())
+
+        # Running since before hosts were recorded
+        for i, test_result in enumerate(TestResult.objects.order_by("id")):
+            test_result.status = TestResult.TestResultStatus.RUNNING
+            test_result.token = f"token-{i}"
+            test_result.lease_expires_at = timezone.now() - timedelta(minutes=5)
+            test_result.save()
+
+    def test_hostless_tokens_are_fetched_from_every_host(self):
+        from arbitre import tasks
+
+        def get_judge0_results_batch(hostname, tokens):
+            if hostname == "judge0-b:2358":
+                return {
+                    "token-0": {
+                        "token": "token-0",
+                        "status": {"id": 3},
+                        "stdout": base64.b64encode(b"0").decode(),
+                    }
+                }
+            return {}
+
+        with mock.patch.object(
+            tasks, "get_judge0_results_batch", side_effect=get_judge0_results_batch
+        ) as get_results:
+            tasks.reconcile_overdue_testresults()
+
+        self.assertCountEqual(
+            [call.args[0] for call in get_results.call_args_list],
+            ["judge0-a:2358", "judge0-b:2358"],
+        )
+        self.assertEqual(
+            dict(TestResult.objects.values_list("token", "status")),
+            {
+                "token-0": TestResult.TestResultStatus.SUCCESS,
+                "token-1": TestResult.TestResultStatus.PENDING,
+            },
+        )
+
+    def test_missing_tokens_wait_while_a_host_is_unreachable(self):
+        from arbitre import tasks
+        import requests
+
+        def get_judge0_results_batch(hostname, tokens):
+            if hostname == "judge0-a:2358":
+                raise requests.exceptions.ConnectionError
+            return {}
+
+        with mock.patch.object(
+            tasks, "get_judge0_results_batch", side_effect=get_judge0_results_batch
+        ):
+            tasks.reconcile_overdue_testresults()
+
+        for test_result in TestResult.objects.all():
+            self.assertEqual(test_result.status, TestResult.TestResultStatus.RUNNING)
+            self.assertGreater(test_result.lease_expires_at, timezone.now())
+
+
+class Judge0OutputTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=3)
+        self.submission = self.create_submission(self.exercise)
+
+        self.test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+        TestResult.register_tokens(
+            self.submission.id,
+            {test_id: f"token-{i}" for i, test_id in enumerate(self.test_ids)},
+            "judge0:2358",
+        )
+
+    def get_output(self, token, stdout):
+        return {
+            "token": token,
+            "stdout": base64.b64encode(stdout).decode(),
+            "status": {"id": 3},
+            "time": "0.01",
+            "memory": 1024,
+        }
+
+    def test_binary_output_is_stored_with_replacement_characters(self):
+        TestResult.store_judge0_outputs([self.get_output("token-0", b"\xff0")])
+
+        test_result = TestResult.objects.get(token="token-0")
+        self.assertEqual(test_result.status, TestResult.TestResultStatus.FAILED)
+        self.assertEqual(test_result.stdout, "\ufffd0")
+
+    def test_unapplicable_output_does_not_drop_the_batch(self):
+        outputs = [
+            self.get_output("token-0", b"0"),
+            {**self.get_output("token-1", b"1"), "stdout": ["1"]},
+            self.get_output("token-2", b"2"),
+        ]
+
+        self.assertEqual(TestResult.store_judge0_outputs(outputs), 2)
+
+        statuses = dict(TestResult.objects.values_list("token", "status"))
+        self.assertEqual(
+            statuses,
+            {
+                "token-0": TestResult.TestResultStatus.SUCCESS,
+                "token-1": TestResult.TestResultStatus.RUNNING,
+                "token-2": TestResult.TestResultStatus.SUCCESS,
+            },
+        )
+
+    def test_callback_with_malformed_base64_is_rejected(self):
+        with mock.patch("runner.views.buffer_callback") as buffer_callback:
+            response = self.client.put(
+                reverse("judge0-callback"),
+                {"token": "token-0", "stdout": "not base64!"},
+                content_type="application/json",
+                HTTP_HOST="testserver",
+            )
+
+        self.assertEqual(response.status_code, 400)
+        buffer_callback.assert_not_called()
+
+    def test_callback_with_wrapped_base64_is_accepted(self):
+        output = self.get_output("token-0", b"0" * 100)
+        output["stdout"] = "\n".join(
+            output["stdout"][i : i + 60] for i in range(0, len(output["stdout"]), 60)
+        )
+
+        with mock.patch("runner.views.buffer_callback", return_value=True):
+            response = self.client.put(
+                reverse("judge0-callback"),
+                output,
+                content_type="application/json",
+                HTTP_HOST="testserver",
+            )
+
+        self.assertEqual(response.status_code, 200)
+
+
+class RecomputeTests(RedisTestMixin, ArbitreTestCase):
+    env = {"RECOMPUTE_WINDOW": "60"}
+
+    def test_submissions_failing_to_refresh_are_scheduled_again(self):
+        from arbitre.recompute import DIRTY_KEY
+        from arbitre.redis_client import get_redis
+        from runner.models import Submission
+
+        exercise = self.create_exercise(tests=1)
+        failing = self.create_submission(exercise, username="failing")
+        refreshed = self.create_submission(exercise, username="refreshed")
+
+        # Both are due
+        get_redis().zadd(DIRTY_KEY, {str(failing.id): 0, str(refreshed.id): 0})
+
+        refresh_status = Submission.refresh_status
+
+        def refresh_or_fail(submission):
+            if submission.id == failing.id:
+                raise RuntimeError("Database unreachable")
+            refresh_status(submission)
+
+        with mock.patch.object(
+            Submission, "refresh_status", autospec=True, side_effect=refresh_or_fail
+        ) as refresh:
+            self.assertEqual(Submission.refresh_dirty_submissions(), 2)
+
+        self.assertEqual(refresh.call_count, 2)
+        self.assertIsNotNone(get_redis().zscore(DIRTY_KEY, str(failing.id)))
+        self.assertIsNone(get_redis().zscore(DIRTY_KEY, str(refreshed.id)))
+
+
+class CounterTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=3)
+        Test.objects.filter(name="Test 2").update(coefficient=2)
+        self.submission = self.create_submission(self.exercise)
+
+        self.test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+        TestResult.register_tokens(
+            self.submission.id,
+            {test_id: f"token-{i}" for i, test_id in enumerate(self.test_ids)},
+            "judge0:2358",
+        )
+
+    def get_output(self, token, stdout):
+        return {
+            "token": token,
+            "stdout": base64.b64encode(stdout.encode()).decode(),
+            "status": {"id": 3},
+        }
+
+    def assertCountersAreRecounted(self):
+        counters = self.submission.get_counters()
+        Submission.recount(pk=self.submission.pk)
+        self.assertEqual(counters, self.submission.get_counters())
+        return counters
+
+    def test_transitions_update_the_counters(self):
+        counters = self.assertCountersAreRecounted()
+        self.assertEqual(counters["running_count"], 3)
+        self.assertEqual(counters["coefficient_sum"], 4)
+
+        TestResult.store_judge0_outputs(
+            [self.get_output("token-0", "0"), self.get_output("token-2", "2")]
+        )
+        TestResult.store_error(self.submission.id, self.test_ids[1], "Error")
+
+        counters = self.assertCountersAreRecounted()
+        self.assertEqual(counters["running_count"], 0)
+        self.assertEqual(counters["success_count"], 2)
+        self.assertEqual(counters["error_count"], 1)
+        self.assertEqual(counters["success_coefficient_sum"], 3)
+
+    def test_output_stored_twice_is_counted_once(self):
+        # Loaded by the callback view while the reconciliation stores the same output
+        stale = TestResult.objects.select_related("exercise_test").get(token="token-2")
+        TestResult.store_judge0_outputs([self.get_output("token-2", "2")])
+        TestResult.store_judge0_outputs([self.get_output("token-2", "2")])
+        stale.store_judge0_output(self.get_output("token-2", "2"))
+
+        counters = self.assertCountersAreRecounted()
+        self.assertEqual(counters["running_count"], 2)
+        self.assertEqual(counters["success_count"], 1)
+        self.assertEqual(counters["success_coefficient_sum"], 2)
+
+    def test_deletions_recount_the_submissions(self):
+        from django.contrib.admin.sites import site
+
+        TestResult.store_judge0_outputs([self.get_output("token-2", "2")])
+
+        Test.objects.get(name="Test 2").delete()
+        counters = self.assertCountersAreRecounted()
+        self.assertEqual(counters["success_count"], 0)
+        self.assertEqual(counters["coefficient_sum"], 2)
+
+        TestResult.objects.get(token="token-0").delete()
+        self.assertEqual(self.assertCountersAreRecounted()["running_count"], 1)
+
+        site._registry[TestResult].delete_queryset(None, TestResult.objects.all())
+        self.assertEqual(self.assertCountersAreRecounted()["running_count"], 0)
+
+
+class GradeTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=2, grade=20)
+        self.submission = self.create_submission(self.exercise)
+
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+        TestResult.register_tokens(
+            self.submission.id,
+            {test_id: f"token-{i}" for i, test_id in enumerate(test_ids)},
+        )
+        TestResult.store_judge0_outputs(
+            [
+                {"token": "token-0", "stdout": base64.b64encode(b"0").decode()},
+                {"token": "token-1", "stdout": base64.b64encode(b"wrong").decode()},
+            ]
+        )
+
+    def test_exercise_grade_change_updates_the_grades(self):
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.grade, 10)
+
+        self.exercise.grade = 5
+        self.exercise.save()
+
+        self.submission.refresh_from_db()
+        self.assertEqual(self.submission.grade, 2.5)
+
+
+class MissingTestResultsMigrationTests(ArbitreTestCase):
+    def test_submissions_without_results_get_pending_ones(self):
+        from django.apps import apps
+        from importlib import import_module
+
+        migration = import_module("runner.migrations.0047_create_missing_testresults")
+
+        exercise = self.create_exercise(tests=2)
+        submission = self.create_submission(exercise)
+
+        # Uploaded before the deployment, only waiting for a `run_test` message
+        TestResult.objects.all().delete()
+        Submission.recount(pk=submission.pk)
+
+        migration.create_missing_testresults(apps, None)
+
+        self.assertEqual(
+            set(TestResult.objects.values_list("status", flat=True)),
+            {TestResult.TestResultStatus.PENDING},
+        )
+        self.assertEqual(TestResult.objects.count(), 2)
+        self.assertEqual(submission.get_counters()["pending_count"], 2)
+
+
+class OutboxRelayTests(ArbitreTestCase):
+    def test_each_entry_is_published_once(self):
+        exercise = self.create_exercise(tests=2)
+        first = self.create_submission(exercise, username="first")
+        second = self.create_submission(exercise, username="second")
+
+        publish = mock.Mock()
+        self.assertEqual(DispatchOutbox.relay(publish=publish), 2)
+        self.assertEqual(
+            sorted(call.args[0].submission_id for call in publish.call_args_list),
+            sorted([first.id, second.id]),
+        )
+
+        # Published entries are not published again
+        publish.reset_mock()
+        self.assertEqual(DispatchOutbox.relay(publish=publish), 0)
+        publish.assert_not_called()
+        self.assertFalse(DispatchOutbox.objects.filter(dispatched_at=None).exists())
+
+
+class DispatchIdempotencyTests(RedisTestMixin, ArbitreTestCase):
+    env = {"RUNNER_DATA_ACCESS": "database", "JUDGE0_BATCH_DISPATCH": "False"}
+
+    def test_entries_published_twice_run_once(self):
+        from arbitre import tasks
+
+        exercise = self.create_exercise(tests=1)
+        self.create_submission(exercise)
+        entry = DispatchOutbox.objects.get()
+        args, kwargs = entry.get_task_arguments()
+
+        with mock.patch.object(
+            tasks, "acquire_judge0_host", return_value=("judge0:2358", [])
+        ), mock.patch.object(
+            tasks, "send_submission_to_judge0", return_value={"token": "token-0"}
+        ) as send_submission_to_judge0:
+            # The relay crashed before marking the entry as dispatched
+            tasks.run_submission(*args, **kwargs)
+            tasks.run_submission(*args, **kwargs)
+
+        send_submission_to_judge0.assert_called_once()
+
+
+class QueueRoutingTests(ArbitreTestCase):
+    env = {"DISPATCH_URGENT_WINDOW": "300"}
+
+    def setUp(self):
+        exercise = self.create_exercise(tests=1)
+        self.submission = self.create_submission(exercise)
+        self.entry = DispatchOutbox.objects.get()
+
+    def publish(self, entry):
+        from arbitre import celery_app
+
+        with mock.patch.object(celery_app, "send_task") as send_task:
+            entry.publish_to_celery()
+
+        return send_task.call_args.kwargs
+
+    def test_queues_accept_priorities(self):
+        from arbitre import celery_app
+
+        queues = {queue.name: queue for queue in celery_app.conf.task_queues}
+        for name in ["interactive", "recovery", "bulk"]:
+            with self.subTest(queue=name):
+                self.assertEqual(queues[name].queue_arguments, {"x-max-priority": 10})
+
+    def test_entries_are_published_to_their_queue(self):
+        from runner.models import DispatchQueue
+
+        self.entry.due_at = timezone.now() + timedelta(hours=1)
+
+        for queue, priority in [
+            (DispatchQueue.INTERACTIVE, 8),
+            (DispatchQueue.RECOVERY, 4),
+            (DispatchQueue.BULK, 1),
+        ]:
+            with self.subTest(queue=queue):
+                self.entry.queue = queue
+                published = self.publish(self.entry)
+
+                self.assertEqual(published["queue"], queue)
+                self.assertEqual(published["priority"], priority)
+                self.assertEqual(published["task_id"], str(self.entry.dispatch_id))
+
+    def test_entries_due_soon_get_a_higher_priority(self):
+        self.entry.due_at = timezone.now() + timedelta(minutes=1)
+
+        self.assertEqual(self.publish(self.entry)["priority"], 9)
+
+    def test_new_uploads_are_interactive_and_the_sweep_recovers(self):
+        from arbitre import tasks
+        from runner.models import DispatchQueue
+
+        self.assertEqual(self.entry.queue, DispatchQueue.INTERACTIVE)
+
+        # The dispatch was lost
+        DispatchOutbox.objects.update(dispatched_at=timezone.now())
+        TestResult.objects.update(
+            lease_expires_at=timezone.now() - timedelta(minutes=5)
+        )
+        tasks.run_all_pending_testresults()
+
+        entry = DispatchOutbox.get_queued(self.submission).get()
+        self.assertEqual(entry.queue, DispatchQueue.RECOVERY)
+
+
+class DispatchOutboxTests(ArbitreTestCase):
+    env = {"DISPATCH_MAX_IN_FLIGHT_PER_OWNER": "4"}
+
+    def get_entry(self, owner_id, tests=1):
+        return SimpleNamespace(
+            submission=SimpleNamespace(owner_id=owner_id), test_ids=list(range(tests))
+        )
+
+    def test_entries_are_due_at_their_deadline_or_horizon(self):
+        now = timezone.now()
+        horizon = now + timedelta(hours=6)
+
+        with mock.patch("django.utils.timezone.now", return_value=now):
+            self.assertEqual(DispatchOutbox.get_due_at(None), horizon)
+            self.assertEqual(
+                DispatchOutbox.get_due_at(now + timedelta(hours=2)),
+                now + timedelta(hours=2),
+            )
+            self.assertEqual(
+                DispatchOutbox.get_due_at(now + timedelta(days=1)), horizon
+            )
+
+            # Late submissions are not more urgent
+            self.assertEqual(
+                DispatchOutbox.get_due_at(now - timedelta(minutes=5)), horizon
+            )
+
+    def test_entries_are_published_earliest_deadline_first(self):
+        exercises = [self.create_exercise(tests=1) for _ in range(3)]
+        for exercise, hours in zip(exercises, [3, 1, 2]):
+            session = exercise.session
+            session.deadline = timezone.now() + timedelta(hours=hours)
+            session.save()
+
+        submissions = [
+            self.create_submission(exercise, username=f"student-{i}")
+            for i, exercise in enumerate(exercises)
+        ]
+
+        publish = mock.Mock()
+        DispatchOutbox.relay(publish=publish)
+
+        self.assertEqual(
+            [call.args[0].submission_id for call in publish.call_args_list],
+            [submissions[1].id, submissions[2].id, submissions[0].id],
+        )
+
+    def test_entries_are_picked_round_robin_across_owners(self):
+        first, second, third = [self.get_entry(1) for _ in range(3)]
+        other = self.get_entry(2)
+
+        self.assertEqual(
+            DispatchOutbox.pick_fairly([first, second, third, other], 10, {}),
+            [first, other, second, third],
+        )
+        self.assertEqual(
+            DispatchOutbox.pick_fairly([first, second, third, other], 2, {}),
+            [first, other],
+        )
+
+    def test_owners_with_too_many_tests_in_flight_are_skipped(self):
+        busy, idle = self.get_entry(1, tests=3), self.get_entry(2, tests=10)
+        in_flight = {1: 2}
+
+        # An owner with nothing in flight can always run one submission
+        self.assertEqual(
+            DispatchOutbox.pick_fairly([busy, idle], 10, in_flight), [idle]
+        )
+        self.assertEqual(in_flight, {1: 2, 2: 10})
+
+    def test_held_back_entries_are_published_once_tests_finish(self):
+        exercise = self.create_exercise(tests=3)
+        busy = self.create_submission(exercise, username="busy")
+        DispatchOutbox.relay(publish=mock.Mock())
+
+        # Their first upload is still running
+        waiting = self.create_submission(self.create_exercise(tests=3), username="busy")
+        publish = mock.Mock()
+        self.assertEqual(DispatchOutbox.relay(publish=publish), 0)
+
+        TestResult.objects.filter(submission=busy).update(
+            status=TestResult.TestResultStatus.SUCCESS
+        )
+        self.assertEqual(DispatchOutbox.relay(publish=publish), 1)
+        self.assertEqual(publish.call_args.args[0].submission_id, waiting.id)
+
+
+class StaleGenerationTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=2)
+        self.submission = self.create_submission(self.exercise)
+        self.test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+
+        # The student uploads again while the first upload is dispatched
+        self.stale_generation = self.submission.generation
+        self.submission.file.save("main.py", ContentFile(b"print(0)"), save=False)
+        self.submission.save()
+
+    def assertResultsPending(self):
+        self.assertEqual(
+            set(TestResult.objects.values_list("status", flat=True)),
+            {TestResult.TestResultStatus.PENDING},
+        )
+
+    def test_tokens_of_a_former_upload_are_dropped(self):
+        TestResult.register_tokens(
+            self.submission.id,
+            {test_id: "stale-token" for test_id in self.test_ids},
+            "judge0:2358",
+            self.stale_generation,
+        )
+
+        self.assertResultsPending()
+
+        TestResult.register_tokens(
+            self.submission.id,
+            {self.test_ids[0]: "token-0"},
+            "judge0:2358",
+            self.submission.generation,
+        )
+        self.assertEqual(
+            TestResult.objects.get(exercise_test_id=self.test_ids[0]).token, "token-0"
+        )
+
+    def test_cached_outputs_of_a_former_upload_are_dropped(self):
+        TestResult.apply_cached_outputs(
+            self.submission.id,
+            {test_id: {"status": {"id": 3}} for test_id in self.test_ids},
+            self.stale_generation,
+        )
+
+        self.assertResultsPending()
+
+    def test_runners_tokens_of_a_former_upload_are_dropped(self):
+        from rest_framework_api_key.models import APIKey
+
+        _, key = APIKey.objects.create_key(name="runner")
+        response = self.client.post(
+            reverse("testresult-tokens"),
+            {
+                "submission_pk": self.submission.id,
+                "tokens": {str(test_id): "stale-token" for test_id in self.test_ids},
+                "host": "judge0:2358",
+                "generation": self.stale_generation,
+            },
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Api-Key {key}",
+            HTTP_HOST="testserver",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertResultsPending()
+
+
+class CompletionTests(ArbitreTestCase):
+    def setUp(self):
+        self.exercise = self.create_exercise(tests=2)
+        self.submission = self.create_submission(self.exercise)
+
+    def run_tests(self, prefix):
+        test_ids = list(Test.objects.order_by("id").values_list("id", flat=True))
+        TestResult.register_tokens(
+            self.submission.id,
+            {test_id: f"{prefix}-{i}" for i, test_id in enumerate(test_ids)},
+        )
+
+        outputs = [
+            {"token": f"{prefix}-{i}", "stdout": base64.b64encode(b"0").decode()}
+            for i in range(len(test_ids))
+        ]
+        TestResult.store_judge0_outputs(outputs[:1])
+        TestResult.store_judge0_outputs(outputs)
+
+        # Callbacks delivered twice
+        TestResult.store_judge0_outputs(outputs)
+
+    def test_completion_fires_once_per_upload(self):
+        with mock.patch(
+            "arbitre.completions.record_completion_latency"
+        ) as record_completion_latency, self.captureOnCommitCallbacks(execute=True):
+            self.run_tests("first")
+
+            self.submission.refresh_from_db()
+            self.assertFalse(self.submission.complete())
+
+        record_completion_latency.assert_called_once()
+        self.assertEqual(
+            self.submission.completed_generation, self.submission.generation
+        )
+
+        # The next upload completes again
+        self.submission.file.save("main.py", ContentFile(b"print(0)"), save=False)
+        self.submission.save()
+        with mock.patch(
+            "arbitre.completions.record_completion_latency"
+        ) as record_completion_latency, self.captureOnCommitCallbacks(execute=True):
+            self.run_tests("second")
+
+        record_completion_latency.assert_called_once()
+
+
+class BulkGradeTests(ArbitreTestCase):
+    def test_bulk_grades_match_the_grades_of_each_submission(self):
+        from api.models import Course, Session
+
+        exercise = self.create_exercise(tests=3, grade=20)
+        Test.objects.filter(name="Test 2").update(coefficient=2)
+
+        Course.objects.update(late_penalty=25)
+        deadline = timezone.now() - timedelta(days=1)
+        Session.objects.update(deadline=deadline)
+
+        submissions = [
+            self.create_submission(exercise, username=f"student-{i}") for i in range(4)
+        ]
+
+        # Results : none, some and all successful, and a late one
+        statuses = [
+            ["failed", "error", "failed"],
+            ["success", "failed", "success"],
+            ["success", "success", "success"],
+            ["success", "failed", "success"],
+        ]
+        for submission, submission_statuses in zip(submissions, statuses):
+            for test_result, status in zip(
+                TestResult.objects.filter(submission=submission).order_by(
+                    "exercise_test_id"
+                ),
+                submission_statuses,
+            ):
+                TestResult.objects.filter(pk=test_result.pk).update(status=status)
+        Submission.recount(exercise=exercise)
+
+        Submission.objects.filter(pk__in=[s.pk for s in submissions[:3]]).update(
+            created=deadline - timedelta(hours=1)
+        )
+
+        # Still running, not graded yet
+        pending = self.create_submission(exercise, username="pending")
+
+        grades = {}
+        for submission in Submission.objects.filter(pk__in=[s.pk for s in submissions]):
+            submission.refresh_grade()
+            grades[submission.pk] = float(submission.grade)
+
+        Submission.objects.update(grade=None)
+        self.assertEqual(Submission.refresh_grades(exercise=exercise), 4)
+
+        self.assertEqual(
+            {
+                pk: float(grade)
+                for pk, grade in Submission.objects.exclude(pk=pending.pk).values_list(
+                    "pk", "grade"
+                )
+            },
+            grades,
+        )
+        self.assertEqual(
+            grades,
+            {
+                submissions[0].pk: 0,
+                submissions[1].pk: 15,
+                submissions[2].pk: 20,
+                submissions[3].pk: 11.25,
+            },
+        )
+        self.assertIsNone(Submission.objects.get(pk=pending.pk).grade)
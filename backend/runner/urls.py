@@ -14,6 +14,12 @@ router.register(
 router.register(
     r"submission-file", views.SubmissionFileViewSet, basename="submission-file"
 )
+router.register(
+    r"submission-payload", views.SubmissionPayloadViewSet, basename="submission-payload"
+)
+router.register(
+    r"exercise-bundle", views.ExerciseBundleViewSet, basename="exercise-bundle"
+)
 router.register(
     r"requeue-submissions",
     views.RequeueSubmissionsViewSet,
@@ -22,6 +28,31 @@ router.register(
 
 urlpatterns = [
     re_path("api/", include(router.urls)),
+    re_path(
+        "api/testresult-tokens",
+        views.TestResultTokensView.as_view(),
+        name="testresult-tokens",
+    ),
+    re_path(
+        "api/testresult-cached",
+        views.TestResultCachedView.as_view(),
+        name="testresult-cached",
+    ),
+    re_path(
+        "api/testresult-leases",
+        views.TestResultLeasesView.as_view(),
+        name="testresult-leases",
+    ),
+    re_path(
+        "api/dead-letter",
+        views.DeadLetterView.as_view(),
+        name="dead-letter",
+    ),
+    re_path(
+        "api/judge0-metrics",
+        views.Judge0MetricsView.as_view(),
+        name="judge0-metrics",
+    ),
     re_path(
         "api/judge0-callback",
         views.Judge0CallbackView.as_view(),
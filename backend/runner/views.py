@@ -1,4 +1,4 @@
-from .models import Submission, Test, TestResult
+from .models import DeadLetter, DispatchQueue, Submission, Test, TestResult
 from api.models import Exercise
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
@@ -10,12 +10,18 @@ from runner.serializers import (
     TestSerializer,
 )
 from api.util.views import RoleBasedViewSet
+from arbitre.callbacks import buffer_callback, get_backlog, is_valid_output
+from arbitre.completions import get_completion_histogram
+from arbitre.concurrency import get_windows_state, record_completion
+from arbitre.http_client import get_latency_histograms
+from arbitre.judge0_hosts import get_judge0_hosts
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError, ParseError
+from rest_framework_api_key.permissions import HasAPIKey
 import base64
 import json
 
@@ -84,6 +90,9 @@ class RefreshSubmissionViewSet(viewsets.ViewSet):
                     pk=request.query_params["submission_id"]
                 )
 
+            # Their result counters are rebuilt along
+            Submission.recount(pk__in=submissions.values("pk"))
+
             for submission in submissions:
                 test_results = TestResult.objects.filter(submission=submission)
                 status = ""
@@ -163,6 +172,58 @@ class SubmissionFileViewSet(viewsets.ViewSet):
             return error_response
 
 
+class SubmissionPayloadViewSet(viewsets.ViewSet):
+    """
+    Returns everything a runner needs to run the tests of a submission :
+    its source, its exercise's settings and tests
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # GET runner/api/submission-payload?submission_id=...&with_file=true
+    def list(self, request):
+        try:
+            submission = Submission.objects.select_related(
+                "exercise", "exercise__session__course"
+            ).get(pk=request.query_params["submission_id"])
+        except (KeyError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        except Submission.DoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        # Runners which got the source from the payload store don't need it
+        with_file = request.query_params.get("with_file", "true") == "true"
+
+        try:
+            payload = submission.get_runner_payload(with_file=with_file)
+        except FileNotFoundError:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return JsonResponse(payload)
+
+
+class ExerciseBundleViewSet(viewsets.ViewSet):
+    """
+    Returns the bundle of an exercise : everything a runner needs to run its tests,
+    with its version. Runners cache bundles by version.
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # GET runner/api/exercise-bundle?exercise_id=...
+    def list(self, request):
+        try:
+            exercise = Exercise.objects.select_related("session__course").get(
+                pk=request.query_params["exercise_id"]
+            )
+        except (KeyError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        except Exercise.DoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        return JsonResponse(exercise.get_bundle())
+
+
 class RequeueSubmissionsViewSet(viewsets.ViewSet):
     """
     Requeues all submissions for a given exercise
@@ -180,12 +241,28 @@ class RequeueSubmissionsViewSet(viewsets.ViewSet):
             # Get all test results for the submissions and set their status to "pending"
             TestResult.objects.filter(
                 submission__exercise_id=request.query_params["exercise_id"]
-            ).update(status="pending", stdout="")
+            ).update(
+                status="pending",
+                stdout="",
+                queue=DispatchQueue.BULK,
+                lease_expires_at=None,
+            )
+            Submission.recount(exercise_id=request.query_params["exercise_id"])
+
+            # Their failed dispatches are replayed along
+            DeadLetter.resolve(
+                submission__exercise_id=request.query_params["exercise_id"]
+            )
 
             # Set all submissions to pending
             for submission in submissions:
                 Submission.objects.filter(pk=submission.id).update(status="pending")
 
+            # Dispatch them on the bulk queue, behind live submissions
+            TestResult.run_all_pending_testresults(
+                submission__exercise_id=request.query_params["exercise_id"]
+            )
+
             return JsonResponse({"detail": "Submissions requeued"})
 
         except Submission.DoesNotExist:
@@ -236,6 +313,9 @@ class RawTestsViewSet(viewsets.ModelViewSet):
                 stdout=test.get("stdout"),
             )
 
+        # The results of the former tests were deleted along
+        Submission.recount(exercise_id=exercise_id)
+
 
 class TestViewSet(RoleBasedViewSet):
     queryset = Test.objects.all()
@@ -276,7 +356,16 @@ class TestViewSet(RoleBasedViewSet):
         TestResult.objects.filter(
             submission__exercise_id=self.request.data["exercise"],
             exercise_test=self.request.data["id"],
-        ).update(status="pending", stdout="")
+        ).update(
+            status="pending",
+            stdout="",
+            queue=DispatchQueue.BULK,
+            lease_expires_at=None,
+        )
+
+        # The test's coefficient may have changed too
+        serializer.save()
+        Submission.recount(exercise_id=self.request.data["exercise"])
 
         # Take all associated submissions and refresh their statuses
         for submission in Submission.objects.filter(
@@ -284,17 +373,25 @@ class TestViewSet(RoleBasedViewSet):
         ):
             submission.refresh_status()
 
-        serializer.save()
+        # Their failed dispatches are replayed along
+        DeadLetter.resolve(submission__exercise_id=self.request.data["exercise"])
+
+        # Dispatch them on the bulk queue, behind live submissions
+        TestResult.run_all_pending_testresults(
+            submission__exercise_id=self.request.data["exercise"],
+            exercise_test=self.request.data["id"],
+        )
+
         return super().perform_update(serializer)
 
     def perform_destroy(self, instance):
-        # Take all associated submissions and refresh their statuses
         exercise_id = instance.exercise.id
+        super().perform_destroy(instance)
+
+        # Its results were deleted along, take all associated submissions and refresh their statuses
         for submission in Submission.objects.filter(exercise_id=exercise_id):
             submission.refresh_status()
 
-        return super().perform_destroy(instance)
-
 
 class TestResultViewSet(viewsets.ModelViewSet):
     queryset = TestResult.objects.all()
@@ -317,10 +414,239 @@ class TestResultViewSet(viewsets.ModelViewSet):
             return super().get_queryset()
 
 
+def get_generation(request):
+    """
+    Upload generation the runner's request was made for, if it sent one
+    """
+
+    generation = request.data.get("generation")
+    return None if generation is None else int(generation)
+
+
+class TestResultTokensView(APIView):
+    """
+    Stores the Judge0 tokens of several tests of a submission in bulk.
+    Used by the runners after a batch of tests has been sent to Judge0.
+
+    body: {
+        "submission_pk": 1,
+        "tokens": {"<test_id>": "<judge0 token>", ...},
+        "host": "<judge0 host>",
+        "generation": 3
+    }
+
+    Tokens of a former upload (`generation`, optional) are dropped.
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # POST
+    def post(self, request, *args, **kwargs):
+        submission_id = request.data.get("submission_pk")
+        tokens = request.data.get("tokens")
+        if not submission_id or not isinstance(tokens, dict):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if not Submission.objects.filter(pk=submission_id).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            tokens = {int(test_id): str(token) for test_id, token in tokens.items()}
+            generation = get_generation(request)
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        TestResult.register_tokens(
+            submission_id, tokens, str(request.data.get("host", "")), generation
+        )
+
+        return Response(status=status.HTTP_200_OK)
+
+
+class TestResultCachedView(APIView):
+    """
+    Stores the results of several tests of a submission from cached Judge0 outputs.
+    Used by the runners when identical executions already ran.
+
+    body: {
+        "submission_pk": 1,
+        "outputs": {"<test_id>": {"stdout": "<base64>", "time": 0.1, ...}, ...},
+        "generation": 3
+    }
+
+    Outputs for a former upload (`generation`, optional) are dropped.
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # POST
+    def post(self, request, *args, **kwargs):
+        submission_id = request.data.get("submission_pk")
+        outputs = request.data.get("outputs")
+        if not submission_id or not isinstance(outputs, dict):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if not Submission.objects.filter(pk=submission_id).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            outputs = {
+                int(test_id): output
+                for test_id, output in outputs.items()
+                if isinstance(output, dict)
+            }
+            generation = get_generation(request)
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        TestResult.apply_cached_outputs(submission_id, outputs, generation)
+
+        return Response(status=status.HTTP_200_OK)
+
+
+class TestResultLeasesView(APIView):
+    """
+    Gives pending results more time before the sweep dispatches them again.
+    Used by the runners when they postpone a dispatch by `delay` seconds.
+
+    body: {
+        "submission_pk": 1,
+        "test_ids": [1, 2, ...],
+        "delay": 2.0,
+        "generation": 3
+    }
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # POST
+    def post(self, request, *args, **kwargs):
+        submission_id = request.data.get("submission_pk")
+        test_ids = request.data.get("test_ids")
+        if not submission_id or not isinstance(test_ids, list):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            TestResult.extend_pending_leases(
+                int(submission_id),
+                [int(test_id) for test_id in test_ids],
+                float(request.data.get("delay", 0)),
+                get_generation(request),
+            )
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(status=status.HTTP_200_OK)
+
+
+class DeadLetterView(APIView):
+    """
+    Puts the tests of a submission that couldn't be sent to Judge0 in the dead letters.
+    Used by the runners once the retries are exhausted.
+
+    body: {
+        "submission_pk": 1,
+        "test_ids": [1, 2],
+        "generation": 3,
+        "attempts": 6,
+        "error": "ConnectionError(...)"
+    }
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # POST
+    def post(self, request, *args, **kwargs):
+        submission_id = request.data.get("submission_pk")
+        test_ids = request.data.get("test_ids")
+        if not submission_id or not isinstance(test_ids, list):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            DeadLetter.record(
+                int(submission_id),
+                [int(test_id) for test_id in test_ids],
+                request.data.get("generation"),
+                int(request.data.get("attempts", 1)),
+                str(request.data.get("error", "")),
+            )
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(status=status.HTTP_201_CREATED)
+
+
+class Judge0MetricsView(APIView):
+    """
+    Concurrency windows of the Judge0 hosts, latency of the runners' HTTP requests
+    (to Judge0 and the REST API) and of the submissions, in Prometheus' text format
+    """
+
+    permission_classes = [HasAPIKey]
+
+    # GET
+    def get(self, request, *args, **kwargs):
+        metrics = {
+            "window": "Executions the host may run at once",
+            "in_flight": "Executions running on the host",
+            "latency_seconds": "Average callback latency of the host's executions",
+            "error_rate": "Average rate of Judge0 errors on the host",
+        }
+
+        states = get_windows_state()
+
+        lines = []
+        for metric, description in metrics.items():
+            name = f"arbitre_judge0_{metric}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for hostname, state in states.items():
+                lines.append(f'{name}{{host="{hostname}"}} {state[metric]}')
+
+        histograms = get_latency_histograms()
+
+        name = "arbitre_http_request_duration_seconds"
+        lines.append(f"# HELP {name} Latency of the runners' HTTP requests")
+        lines.append(f"# TYPE {name} histogram")
+        for host, histogram in histograms.items():
+            for le, count in histogram["buckets"]:
+                lines.append(f'{name}_bucket{{host="{host}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{host="{host}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{host="{host}"}} {histogram["count"]}')
+
+        completion = get_completion_histogram()
+
+        name = "arbitre_submission_completion_seconds"
+        lines.append(
+            f"# HELP {name} Latency of the submissions, from upload to final result"
+        )
+        lines.append(f"# TYPE {name} histogram")
+        for le, count in completion["buckets"]:
+            lines.append(f'{name}_bucket{{le="{le}"}} {count}')
+        lines.append(f'{name}_sum {completion["sum"]}')
+        lines.append(f'{name}_count {completion["count"]}')
+
+        name = "arbitre_callbacks_backlog"
+        lines.append(f"# HELP {name} Judge0 callbacks waiting to be applied")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {get_backlog()}")
+
+        name = "arbitre_http_request_errors_total"
+        lines.append(
+            f"# HELP {name} Runners' HTTP requests without response or with a 5xx"
+        )
+        lines.append(f"# TYPE {name} counter")
+        for host, histogram in histograms.items():
+            lines.append(f'{name}{{host="{host}"}} {histogram["errors"]}')
+
+        return HttpResponse("\n".join(lines) + "\n", content_type="text/plain")
+
+
 class Judge0CallbackView(APIView):
     """
     Handles Judge0's callback on submission completion.
-    Processes the execution results and updates the corresponding TestResult.
+    The execution results are buffered, or, if the buffer is disabled or unreachable,
+    processed at once to update the corresponding TestResult.
     """
 
     # PUT
@@ -334,36 +660,25 @@ class Judge0CallbackView(APIView):
         if not token:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
+        # Rejected before buffering, it would fail its whole batch
+        if not is_valid_output(request.data):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        # Applied in batches by `python manage.py ingest_callbacks`
+        if buffer_callback(request.data):
+            return Response(status=status.HTTP_200_OK)
+
         try:
-            test_result = TestResult.objects.select_related("exercise_test").get(
-                token=token
-            )
+            test_result = TestResult.objects.select_related(
+                "exercise_test__exercise"
+            ).get(token=token)
         except TestResult.DoesNotExist:
+            # Execution of a replaced upload, its slot is freed anyway
+            for hostname in get_judge0_hosts():
+                record_completion(hostname, token)
             return Response(status=status.HTTP_404_NOT_FOUND)
 
-        test = test_result.exercise_test
-        output_data = request.data
-
-        # Decode and concatenate all output streams
-        stdout = ""
-        for key in ["message", "stdout", "stderr", "compile_output"]:
-            if output_data.get(key):
-                stdout += base64.b64decode(output_data[key]).decode("utf-8")
-
-        # Determine execution status
-        status_value = "error"
-        if output_data.get("stdout"):
-            decoded_stdout = base64.b64decode(output_data["stdout"]).decode("utf-8")
-            if not test.stdout or decoded_stdout.rstrip("\n") == test.stdout:
-                status_value = "success"
-            else:
-                status_value = "failed"
-
         # Update test result
-        test_result.stdout = stdout
-        test_result.status = status_value
-        test_result.time = output_data.get("time") or 0
-        test_result.memory = output_data.get("memory") or 0
-        test_result.save()
+        test_result.store_judge0_output(request.data)
 
         return Response(status=status.HTTP_200_OK)
@@ -9,8 +9,6 @@ Refresh grades on all submissions
 def run(*args):
     print("Refreshing the grade on all submissions...")
 
-    submissions = Submission.objects.all()
-    for s in submissions:
-        s.refresh_grade()
+    count = Submission.refresh_grades()
 
-    print("Done")
+    print(f"Done, {count} submissions graded")
@@ -30,6 +30,7 @@
           djangorestframework-api-key
           djangorestframework-simplejwt
           drf-yasg
+          httpx
           mozilla-django-oidc
           packaging
           psycopg2
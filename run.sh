@@ -32,7 +32,20 @@ echo -e "${BLUE} Automated code correction platform ${NC}"
     trap _finally EXIT
     (trap 'kill 0' SIGINT;
         cd backend && python manage.py runserver &
-        cd backend && celery -A arbitre worker -l info -B -E &
+        # One worker per queue, their concurrency sets how many tests each queue runs at once.
+        # They consume the queue of every pool of Judge0 hosts (JUDGE0_POOLS), a pool can get
+        # dedicated workers with `-Q "$(python manage.py judge0_queues interactive --pool <pool>)"`
+        # The recovery workers also drain Celery's former default queue, until LEGACY_QUEUE=False
+        cd backend && celery -A arbitre worker -l info -B -E -Q "$(python manage.py judge0_queues interactive)" -n interactive@%h -c "${INTERACTIVE_WORKERS:-4}" &
+        cd backend && celery -A arbitre worker -l info -E -Q "$(python manage.py judge0_queues recovery)" -n recovery@%h -c "${RECOVERY_WORKERS:-2}" &
+        cd backend && celery -A arbitre worker -l info -E -Q "$(python manage.py judge0_queues bulk)" -n bulk@%h -c "${BULK_WORKERS:-2}" &
+        cd backend && python manage.py ingest_callbacks &
+        # DISPATCHER=async sends the outbox to Judge0 from a single asynchronous process instead
+        if [ "${DISPATCHER}" = "async" ]; then
+            cd backend && python manage.py judge0_dispatcher &
+        else
+            cd backend && python manage.py dispatch_relay &
+        fi
         # cd backend && sudo celery -A arbitre multi start w1 w2 w3 w4 w5 w6 --loglevel="DEBUG" -Ofair -B -E &
         cd frontend && npm start
     )